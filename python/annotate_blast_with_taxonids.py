@@ -4,11 +4,16 @@ annotate a BLAST search result file with taxonomic identifiers of the search hit
 """
 
 import argparse
+import json
 import logging
+import os
+import sys
 from datetime import datetime
 import csv
 from pymeta import blast
 from pyvalise.ext import uniprot
+from pyvalise.util import files
+from pyvalise.util import progress
 
 __author__ = "Damon May"
 __copyright__ = "Copyright (c) 2015 Damon May"
@@ -17,6 +22,12 @@ __version__ = ""
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_CHECKPOINT_EVERY_LINES = 1000000
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+# how often (in lines) to check whether it's time to report progress
+PROGRESS_CHECK_LINES = 10000
+
 
 def declare_gather_args():
     """
@@ -27,15 +38,142 @@ def declare_gather_args():
 
     # declare args
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('blastfile', type=argparse.FileType('r'),
-                        help='input blast file')
-    parser.add_argument('accessiontaxonfile', type=argparse.FileType('r'),
+    parser.add_argument('blastfile', type=files.CompressedFileType('r'),
+                        help='input blast file (may be gzipped or bzipped, or - for stdin)')
+    parser.add_argument('accessiontaxonfile', type=files.CompressedFileType('r'),
                         help='input file mapping accession to taxon')
-    parser.add_argument('--out', required=True, type=argparse.FileType('w'),
-                        help='output file')
+    parser.add_argument('--out', required=True,
+                        help='output file. If it ends with .gz or .bz2 it is compressed, and can\'t be checkpointed')
+    parser.add_argument('--prefilter', action="store_true",
+                        help='Read the blast file twice: first collect the hit accessions, then load taxa '
+                             'only for those accessions. Saves a lot of memory for large accession files')
+    parser.add_argument('--tmpdir',
+                        help='directory for spooling a non-rewindable blast file when using --prefilter')
+    parser.add_argument('--checkpoint',
+                        help='checkpoint file. Default: output file with %s appended' % CHECKPOINT_SUFFIX)
+    parser.add_argument('--checkpointevery', type=int, default=DEFAULT_CHECKPOINT_EVERY_LINES,
+                        help='Write a checkpoint every this many blast lines. 0 to disable checkpointing')
+    parser.add_argument('--resume', action="store_true",
+                        help='Resume from the checkpoint left by an earlier, interrupted run, if there is one')
+    parser.add_argument('--progressinterval', type=float, default=progress.DEFAULT_REPORT_INTERVAL_SECS,
+                        help='Seconds between progress reports. 0 to disable')
 
     parser.add_argument('--debug', action="store_true", help='Enable debug logging')
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.checkpoint is None:
+        args.checkpoint = args.out + CHECKPOINT_SUFFIX
+    if args.resume:
+        if not can_checkpoint(args):
+            parser.error('--resume requires an uncompressed --out file and checkpointing enabled')
+        checkpoint = read_checkpoint(args.checkpoint)
+        if checkpoint is not None and checkpoint['blastfile'] != args.blastfile.name:
+            parser.error('Checkpoint %s is for blast file %s, not %s' % (args.checkpoint, checkpoint['blastfile'],
+                                                                       args.blastfile.name))
+        if checkpoint is not None and not os.path.exists(args.out):
+            parser.error('Can\'t resume from checkpoint %s: output file %s is missing' % (args.checkpoint, args.out))
+    return args
+
+
+def can_checkpoint(args):
+    """
+    Checkpointing needs it enabled, and an uncompressed output file that we can truncate and append to
+    :param args:
+    :return:
+    """
+    return args.checkpointevery > 0 and args.out != '-' and not files.is_compressed_path(args.out)
+
+
+def collect_hit_accessions(blast_lines):
+    """
+    Collect the UniProt accessions of all the hit proteins in a BLAST file
+    :param blast_lines:
+    :return: a set of accessions
+    """
+    result = set()
+    for line in blast_lines:
+        try:
+            blast_hit = blast.parse_blast_line(line)
+            result.add(uniprot.protid2uniprotaccession(blast_hit.hit_protein))
+        except ValueError:
+            continue
+    return result
+
+
+def load_accession_taxon_map(accession_taxon_file, accessions_tokeep=None):
+    """
+    Load a map from accession to taxon ID string.
+    :param accession_taxon_file:
+    :param accessions_tokeep: if not None, only load these accessions
+    :return:
+    """
+    result = {}
+    for row in csv.DictReader(accession_taxon_file, delimiter='\t'):
+        accession = row['accession']
+        if accessions_tokeep is None or accession in accessions_tokeep:
+            result[accession] = row['taxon_id']
+    return result
+
+
+def annotate_blast_line(line, accession_taxon_map):
+    """
+    Add the hit protein's taxon ID to a BLAST line, as a last column. The column is empty if the taxon is unknown.
+    Raises ValueError if the line isn't valid tabular BLAST output
+    :param line:
+    :param accession_taxon_map:
+    :return: the output line, and whether the hit protein's taxon is known
+    """
+    blast_hit = blast.parse_blast_line(line)
+    taxon_id_str = ''
+    hit_accession = uniprot.protid2uniprotaccession(blast_hit.hit_protein)
+    has_taxon = hit_accession in accession_taxon_map
+    if has_taxon:
+        taxon_id_str = str(accession_taxon_map[hit_accession])
+    return line.strip() + '\t' + taxon_id_str + '\n', has_taxon
+
+
+def read_checkpoint(checkpoint_path):
+    """
+    Read a checkpoint file written by write_checkpoint()
+    :param checkpoint_path:
+    :return: the checkpoint dict, or None if there's no checkpoint
+    """
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def write_checkpoint(checkpoint_path, checkpoint):
+    """
+    Atomically replace the checkpoint file, so that a crash never leaves a partial checkpoint
+    :param checkpoint_path:
+    :param checkpoint: dict
+    :return:
+    """
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.rename(tmp_path, checkpoint_path)
+
+
+def open_output(out_path, checkpoint):
+    """
+    Open the output file. If resuming from a checkpoint, discard anything written after the checkpoint
+    and position the file for appending
+    :param out_path:
+    :param checkpoint:
+    :return:
+    """
+    if checkpoint is None:
+        return files.open_file(out_path, 'w')
+    if not os.path.exists(out_path):
+        raise ValueError("Can't resume: output file %s is missing" % out_path)
+    out = open(out_path, 'r+')
+    out.truncate(checkpoint['output_offset'])
+    out.seek(0, os.SEEK_END)
+    return out
 
 
 def main():
@@ -51,27 +189,83 @@ def main():
     logger.debug("Start time: %s" % script_start_time)
 
     # do stuff here
-    accession_taxon_map = {}
-    for row in csv.DictReader(args.accessiontaxonfile, delimiter='\t'):
-        accession_taxon_map[row['accession']] = row['taxon_id']
+    blastfile_name = args.blastfile.name
+    checkpointing = can_checkpoint(args)
+    checkpoint_path = args.checkpoint
+    checkpoint = None
+    if args.resume:
+        # declare_gather_args() has checked that the checkpoint, if any, matches
+        checkpoint = read_checkpoint(checkpoint_path)
+        if checkpoint is None:
+            print("No checkpoint found at %s. Starting from the beginning." % checkpoint_path)
+
+    accessions_tokeep = None
+    if args.prefilter:
+        print("Collecting hit accessions from %s" % blastfile_name)
+        args.blastfile = files.make_rereadable(args.blastfile, tmpdir=args.tmpdir)
+        accessions_tokeep = collect_hit_accessions(args.blastfile)
+        args.blastfile.seek(0)
+        print("Found %d distinct hit accessions" % len(accessions_tokeep))
+    accession_taxon_map = load_accession_taxon_map(args.accessiontaxonfile, accessions_tokeep=accessions_tokeep)
+    print("Loaded taxa for %d accessions" % len(accession_taxon_map))
     n_withtaxa = 0
     n_written = 0
-    print("Processing file %s" % args.blastfile.name)
+    n_lines = 0
+    input_offset = 0
+    if checkpoint:
+        n_withtaxa = checkpoint['n_withtaxa']
+        n_written = checkpoint['n_written']
+        n_lines = checkpoint['n_lines']
+        input_offset = checkpoint['input_offset']
+        print("Resuming from checkpoint at line %d (byte %d)" % (n_lines, input_offset))
+        files.skip_to(args.blastfile, input_offset)
+    out = open_output(args.out, checkpoint)
+
+    start_n_lines = n_lines
+    start_n_withtaxa = n_withtaxa
+    reporter = None
+    if args.progressinterval > 0:
+        reporter = progress.ProgressReporter(start_bytes=input_offset,
+                                             start_fraction=files.calc_fraction_read(args.blastfile,
+                                                                                     input_offset) or 0.0,
+                                             interval_secs=args.progressinterval)
+    print("Processing file %s" % blastfile_name)
     for line in args.blastfile:
+        n_lines += 1
+        input_offset += len(line)
         try:
-            blast_hit = blast.parse_blast_line(line)
-            taxon_id_str = ''
-            hit_accession = uniprot.protid2uniprotaccession(blast_hit.hit_protein)
-            if hit_accession in accession_taxon_map:
-                taxon_id_str = str(accession_taxon_map[hit_accession])
+            outline, has_taxon = annotate_blast_line(line, accession_taxon_map)
+            if has_taxon:
                 n_withtaxa += 1
             n_written += 1
-            args.out.write(line.strip() + '\t' + taxon_id_str + '\n')
+            out.write(outline)
         except ValueError:
-            continue
+            pass
+        if checkpointing and n_lines % args.checkpointevery == 0:
+            out.flush()
+            write_checkpoint(checkpoint_path, {'blastfile': blastfile_name,
+                                               'input_offset': input_offset,
+                                               'output_offset': out.tell(),
+                                               'n_lines': n_lines,
+                                               'n_written': n_written,
+                                               'n_withtaxa': n_withtaxa})
+        if reporter and n_lines % PROGRESS_CHECK_LINES == 0:
+            reporter.update(n_lines - start_n_lines, input_offset, n_withtaxa - start_n_withtaxa,
+                            fraction_done=files.calc_fraction_read(args.blastfile, input_offset))
+    if reporter:
+        reporter.update(n_lines - start_n_lines, input_offset, n_withtaxa - start_n_withtaxa,
+                        fraction_done=files.calc_fraction_read(args.blastfile, input_offset), force=True)
+        reporter.finish()
+    if out is sys.stdout:
+        out.flush()
+    else:
+        out.close()
+    if checkpointing and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
     print("Done. Found taxa for %d of %d lines written" % (n_withtaxa, n_written))
 
     logger.debug("End time: %s. Elapsed time: %s" % (datetime.now(), datetime.now() - script_start_time))
 
 
-main()
+if __name__ == '__main__':
+    main()
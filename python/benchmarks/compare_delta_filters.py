@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""
+Cross-check the implementations of the BLAST log10 e-value delta filter (keep a bait's hits whose
+log10 e-value is less than --maxblastdeltalog10e worse than the bait's best hit) against each other:
+
+* BaitHits pruning as hits are added (load_blast_protein_proteins_evalues_map())
+* blast.calc_bait_delta_filtered_hits(), the vectorized filter over all baits at once
+* blast.iter_sorted_bait_delta_filtered_hits(), the same filter in batches of bait-sorted baits
+* the --externalsort path: the hits as BLAST lines through an extsort.ExternalSorter, regrouped and pruned by
+  blast.iter_sorted_bait_hits(), then filtered by blast.iter_sorted_bait_delta_filtered_hits()
+* sweep.ThresholdSweep, which keeps a prefix of each bait's hits sorted by e-value
+
+Each is compared to a reference that filters every bait's hits with calc_log10_evalue(), one hit at a
+time. The e-values are mostly whole powers of ten, with whole-number deltas, so that many hits fall
+exactly on the filter's boundary: there, a log10 computed differently (e.g., np.log10() rather than
+math.log(e, 10)) keeps a different set of hits. Exits nonzero if any implementation disagrees.
+"""
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+# the benchmarks live one directory below the pymeta and pyvalise packages
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymeta import blast
+from pymeta import extsort
+from pymeta import sweep
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_N_BAITS = 2000
+DEFAULT_MAX_DELTAS = [0.5, 1, 2, 3, 5, 10, 30, 181]
+DEFAULT_SEED = 1
+# memory ceiling for the external sort. 0 writes every line to its own run, like --sortmemorymb 0
+DEFAULT_SORT_MEMORY_BYTES = 0
+MAX_HITS_PER_BAIT = 20
+# fraction of random e-values that are whole powers of ten, and that are 0
+DECADE_FRACTION = 0.8
+ZERO_FRACTION = 0.05
+# number of disagreements to print per implementation
+MAX_MISMATCHES_SHOWN = 5
+
+# hits that sit exactly on a whole-decade boundary, as (e-value, ...) in the order they're added
+BOUNDARY_CASES = [[1e-30, 1e-25],
+                  [1e-25, 1e-30],
+                  [1e-10, 1e-7, 1e-5, 1e-8],
+                  [0.0, 1e-176, 1e-171, 1e-151],
+                  [1.0, 1e-1, 1e-2, 1e-3, 1e-5, 1e-10],
+                  [1e-100, 1e-95, 1e-90, 1e-70, 1e-99]]
+
+
+def generate_bait_evalues(n_baits, rng):
+    """
+    The e-values of each bait's hits: the boundary cases, then random baits
+    :param n_baits: number of random baits
+    :param rng:
+    :return: map from bait protein to a list of (hit protein, e-value), in the order to add them
+    """
+    result = {}
+    evalue_lists = list(BOUNDARY_CASES)
+    for i in xrange(0, n_baits):
+        evalues = []
+        for j in xrange(0, rng.randint(1, MAX_HITS_PER_BAIT)):
+            draw = rng.random()
+            if draw < ZERO_FRACTION:
+                evalues.append(0.0)
+            elif draw < DECADE_FRACTION:
+                evalues.append(float('1e-%d' % rng.randint(0, 181)))
+            else:
+                evalues.append(rng.random() * 10.0 ** -rng.randint(0, 181))
+        evalue_lists.append(evalues)
+    for i, evalues in enumerate(evalue_lists):
+        result['BAIT%06d' % i] = [('HIT%06d_%d' % (i, j), evalue) for j, evalue in enumerate(evalues)]
+    return result
+
+
+def filter_reference(bait_evalues_map, max_delta_log10_e):
+    """
+    The delta filter, one hit at a time with calc_log10_evalue()
+    :param bait_evalues_map:
+    :param max_delta_log10_e:
+    :return: map from bait protein to a frozenset of the hit proteins kept
+    """
+    result = {}
+    for bait, hits_evalues in bait_evalues_map.iteritems():
+        log10_evalues = [blast.calc_log10_evalue(evalue) for _, evalue in hits_evalues]
+        min_log10_evalue = min(log10_evalues)
+        result[bait] = frozenset([hits_evalues[i][0] for i in xrange(0, len(hits_evalues))
+                                  if log10_evalues[i] - min_log10_evalue < max_delta_log10_e])
+    return result
+
+
+def build_bait_hits_map(bait_evalues_map, max_delta_log10_e=None):
+    """
+    :param bait_evalues_map:
+    :param max_delta_log10_e: if not None, prune as hits are added, as when loading a BLAST file
+    :return: map from bait protein to BaitHits
+    """
+    result = {}
+    for bait, hits_evalues in bait_evalues_map.iteritems():
+        bait_hits = blast.BaitHits()
+        for hit_protein, evalue in hits_evalues:
+            bait_hits.add(hit_protein, evalue, max_delta_log10_e=max_delta_log10_e)
+        bait_hits.finish(max_delta_log10_e)
+        result[bait] = bait_hits
+    return result
+
+
+def filter_bait_hits_pruning(bait_evalues_map, max_delta_log10_e):
+    bait_hits_map = build_bait_hits_map(bait_evalues_map, max_delta_log10_e)
+    return dict([(bait, frozenset(bait_hits.proteins)) for bait, bait_hits in bait_hits_map.iteritems()])
+
+
+def filter_vectorized(bait_evalues_map, max_delta_log10_e):
+    return blast.calc_bait_delta_filtered_hits(build_bait_hits_map(bait_evalues_map), max_delta_log10_e)
+
+
+def filter_sorted_batches(bait_evalues_map, max_delta_log10_e):
+    bait_hits_map = build_bait_hits_map(bait_evalues_map)
+    sorted_bait_hits = [(bait, bait_hits_map[bait]) for bait in sorted(bait_hits_map.keys())]
+    # small batches, so that batch edges fall among the baits too
+    return dict([(bait, hits) for bait, hits, _ in
+                 blast.iter_sorted_bait_delta_filtered_hits(sorted_bait_hits, max_delta_log10_e, batch_baits=7)])
+
+
+def filter_external_sort(bait_evalues_map, max_delta_log10_e, max_memory_bytes, tmpdir):
+    blast_lines = []
+    for bait, hits_evalues in bait_evalues_map.iteritems():
+        for hit_protein, evalue in hits_evalues:
+            blast_lines.append('\t'.join([bait, hit_protein, '90', '100', '1', '0', '1', '100', '1', '100',
+                                          repr(evalue), '200']) + '\n')
+    sorter = extsort.ExternalSorter(max_memory_bytes=max_memory_bytes, tmpdir=tmpdir)
+    try:
+        blast.sort_blast_hits_by_bait(blast_lines, sorter)
+        sorted_bait_hits = blast.iter_sorted_bait_hits(sorter.iter_sorted(), max_delta_log10_e=max_delta_log10_e)
+        return dict([(bait, hits) for bait, hits, _ in
+                     blast.iter_sorted_bait_delta_filtered_hits(sorted_bait_hits, max_delta_log10_e)])
+    finally:
+        sorter.close()
+
+
+def filter_threshold_sweep(bait_evalues_map, max_delta_log10_e):
+    threshold_sweep = sweep.ThresholdSweep([], {}, build_bait_hits_map(bait_evalues_map), {})
+    hit_counts = threshold_sweep.calc_hit_counts(float('inf'), max_delta_log10_e)
+    return dict([(bait, frozenset(threshold_sweep.bait_hit_proteins[i][:hit_counts[i]]))
+                 for i, bait in enumerate(threshold_sweep.baits)])
+
+
+def compare_filters(bait_evalues_map, max_deltas, sort_memory_bytes, tmpdir):
+    """
+    Run every implementation at every delta and compare each bait's kept hits to the reference
+    :param bait_evalues_map:
+    :param max_deltas:
+    :param sort_memory_bytes: memory ceiling for the external sort
+    :param tmpdir: directory for the external sort's run files
+    :return: list of (implementation name, list of (delta, bait, expected hits, actual hits) mismatches)
+    """
+    def filter_external_sort_here(bait_evalues_map, max_delta_log10_e):
+        return filter_external_sort(bait_evalues_map, max_delta_log10_e, sort_memory_bytes, tmpdir)
+
+    implementations = [('BaitHits pruning', filter_bait_hits_pruning),
+                       ('calc_bait_delta_filtered_hits', filter_vectorized),
+                       ('iter_sorted_bait_delta_filtered_hits', filter_sorted_batches),
+                       ('external sort', filter_external_sort_here),
+                       ('ThresholdSweep', filter_threshold_sweep)]
+    result = [(name, []) for name, _ in implementations]
+    for max_delta_log10_e in max_deltas:
+        expected_map = filter_reference(bait_evalues_map, max_delta_log10_e)
+        for (name, function), (_, mismatches) in zip(implementations, result):
+            actual_map = function(bait_evalues_map, max_delta_log10_e)
+            for bait in sorted(expected_map.keys()):
+                if actual_map.get(bait, frozenset()) != expected_map[bait]:
+                    mismatches.append((max_delta_log10_e, bait, expected_map[bait], actual_map.get(bait)))
+    return result
+
+
+def declare_gather_args():
+    """
+    Declare all arguments, parse them, and return the args dict.
+    Does no validation beyond the implicit validation done by argparse.
+    return: a dict mapping arg names to values
+    """
+
+    # declare args
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--nbaits', type=int, default=DEFAULT_N_BAITS,
+                        help='number of random baits, besides the fixed boundary cases')
+    parser.add_argument('--maxdeltas', type=float, nargs='+', default=DEFAULT_MAX_DELTAS,
+                        help='maximum log10 e-value deltas to check')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED,
+                        help='random seed')
+    parser.add_argument('--sortmemorybytes', type=int, default=DEFAULT_SORT_MEMORY_BYTES,
+                        help='memory ceiling for the external sort. 0 writes every hit to its own sorted run')
+    parser.add_argument('--debug', action="store_true", help='Enable debug logging')
+    return parser.parse_args()
+
+
+def main():
+    args = declare_gather_args()
+    # logging
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s: %(message)s")
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    bait_evalues_map = generate_bait_evalues(args.nbaits, random.Random(args.seed))
+    print("Comparing delta filters on %d baits, %d hits, at deltas %s" %
+          (len(bait_evalues_map), sum(len(x) for x in bait_evalues_map.values()), args.maxdeltas))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        results = compare_filters(bait_evalues_map, args.maxdeltas, args.sortmemorybytes, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+    n_mismatches = 0
+    print("%-40s %10s" % ('implementation', 'mismatches'))
+    for name, mismatches in results:
+        print("%-40s %10d" % (name, len(mismatches)))
+        for max_delta_log10_e, bait, expected, actual in mismatches[:MAX_MISMATCHES_SHOWN]:
+            print("    MISMATCH delta %s, %s %s: expected %s, got %s" %
+                  (max_delta_log10_e, bait, [evalue for _, evalue in bait_evalues_map[bait]],
+                   sorted(expected), sorted(actual) if actual is not None else None))
+        n_mismatches += len(mismatches)
+    if n_mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
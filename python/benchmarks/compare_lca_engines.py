@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+"""
+Cross-check the LCA engines against each other and time them. Generates random taxon sets of
+varying size and depth over a taxonomy (synthetic, or a real one in an ncbi_taxonomy SQLite
+database) and runs every engine on every set:
+
+* raw lineages: pymeta.ncbi.infer_lca (SQLite) and pymeta.unipept.infer_lca
+* validated lineages: unipept.validate_rebuild_taxon + unipept.infer_lca, as infer_taxa_withblast.py
+  does it, and pymeta.lineagetable.LineageTable
+
+Each engine's answer is compared to a simple reference LCA computed straight from the taxonomy
+tree. validate_rebuild_taxon is checked and timed on its own, too. Reports latency percentiles and
+throughput per engine, and exits nonzero if any engine disagrees with the reference.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+from timeit import default_timer
+
+# the benchmarks live one directory below the pymeta and pyvalise packages
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic
+from pymeta import lineagetable
+from pymeta import ncbi
+from pymeta import unipept
+from pymeta.ncbi import RANKS, Taxon
+from pyvalise.util import metrics
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_N_SETS = 2000
+DEFAULT_SET_SIZES = [1, 2, 3, 5, 10, 25, 50]
+DEFAULT_N_SPECIES = 20000
+# number of disagreements to print per engine
+MAX_MISMATCHES_SHOWN = 5
+
+SQL_CREATE_TAXONOMY = \
+  "CREATE TABLE ncbi_taxonomy (taxon_id INTEGER PRIMARY KEY, name TEXT, parent_id INTEGER, rank TEXT, path TEXT)"
+
+SQL_INSERT_TAXON = \
+  "INSERT INTO ncbi_taxonomy (taxon_id, name, parent_id, rank, path) VALUES (?, ?, ?, ?, ?)"
+
+SQL_QUERY_ALL_TAXA = \
+  "SELECT taxon_id, parent_id, rank, name FROM ncbi_taxonomy"
+
+
+def write_sqlite_taxonomy(taxonid_info_map, sqlite_path):
+    """
+    Write a taxonomy to an ncbi_taxonomy table, in the layout pymeta.ncbi reads, with each taxon's path
+    from the root down to itself
+    :param taxonid_info_map: map from taxon ID to (parent ID, rank, name)
+    :param sqlite_path:
+    :return:
+    """
+    conn = sqlite3.connect(sqlite_path)
+    conn.execute(SQL_CREATE_TAXONOMY)
+    rows = []
+    for taxon_id, (parent_id, rank, name) in taxonid_info_map.iteritems():
+        path_ids = [synthetic.ROOT_TAXON_ID] + list(reversed(synthetic.calc_lineage(taxonid_info_map, taxon_id)))
+        if taxon_id == synthetic.ROOT_TAXON_ID:
+            path_ids = [taxon_id]
+        rows.append((taxon_id, name, parent_id, rank, ';'.join([str(path_id) for path_id in path_ids])))
+    conn.executemany(SQL_INSERT_TAXON, rows)
+    conn.commit()
+    conn.close()
+
+
+def read_sqlite_taxonomy(conn):
+    """
+    Read a whole ncbi_taxonomy table
+    :param conn:
+    :return: map from taxon ID to (parent ID, rank, name)
+    """
+    result = {}
+    for taxon_id, parent_id, rank, name in conn.execute(SQL_QUERY_ALL_TAXA):
+        result[taxon_id] = (parent_id, str(rank), str(name))
+    return result
+
+
+def generate_taxon_sets(taxonid_info_map, n_sets, set_sizes, rng):
+    """
+    Random taxon sets of varying size and depth. Each set is drawn by picking an anchor taxon and
+    walking a random number of steps down from it, once per member, so the sets' LCAs fall at all depths
+    :param taxonid_info_map:
+    :param n_sets:
+    :param set_sizes: set sizes to choose from
+    :param rng:
+    :return: list of lists of taxon IDs
+    """
+    parent_children_map = {}
+    for taxon_id, (parent_id, _, _) in taxonid_info_map.iteritems():
+        if taxon_id == parent_id:
+            continue
+        if parent_id not in parent_children_map:
+            parent_children_map[parent_id] = []
+        parent_children_map[parent_id].append(taxon_id)
+    all_taxon_ids = sorted(taxonid_info_map.keys())
+    result = []
+    for i in xrange(0, n_sets):
+        anchor_id = rng.choice(all_taxon_ids)
+        taxon_ids = set()
+        for j in xrange(0, rng.choice(set_sizes)):
+            taxon_id = anchor_id
+            for step in xrange(0, rng.randint(0, len(RANKS))):
+                if taxon_id not in parent_children_map:
+                    break
+                taxon_id = rng.choice(parent_children_map[taxon_id])
+            taxon_ids.add(taxon_id)
+        result.append(sorted(taxon_ids))
+    return result
+
+
+def build_reference_lca(taxonid_info_map, taxon_ids, validate):
+    """
+    The LCA of a set of taxa, by direct comparison of their lineages in the taxonomy tree
+    :param taxonid_info_map:
+    :param taxon_ids:
+    :param validate: drop lineage levels that fail unipept.validate_taxon_onelevel(), and taxa with no valid levels
+    :return: a Taxon, or None if validate is True and no taxa are valid
+    """
+    rank_ids_maps = []
+    for taxon_id in taxon_ids:
+        rank_id_map = {}
+        for lineage_id in synthetic.calc_lineage(taxonid_info_map, taxon_id):
+            _, rank, name = taxonid_info_map[lineage_id]
+            if rank in RANKS and (not validate or unipept.validate_taxon_onelevel(Taxon(lineage_id, name, rank))):
+                rank_id_map[rank] = lineage_id
+        if rank_id_map or not validate:
+            rank_ids_maps.append(rank_id_map)
+    if not rank_ids_maps:
+        return None
+    common_rank_taxon_map = {}
+    for rank in RANKS:
+        rank_ids = set([rank_id_map.get(rank) for rank_id_map in rank_ids_maps])
+        if len(rank_ids) == 1 and None not in rank_ids:
+            rank_id = rank_ids.pop()
+            common_rank_taxon_map[rank] = Taxon(rank_id, taxonid_info_map[rank_id][2], rank)
+    if not common_rank_taxon_map:
+        return Taxon(1, "root", "no rank")
+    lca = common_rank_taxon_map[[rank for rank in RANKS if rank in common_rank_taxon_map][-1]]
+    result = Taxon(lca.id, lca.name, lca.rank)
+    result.rank_taxon_map = common_rank_taxon_map
+    return result
+
+
+def describe_lca(taxon):
+    """
+    A string that two LCAs share exactly when they're the same taxon with the same lineage
+    :param taxon:
+    :return:
+    """
+    if taxon is None:
+        return 'None'
+    return taxon.tostring(',')
+
+
+def check_validated_taxon(taxon, validated_taxon):
+    """
+    Sanity checks on the result of validate_rebuild_taxon(): it keeps a subset of the lineage, and
+    validating it again changes nothing
+    :param taxon:
+    :param validated_taxon:
+    :return: a problem description, or None if it's fine
+    """
+    if validated_taxon is None:
+        return None
+    for rank in validated_taxon.rank_taxon_map:
+        if rank not in taxon.rank_taxon_map or taxon.rank_taxon_map[rank].id != validated_taxon.rank_taxon_map[rank].id:
+            return 'rank %s is not from the original lineage' % rank
+    revalidated_taxon = unipept.validate_rebuild_taxon(validated_taxon)
+    if describe_lca(revalidated_taxon) != describe_lca(validated_taxon):
+        return 'revalidating changes %s to %s' % (describe_lca(validated_taxon), describe_lca(revalidated_taxon))
+    return None
+
+
+class EngineRun:
+    """
+    Latencies and disagreements with the reference for one engine
+    """
+    def __init__(self, name, lineages, setup_secs=0.0):
+        self.name = name
+        self.lineages = lineages
+        self.setup_secs = setup_secs
+        self.latencies_secs = []
+        self.mismatches = []
+
+    def run(self, function, taxon_ids, expected):
+        start_time = default_timer()
+        answer = describe_lca(function(taxon_ids))
+        self.latencies_secs.append(default_timer() - start_time)
+        if answer != expected:
+            self.mismatches.append((taxon_ids, expected, answer))
+
+    def to_dict(self):
+        result = metrics.summarize_latencies(self.latencies_secs)
+        result.update({'engine': self.name,
+                       'lineages': self.lineages,
+                       'setup_secs': self.setup_secs,
+                       'calls_per_sec': len(self.latencies_secs) / result['total_secs'] if result['total_secs'] else None,
+                       'n_mismatches': len(self.mismatches)})
+        return result
+
+
+def compare_engines(taxonid_info_map, conn, taxon_sets):
+    """
+    Run every engine on every taxon set and compare each answer to the reference
+    :param taxonid_info_map:
+    :param conn: connection to the ncbi_taxonomy database
+    :param taxon_sets:
+    :return: list of EngineRuns
+    """
+    all_taxon_ids = set()
+    for taxon_ids in taxon_sets:
+        all_taxon_ids.update(taxon_ids)
+    stub = synthetic.UnipeptStub(taxonid_info_map)
+    taxonid_taxon_map = dict([(taxon_id, unipept.parse_taxon_info_map(stub.build_row(taxon_id)))
+                              for taxon_id in all_taxon_ids])
+
+    validator_run = EngineRun('unipept.validate_rebuild_taxon', 'raw')
+    taxonid_validated_map = {}
+    for taxon_id in sorted(all_taxon_ids):
+        taxon = taxonid_taxon_map[taxon_id]
+        start_time = default_timer()
+        validated_taxon = unipept.validate_rebuild_taxon(taxon)
+        validator_run.latencies_secs.append(default_timer() - start_time)
+        problem = check_validated_taxon(taxon, validated_taxon)
+        if problem:
+            validator_run.mismatches.append(([taxon_id], 'consistent', problem))
+        if validated_taxon:
+            taxonid_validated_map[taxon_id] = validated_taxon
+
+    start_time = default_timer()
+    table = lineagetable.LineageTable(taxonid_taxon_map)
+    table_setup_secs = default_timer() - start_time
+
+    def infer_lca_lineagetable(taxon_ids):
+        rows = table.calc_rows(taxon_ids)
+        if not rows:
+            return None
+        return table.build_lca(rows[0], lineagetable.calc_common_rank_idxs(table.lineages, rows))
+
+    def infer_lca_unipept_validated(taxon_ids):
+        taxa = [taxonid_validated_map[taxon_id] for taxon_id in taxon_ids if taxon_id in taxonid_validated_map]
+        if not taxa:
+            return None
+        return unipept.infer_lca(taxa)
+
+    engines = [(EngineRun('ncbi.infer_lca', 'raw'), lambda taxon_ids: ncbi.infer_lca(taxon_ids, conn)),
+               (EngineRun('unipept.infer_lca', 'raw'),
+                lambda taxon_ids: unipept.infer_lca([taxonid_taxon_map[taxon_id] for taxon_id in taxon_ids])),
+               (EngineRun('unipept.infer_lca', 'validated'), infer_lca_unipept_validated),
+               (EngineRun('LineageTable', 'validated', setup_secs=table_setup_secs), infer_lca_lineagetable)]
+    for taxon_ids in taxon_sets:
+        raw_expected = describe_lca(build_reference_lca(taxonid_info_map, taxon_ids, False))
+        validated_expected = describe_lca(build_reference_lca(taxonid_info_map, taxon_ids, True))
+        for engine_run, function in engines:
+            engine_run.run(function, taxon_ids, raw_expected if engine_run.lineages == 'raw' else validated_expected)
+    return [validator_run] + [engine_run for engine_run, _ in engines]
+
+
+def declare_gather_args():
+    """
+    Declare all arguments, parse them, and return the args dict.
+    Does no validation beyond the implicit validation done by argparse.
+    return: a dict mapping arg names to values
+    """
+
+    # declare args
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sqlitedb',
+                        help='SQLite database with an ncbi_taxonomy table (taxon_id, name, parent_id, rank, path). '
+                             'Default: generate a synthetic taxonomy')
+    parser.add_argument('--nspecies', type=int, default=DEFAULT_N_SPECIES,
+                        help='number of species in the synthetic taxonomy')
+    parser.add_argument('--nsets', type=int, default=DEFAULT_N_SETS,
+                        help='number of random taxon sets')
+    parser.add_argument('--setsizes', type=int, nargs='+', default=DEFAULT_SET_SIZES,
+                        help='taxon set sizes to choose from')
+    parser.add_argument('--seed', type=int, default=synthetic.DEFAULT_SEED,
+                        help='random seed')
+    parser.add_argument('--out', type=argparse.FileType('w'),
+                        help='output JSON file with the per-engine results')
+    parser.add_argument('--debug', action="store_true", help='Enable debug logging')
+    return parser.parse_args()
+
+
+def main():
+    args = declare_gather_args()
+    # logging
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s: %(message)s")
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    rng = random.Random(args.seed)
+    tmp_dir = None
+    sqlite_path = args.sqlitedb
+    if not sqlite_path:
+        tmp_dir = tempfile.mkdtemp()
+        sqlite_path = os.path.join(tmp_dir, 'taxonomy.sqlite')
+        taxonid_info_map = synthetic.SyntheticTaxonomy(args.nspecies, rng).taxonid_info_map
+        write_sqlite_taxonomy(taxonid_info_map, sqlite_path)
+        print("Built a synthetic taxonomy of %d taxa" % len(taxonid_info_map))
+    conn = ncbi.open_conn(sqlite_path)
+    try:
+        taxonid_info_map = read_sqlite_taxonomy(conn)
+        taxon_sets = generate_taxon_sets(taxonid_info_map, args.nsets, args.setsizes, rng)
+        print("Comparing LCA engines on %d taxon sets over %d taxa" % (len(taxon_sets), len(taxonid_info_map)))
+        engine_runs = compare_engines(taxonid_info_map, conn, taxon_sets)
+    finally:
+        conn.close()
+        if tmp_dir:
+            os.remove(sqlite_path)
+            os.rmdir(tmp_dir)
+
+    print("%-32s %-10s %8s %10s %10s %10s %12s %10s" %
+          ('engine', 'lineages', 'calls', 'p50 us', 'p90 us', 'p99 us', 'calls/s', 'mismatches'))
+    for engine_run in engine_runs:
+        summary = engine_run.to_dict()
+        print("%-32s %-10s %8d %10.1f %10.1f %10.1f %12.1f %10d" %
+              (engine_run.name, engine_run.lineages, summary['n_calls'], summary['p50_secs'] * 1e6,
+               summary['p90_secs'] * 1e6, summary['p99_secs'] * 1e6, summary['calls_per_sec'] or 0,
+               summary['n_mismatches']))
+        for taxon_ids, expected, answer in engine_run.mismatches[:MAX_MISMATCHES_SHOWN]:
+            print("    MISMATCH %s: expected %s, got %s" % (taxon_ids, expected, answer))
+    if args.out:
+        json.dump([engine_run.to_dict() for engine_run in engine_runs], args.out, indent=2, sort_keys=True)
+        args.out.write('\n')
+        args.out.close()
+    if any(engine_run.mismatches for engine_run in engine_runs):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
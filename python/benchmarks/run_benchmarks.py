@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+"""
+Benchmark each stage of the peptide LCA pipeline, and the whole of infer_taxa_withblast.py and
+annotate_blast_with_taxonids.py, on synthetic datasets of configurable scale. Runs offline: Unipept
+calls are answered from the synthetic taxonomy. Each benchmark runs in its own process, so peak
+memory is measured per benchmark. Results can be saved as a baseline, and later runs compared
+against it to catch throughput and memory regressions.
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# the benchmarks live one directory below the pymeta and pyvalise packages
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic
+from pyvalise.util import metrics
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCALES = [10000]
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# fractional drop in throughput, or rise in peak memory, that counts as a regression
+DEFAULT_TOLERANCE = 0.2
+
+
+def open_data(datadir, filename):
+    return open(os.path.join(datadir, filename))
+
+
+def count_lines(datadir, filename):
+    """
+    Count the lines in a data file. Also warms the page cache, so the timed read that follows
+    measures parsing rather than the disk
+    :param datadir:
+    :param filename:
+    :return:
+    """
+    with open_data(datadir, filename) as infile:
+        return sum(1 for _ in infile)
+
+
+def load_pepseqs(datadir):
+    import infer_taxa_withblast
+    with open_data(datadir, synthetic.PEPSEQS_FILENAME) as infile:
+        return infer_taxa_withblast.load_pepseqs(infile)
+
+
+def load_pep_prots(datadir, pepseqs):
+    import infer_taxa_withblast
+    with open_data(datadir, synthetic.PEPPROT_FILENAME) as infile:
+        return infer_taxa_withblast.load_pep_prots_maps(infile, pepseqs)[0]
+
+
+def load_bait_hits(datadir, peps_prots_map):
+    from pymeta import blast
+    baits = set()
+    for proteins in peps_prots_map.values():
+        baits.update(proteins)
+    with open_data(datadir, synthetic.BLAST_FILENAME) as infile:
+        return blast.load_blast_protein_proteins_evalues_map(infile, baitproteins_tokeep=baits, trim_accessions=True)
+
+
+def load_prot_taxa(datadir, bait_hits_map):
+    import infer_taxa_withblast
+    blastproteins = set()
+    for bait_hits in bait_hits_map.values():
+        blastproteins.update(bait_hits.proteins)
+    with open_data(datadir, synthetic.PROTTAXON_FILENAME) as infile:
+        return infer_taxa_withblast.load_blastprotein_taxonid_map(infile, blastproteins), blastproteins
+
+
+def load_associations(datadir):
+    """
+    Run the pipeline up to the peptide -> taxa associations
+    :param datadir:
+    :return: a map from peptide to set of taxon IDs
+    """
+    import infer_taxa_withblast
+    pepseqs = load_pepseqs(datadir)
+    peps_prots_map = load_pep_prots(datadir, pepseqs)
+    bait_hits_map = load_bait_hits(datadir, peps_prots_map)
+    blastprotein_taxonid_map = load_prot_taxa(datadir, bait_hits_map)[0]
+    return infer_taxa_withblast.associate_peptides_blasthits_taxa(
+        pepseqs, peps_prots_map, bait_hits_map, blastprotein_taxonid_map,
+        infer_taxa_withblast.DEFAULT_MAX_BLAST_DELTA_LOG10_E)[1]
+
+
+def install_stub(datadir):
+    with open_data(datadir, synthetic.TAXONOMY_FILENAME) as infile:
+        return synthetic.install_unipept_stub(synthetic.read_taxonomy(infile))
+
+
+def load_taxa(datadir, peptide_taxonids_map):
+    from pymeta import unipept
+    install_stub(datadir)
+    all_taxon_ids = set()
+    for taxon_ids in peptide_taxonids_map.values():
+        all_taxon_ids.update(taxon_ids)
+    return unipept.taxonomy(sorted(all_taxon_ids), validate=True)
+
+
+def timed(function):
+    """
+    Call function, and time it
+    :param function:
+    :return: seconds taken
+    """
+    start_time = time.time()
+    function()
+    return time.time() - start_time
+
+
+# Each benchmark does its own setup, then times its stage. Returns (number of items, item unit, seconds)
+
+def bench_load_pep_prots(datadir, n_workers):
+    pepseqs = load_pepseqs(datadir)
+    count_lines(datadir, synthetic.PEPPROT_FILENAME)
+    return len(pepseqs), 'peptides', timed(lambda: load_pep_prots(datadir, pepseqs))
+
+
+def bench_load_blast(datadir, n_workers):
+    peps_prots_map = load_pep_prots(datadir, load_pepseqs(datadir))
+    n_lines = count_lines(datadir, synthetic.BLAST_FILENAME)
+    return n_lines, 'BLAST lines', timed(lambda: load_bait_hits(datadir, peps_prots_map))
+
+
+def bench_load_prot_taxa(datadir, n_workers):
+    bait_hits_map = load_bait_hits(datadir, load_pep_prots(datadir, load_pepseqs(datadir)))
+    n_lines = count_lines(datadir, synthetic.PROTTAXON_FILENAME)
+    return n_lines, 'accessions', timed(lambda: load_prot_taxa(datadir, bait_hits_map))
+
+
+def bench_associate(datadir, n_workers, sparse=False):
+    import infer_taxa_withblast
+    from pymeta import relations
+    pepseqs = load_pepseqs(datadir)
+    peps_prots_map = load_pep_prots(datadir, pepseqs)
+    bait_hits_map = load_bait_hits(datadir, peps_prots_map)
+    blastprotein_taxonid_map = load_prot_taxa(datadir, bait_hits_map)[0]
+    associate_function = infer_taxa_withblast.associate_peptides_blasthits_taxa
+    if sparse:
+        associate_function = relations.associate_peptides_blasthits_taxa
+    return len(pepseqs), 'peptides', timed(lambda: associate_function(
+        pepseqs, peps_prots_map, bait_hits_map, blastprotein_taxonid_map,
+        infer_taxa_withblast.DEFAULT_MAX_BLAST_DELTA_LOG10_E))
+
+
+def bench_associate_sparse(datadir, n_workers):
+    return bench_associate(datadir, n_workers, sparse=True)
+
+
+def bench_taxonomy(datadir, n_workers):
+    peptide_taxonids_map = load_associations(datadir)
+    all_taxon_ids = set()
+    for taxon_ids in peptide_taxonids_map.values():
+        all_taxon_ids.update(taxon_ids)
+    return len(all_taxon_ids), 'taxa', timed(lambda: load_taxa(datadir, peptide_taxonids_map))
+
+
+def bench_infer_lcas(datadir, n_workers):
+    import infer_taxa_withblast
+    peptide_taxonids_map = load_associations(datadir)
+    taxonid_taxon_map = load_taxa(datadir, peptide_taxonids_map)
+    return len(peptide_taxonids_map), 'peptides', timed(lambda: infer_taxa_withblast.infer_peptide_lcas(
+        peptide_taxonids_map, taxonid_taxon_map))
+
+
+def bench_infer_lcas_lineagetable(datadir, n_workers):
+    from pymeta import lineagetable
+    peptide_taxonids_map = load_associations(datadir)
+    taxonid_taxon_map = load_taxa(datadir, peptide_taxonids_map)
+    return len(peptide_taxonids_map), 'peptides', timed(lambda: lineagetable.LineageTable(
+        taxonid_taxon_map).infer_lcas(peptide_taxonids_map, n_workers=n_workers))
+
+
+def run_script_main(module_name, argv):
+    """
+    Run a pipeline script's main() in this process, with the given command line
+    :param module_name:
+    :param argv:
+    :return: seconds taken
+    """
+    module = __import__(module_name)
+    sys.argv = [module_name + '.py'] + argv
+    return timed(module.main)
+
+
+def bench_annotate(datadir, n_workers):
+    n_lines = count_lines(datadir, synthetic.BLAST_FILENAME)
+    fd, out_path = tempfile.mkstemp(dir=datadir)
+    os.close(fd)
+    try:
+        secs = run_script_main('annotate_blast_with_taxonids',
+                               [os.path.join(datadir, synthetic.BLAST_FILENAME),
+                                os.path.join(datadir, synthetic.PROTTAXON_FILENAME),
+                                '--out', out_path, '--prefilter'])
+    finally:
+        os.remove(out_path)
+    return n_lines, 'BLAST lines', secs
+
+
+def bench_end_to_end(datadir, n_workers):
+    n_pepseqs = count_lines(datadir, synthetic.PEPSEQS_FILENAME)
+    install_stub(datadir)
+    fd, out_path = tempfile.mkstemp(dir=datadir)
+    os.close(fd)
+    try:
+        secs = run_script_main('infer_taxa_withblast',
+                               ['--pepseqsfile', os.path.join(datadir, synthetic.PEPSEQS_FILENAME),
+                                '--pepprotmap', os.path.join(datadir, synthetic.PEPPROT_FILENAME),
+                                '--fastablast', os.path.join(datadir, synthetic.BLAST_FILENAME),
+                                '--prottaxonmap', os.path.join(datadir, synthetic.PROTTAXON_FILENAME),
+                                '--outpeptlcas', out_path, '--workers', str(n_workers)])
+    finally:
+        os.remove(out_path)
+    return n_pepseqs, 'peptides', secs
+
+
+BENCHMARKS = [('load_pep_prots', bench_load_pep_prots),
+              ('load_blast', bench_load_blast),
+              ('load_prot_taxa', bench_load_prot_taxa),
+              ('associate', bench_associate),
+              ('associate_sparse', bench_associate_sparse),
+              ('taxonomy', bench_taxonomy),
+              ('infer_lcas', bench_infer_lcas),
+              ('infer_lcas_lineagetable', bench_infer_lcas_lineagetable),
+              ('annotate', bench_annotate),
+              ('end_to_end', bench_end_to_end)]
+BENCHMARK_NAMES = [name for name, _ in BENCHMARKS]
+
+
+def run_one(name, datadir, n_workers):
+    """
+    Run one benchmark in this process
+    :param name:
+    :param datadir:
+    :param n_workers:
+    :return: the result dict
+    """
+    start_rss_mb = metrics.get_peak_rss_mb()
+    n_items, unit, secs = dict(BENCHMARKS)[name](datadir, n_workers)
+    return {'name': name,
+            'items': n_items,
+            'unit': unit,
+            'secs': secs,
+            'items_per_sec': n_items / secs if secs > 0 else None,
+            'start_rss_mb': start_rss_mb,
+            'peak_rss_mb': metrics.get_peak_rss_mb()}
+
+
+def run_in_child(name, datadir, n_workers, show_output):
+    """
+    Run one benchmark in a fresh Python process, so its peak memory isn't polluted by other benchmarks
+    :param name:
+    :param datadir:
+    :param n_workers:
+    :param show_output: let the child's stdout through
+    :return: the result dict
+    """
+    fd, result_path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            returncode = subprocess.call([sys.executable, os.path.abspath(__file__),
+                                          '--runone', name, '--datadir', datadir, '--resultfile', result_path,
+                                          '--workers', str(n_workers)],
+                                         stdout=None if show_output else devnull)
+        if returncode != 0:
+            raise ValueError('Benchmark %s failed with exit code %d' % (name, returncode))
+        with open(result_path) as result_file:
+            return json.load(result_file)
+    finally:
+        os.remove(result_path)
+
+
+def make_result_key(result):
+    return '%s@%d' % (result['name'], result['scale'])
+
+
+def compare_to_baseline(results, baseline_results, tolerance):
+    """
+    Compare each result to the baseline result for the same benchmark and scale
+    :param results:
+    :param baseline_results:
+    :param tolerance: fractional drop in throughput or rise in peak memory that counts as a regression
+    :return: list of (result key, message) for the regressions
+    """
+    key_baseline_map = dict([(make_result_key(result), result) for result in baseline_results])
+    regressions = []
+    for result in results:
+        key = make_result_key(result)
+        if key not in key_baseline_map:
+            continue
+        baseline = key_baseline_map[key]
+        if baseline['items_per_sec'] and result['items_per_sec'] < baseline['items_per_sec'] * (1 - tolerance):
+            regressions.append((key, 'throughput %.1f %s/s, baseline %.1f' %
+                                (result['items_per_sec'], result['unit'], baseline['items_per_sec'])))
+        if result['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + tolerance):
+            regressions.append((key, 'peak RSS %.1f MB, baseline %.1f' %
+                                (result['peak_rss_mb'], baseline['peak_rss_mb'])))
+    return regressions
+
+
+def declare_gather_args():
+    """
+    Declare all arguments, parse them, and return the args dict.
+    Does no validation beyond the implicit validation done by argparse.
+    return: a dict mapping arg names to values
+    """
+
+    # declare args
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES,
+                        help='numbers of identified peptides to benchmark at, e.g., 10000 100000 1000000 10000000')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARK_NAMES, default=BENCHMARK_NAMES,
+                        help='benchmarks to run. Default all')
+    parser.add_argument('--datadir', default=os.path.join(tempfile.gettempdir(), 'pymeta_benchmark_data'),
+                        help='directory for the synthetic datasets. Datasets are generated once per scale and seed '
+                             'and reused')
+    parser.add_argument('--seed', type=int, default=synthetic.DEFAULT_SEED,
+                        help='random seed for the synthetic datasets')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes for the stages that can use them')
+    parser.add_argument('--out', type=argparse.FileType('w'),
+                        help='output JSON file with the results')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH,
+                        help='stored baseline results to compare against, if the file exists')
+    parser.add_argument('--savebaseline', action="store_true",
+                        help='save these results as the baseline, replacing any results for the same benchmarks '
+                             'and scales')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='fractional drop in throughput, or rise in peak memory, that counts as a regression')
+    parser.add_argument('--showoutput', action="store_true",
+                        help='show the output of the stages as they run')
+    parser.add_argument('--runone', choices=BENCHMARK_NAMES,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--resultfile',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--debug', action="store_true", help='Enable debug logging')
+    return parser.parse_args()
+
+
+def main():
+    args = declare_gather_args()
+    # logging
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s: %(message)s")
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    if args.runone:
+        result = run_one(args.runone, args.datadir, args.workers)
+        with open(args.resultfile, 'w') as result_file:
+            json.dump(result, result_file)
+        return
+
+    results = []
+    for scale in args.scales:
+        datadir = os.path.join(args.datadir, 'scale%d_seed%d' % (scale, args.seed))
+        if not synthetic.is_dataset_complete(datadir):
+            synthetic.generate_dataset(datadir, scale, seed=args.seed)
+        for name in args.benchmarks:
+            logger.info("Running %s at scale %d..." % (name, scale))
+            result = run_in_child(name, datadir, args.workers, args.showoutput)
+            result['scale'] = scale
+            result['workers'] = args.workers
+            print("%-24s %10d %12d %-12s %9.2fs %12.1f/s %9.1f MB" %
+                  (name, scale, result['items'], result['unit'], result['secs'], result['items_per_sec'] or 0,
+                   result['peak_rss_mb']))
+            results.append(result)
+
+    if args.out:
+        json.dump(results, args.out, indent=2, sort_keys=True)
+        args.out.write('\n')
+        args.out.close()
+
+    baseline_results = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline_results = json.load(baseline_file)
+    regressions = compare_to_baseline(results, baseline_results, args.tolerance)
+    for key, message in regressions:
+        print("REGRESSION %s: %s" % (key, message))
+
+    if args.savebaseline:
+        new_keys = set([make_result_key(result) for result in results])
+        baseline_results = [result for result in baseline_results if make_result_key(result) not in new_keys]
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline_results + results, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        print("Saved baseline %s" % args.baseline)
+    elif regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+"""
+Generate a consistent synthetic dataset for benchmarking the peptide LCA pipeline: a taxonomy,
+a tide index pep->prot export, identified peptides, BLAST tabular results for the index proteins
+and an accession->taxon map for the BLAST hits. Everything is derived from a seed, and files are
+written as they're generated, so datasets of 10^7 peptides don't need to fit in memory.
+
+Also provides a stand-in for the Unipept API that answers taxonomy requests from the synthetic
+taxonomy, so the pipeline can run offline.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+
+# the benchmarks live one directory below the pymeta and pyvalise packages
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymeta import unipept
+from pymeta.ncbi import RANKS
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+# file names within a dataset directory
+TAXONOMY_FILENAME = 'taxonomy.tsv'
+PEPPROT_FILENAME = 'pepprot.tsv'
+PEPSEQS_FILENAME = 'pepseqs.txt'
+BLAST_FILENAME = 'blast.tsv'
+PROTTAXON_FILENAME = 'prottaxon.tsv'
+# written last, so its presence means the dataset is complete
+PARAMS_FILENAME = 'params.json'
+
+# ranks of the synthetic taxonomy, top down
+TAXONOMY_RANKS = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+# number of children per taxon, roughly, going down the tree
+TAXONOMY_BRANCHING = 3
+ROOT_TAXON_ID = 1
+
+DEFAULT_SEED = 1
+DEFAULT_INVALID_FRACTION = 0.1
+# fraction of the tide index peptides that are identified
+IDENTIFIED_FRACTION = 0.8
+# identified peptides that aren't in the index, as a fraction of the identified peptides
+NOT_IN_INDEX_FRACTION = 0.02
+# index peptides per protein
+PEPTIDES_PER_PROTEIN = 4
+MAX_PROTEINS_PER_PEPTIDE = 3
+MAX_HITS_PER_BAIT = 12
+# fraction of baits with no BLAST hits at all
+NO_HITS_FRACTION = 0.1
+# distinct BLAST-hit proteins per index protein
+HITS_PER_PROTEIN = 2
+# one in this many hit proteins has no taxon in the accession->taxon map
+MISSING_TAXON_EVERY = 10
+
+# amino acids used to spell peptides. No K or R, which only appear at the C-terminus
+PEPTIDE_ALPHABET = 'ACDEFGHILMNPQSTVWY'
+MIN_PEPTIDE_BODY_LENGTH = 6
+
+
+def encode_letters(number, alphabet, min_length=1):
+    """
+    Spell a nonnegative integer in the given alphabet, as a bijective base-len(alphabet) number
+    :param number:
+    :param alphabet:
+    :param min_length: pad with the first letter of the alphabet
+    :return:
+    """
+    chars = []
+    while True:
+        number, remainder = divmod(number, len(alphabet))
+        chars.append(alphabet[remainder])
+        if number == 0:
+            break
+    while len(chars) < min_length:
+        chars.append(alphabet[0])
+    return ''.join(reversed(chars))
+
+
+def make_peptide(peptide_idx):
+    """
+    The sequence of index peptide peptide_idx. Sequences are unique and tryptic-looking
+    :param peptide_idx:
+    :return:
+    """
+    return encode_letters(peptide_idx, PEPTIDE_ALPHABET, MIN_PEPTIDE_BODY_LENGTH) + 'K'
+
+
+def make_protein(protein_idx):
+    return 'SYNPROT_%d' % protein_idx
+
+
+def make_hit_accession(hit_idx):
+    return 'SYN%d' % hit_idx
+
+
+def make_hit_protein(hit_idx):
+    """
+    A UniProt-style hit protein ID, which trims to make_hit_accession(hit_idx)
+    :param hit_idx:
+    :return:
+    """
+    return 'tr|A%d|%s_SYNTH' % (hit_idx, make_hit_accession(hit_idx))
+
+
+def make_taxon_name(rank, taxon_id, parent_name, is_invalid):
+    """
+    Name a synthetic taxon. Valid names have no digits; invalid ones trip one of the Unipept validation rules
+    :param rank:
+    :param taxon_id:
+    :param parent_name:
+    :param is_invalid:
+    :return:
+    """
+    letters = encode_letters(taxon_id, 'abcdefghijklmnopqrstuvwxyz')
+    if rank == 'species':
+        if is_invalid:
+            return ['uncultured %s' % parent_name, '%s sp.' % parent_name,
+                    '%s strain %d' % (parent_name, taxon_id)][taxon_id % 3]
+        return '%s %s' % (parent_name, letters)
+    if is_invalid:
+        return 'unidentified %s' % rank
+    return '%s%s' % (rank[0].upper(), letters)
+
+
+class SyntheticTaxonomy:
+    """
+    A random tree over TAXONOMY_RANKS, with a given number of species
+    """
+    def __init__(self, n_species, rng, invalid_fraction=DEFAULT_INVALID_FRACTION):
+        # map from taxon ID to (parent ID, rank, name)
+        self.taxonid_info_map = {ROOT_TAXON_ID: (ROOT_TAXON_ID, 'no rank', 'root')}
+        level_sizes = [max(2, n_species // TAXONOMY_BRANCHING ** (len(TAXONOMY_RANKS) - 1 - i))
+                       for i in xrange(0, len(TAXONOMY_RANKS))]
+        next_taxon_id = ROOT_TAXON_ID + 1
+        parent_ids = [ROOT_TAXON_ID]
+        for rank, level_size in zip(TAXONOMY_RANKS, level_sizes):
+            level_ids = []
+            for i in xrange(0, level_size):
+                # don't use the IDs that Unipept always rejects
+                while next_taxon_id in unipept.INVALID_TAXON_IDS:
+                    next_taxon_id += 1
+                # make sure every parent gets at least one child
+                if i < len(parent_ids):
+                    parent_id = parent_ids[i]
+                else:
+                    parent_id = rng.choice(parent_ids)
+                # only species and genera can be invalid, so there's still a sane tree above them
+                is_invalid = rank in ('species', 'genus') and rng.random() < invalid_fraction
+                name = make_taxon_name(rank, next_taxon_id, self.taxonid_info_map[parent_id][2], is_invalid)
+                self.taxonid_info_map[next_taxon_id] = (parent_id, rank, name)
+                level_ids.append(next_taxon_id)
+                next_taxon_id += 1
+            parent_ids = level_ids
+        self.species_ids = parent_ids
+        self.genus_species_map = {}
+        for species_id in self.species_ids:
+            genus_id = self.taxonid_info_map[species_id][0]
+            if genus_id not in self.genus_species_map:
+                self.genus_species_map[genus_id] = []
+            self.genus_species_map[genus_id].append(species_id)
+
+    def write(self, outfile):
+        outfile.write('taxon_id\tparent_id\trank\tname\n')
+        for taxon_id in sorted(self.taxonid_info_map.keys()):
+            parent_id, rank, name = self.taxonid_info_map[taxon_id]
+            outfile.write('%d\t%d\t%s\t%s\n' % (taxon_id, parent_id, rank, name))
+
+
+def read_taxonomy(taxonomy_file):
+    """
+    Read a taxonomy written by SyntheticTaxonomy.write()
+    :param taxonomy_file:
+    :return: map from taxon ID to (parent ID, rank, name)
+    """
+    result = {}
+    taxonomy_file.readline()
+    for line in taxonomy_file:
+        taxon_id, parent_id, rank, name = line.rstrip('\n').split('\t')
+        result[int(taxon_id)] = (int(parent_id), rank, name)
+    return result
+
+
+def calc_lineage(taxonid_info_map, taxon_id):
+    """
+    The lineage of a taxon, from itself up to (but not including) the root
+    :param taxonid_info_map:
+    :param taxon_id:
+    :return: list of taxon IDs
+    """
+    result = []
+    while taxon_id != ROOT_TAXON_ID:
+        result.append(taxon_id)
+        taxon_id = taxonid_info_map[taxon_id][0]
+    return result
+
+
+def generate_dataset(outdir, n_peptides, seed=DEFAULT_SEED, invalid_fraction=DEFAULT_INVALID_FRACTION):
+    """
+    Write a synthetic dataset with about n_peptides identified peptides to outdir
+    :param outdir:
+    :param n_peptides:
+    :param seed:
+    :param invalid_fraction: fraction of species and genera with names Unipept considers invalid
+    :return:
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    rng = random.Random(seed)
+    n_index_peptides = max(10, int(n_peptides / IDENTIFIED_FRACTION))
+    n_proteins = max(10, n_index_peptides // PEPTIDES_PER_PROTEIN)
+    n_hits = n_proteins * HITS_PER_PROTEIN
+    n_species = max(TAXONOMY_BRANCHING ** 4, n_peptides // 100)
+    logger.info("Generating %d index peptides, %d proteins, %d hit proteins and %d species in %s" %
+                (n_index_peptides, n_proteins, n_hits, n_species, outdir))
+
+    taxonomy = SyntheticTaxonomy(n_species, rng, invalid_fraction=invalid_fraction)
+    with open(os.path.join(outdir, TAXONOMY_FILENAME), 'w') as outfile:
+        taxonomy.write(outfile)
+
+    # hit protein hit_idx belongs to species hit_idx % n_species, so a bait's hits can be drawn
+    # from one neighborhood of the tree and its peptides get LCAs below the root
+    species_ids = taxonomy.species_ids
+    species_idx_map = dict([(species_ids[i], i) for i in xrange(0, len(species_ids))])
+    with open(os.path.join(outdir, PROTTAXON_FILENAME), 'w') as outfile:
+        outfile.write('accession\ttaxon_id\n')
+        for hit_idx in xrange(0, n_hits):
+            if hit_idx % MISSING_TAXON_EVERY != MISSING_TAXON_EVERY - 1:
+                outfile.write('%s\t%d\n' % (make_hit_accession(hit_idx), species_ids[hit_idx % len(species_ids)]))
+
+    with open(os.path.join(outdir, PEPPROT_FILENAME), 'w') as pepprot_file:
+        with open(os.path.join(outdir, PEPSEQS_FILENAME), 'w') as pepseqs_file:
+            pepprot_file.write('sequence\tprotein id\n')
+            for peptide_idx in xrange(0, n_index_peptides):
+                peptide = make_peptide(peptide_idx)
+                n_proteins_this_peptide = rng.choice([1, 1, 1, 2, MAX_PROTEINS_PER_PEPTIDE])
+                protein_idxs = set([peptide_idx // PEPTIDES_PER_PROTEIN % n_proteins])
+                while len(protein_idxs) < n_proteins_this_peptide:
+                    protein_idxs.add(rng.randrange(n_proteins))
+                pepprot_file.write('%s\t%s\n' % (peptide, ';'.join([make_protein(idx)
+                                                                     for idx in sorted(protein_idxs)])))
+                if rng.random() < IDENTIFIED_FRACTION:
+                    pepseqs_file.write(peptide + '\n')
+            for peptide_idx in xrange(n_index_peptides,
+                                      n_index_peptides + int(n_peptides * NOT_IN_INDEX_FRACTION)):
+                pepseqs_file.write(make_peptide(peptide_idx) + '\n')
+
+    n_hits_per_species = max(1, n_hits // len(species_ids))
+    with open(os.path.join(outdir, BLAST_FILENAME), 'w') as outfile:
+        for protein_idx in xrange(0, n_proteins):
+            if rng.random() < NO_HITS_FRACTION:
+                continue
+            home_species_id = rng.choice(species_ids)
+            sibling_species_ids = taxonomy.genus_species_map[taxonomy.taxonid_info_map[home_species_id][0]]
+            best_log10_e = -rng.uniform(5, 150)
+            for hit_number in xrange(0, rng.randint(1, MAX_HITS_PER_BAIT)):
+                draw = rng.random()
+                if draw < 0.5:
+                    species_id = home_species_id
+                elif draw < 0.8:
+                    species_id = rng.choice(sibling_species_ids)
+                else:
+                    species_id = rng.choice(species_ids)
+                species_idx = species_idx_map[species_id]
+                hit_idx = species_idx + len(species_ids) * rng.randrange(n_hits_per_species)
+                if hit_idx >= n_hits:
+                    hit_idx = species_idx
+                if hit_number == 0 and draw < 0.1:
+                    evalue = 0.0
+                else:
+                    evalue = 10 ** (best_log10_e + (0 if hit_number == 0 else rng.uniform(0, 40)))
+                length = rng.randint(50, 500)
+                outfile.write('%s\t%s\t%.2f\t%d\t%d\t%d\t1\t%d\t1\t%d\t%.2e\t%.1f\n' %
+                              (make_protein(protein_idx), make_hit_protein(hit_idx), rng.uniform(30, 100),
+                               length, rng.randint(0, length // 4), rng.randint(0, 5), length, length,
+                               evalue, rng.uniform(40, 1000)))
+
+    with open(os.path.join(outdir, PARAMS_FILENAME), 'w') as outfile:
+        json.dump({'n_peptides': n_peptides, 'seed': seed, 'invalid_fraction': invalid_fraction,
+                   'n_index_peptides': n_index_peptides, 'n_proteins': n_proteins, 'n_hits': n_hits,
+                   'n_taxa': len(taxonomy.taxonid_info_map)}, outfile, indent=2, sort_keys=True)
+
+
+def is_dataset_complete(datadir):
+    return os.path.exists(os.path.join(datadir, PARAMS_FILENAME))
+
+
+class FakeResponse:
+    """
+    Just enough of a requests Response for pymeta.unipept
+    """
+    def __init__(self, text):
+        self.text = text
+        self.status_code = 200
+
+
+class UnipeptStub:
+    """
+    Stands in for the requests module in pymeta.unipept, answering taxonomy API calls from a
+    synthetic taxonomy, with the same JSON Unipept would return
+    """
+    def __init__(self, taxonid_info_map, latency_secs=0.0):
+        """
+        :param taxonid_info_map: map from taxon ID to (parent ID, rank, name)
+        :param latency_secs: simulated network latency per call
+        """
+        self.taxonid_info_map = taxonid_info_map
+        self.latency_secs = latency_secs
+        self.n_calls = 0
+
+    def post(self, url, params=None):
+        self.n_calls += 1
+        if self.latency_secs:
+            time.sleep(self.latency_secs)
+        if not url.endswith('/taxonomy.json'):
+            raise ValueError('UnipeptStub only supports the taxonomy API, not %s' % url)
+        taxon_ids = [int(taxon_id) for taxon_id in re.findall(r'input\[\]=(\d+)', params)]
+        return FakeResponse(json.dumps([self.build_row(taxon_id) for taxon_id in taxon_ids
+                                        if taxon_id in self.taxonid_info_map]))
+
+    def build_row(self, taxon_id):
+        """
+        The Unipept taxonomy API result for one taxon, with extra=true and names=true
+        :param taxon_id:
+        :return:
+        """
+        parent_id, rank, name = self.taxonid_info_map[taxon_id]
+        row = {'taxon_id': taxon_id, 'taxon_name': name, 'taxon_rank': rank}
+        for rank in RANKS:
+            row[rank + '_id'] = None
+            row[rank + '_name'] = None
+        for lineage_taxon_id in calc_lineage(self.taxonid_info_map, taxon_id):
+            _, lineage_rank, lineage_name = self.taxonid_info_map[lineage_taxon_id]
+            row[lineage_rank + '_id'] = lineage_taxon_id
+            row[lineage_rank + '_name'] = lineage_name
+        return row
+
+
+def install_unipept_stub(taxonid_info_map, latency_secs=0.0):
+    """
+    Route pymeta.unipept's API calls to a UnipeptStub
+    :param taxonid_info_map:
+    :param latency_secs:
+    :return: the stub
+    """
+    stub = UnipeptStub(taxonid_info_map, latency_secs=latency_secs)
+    unipept.requests = stub
+    return stub
+
+
+def declare_gather_args():
+    """
+    Declare all arguments, parse them, and return the args dict.
+    Does no validation beyond the implicit validation done by argparse.
+    return: a dict mapping arg names to values
+    """
+
+    # declare args
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--outdir', required=True,
+                        help='directory to write the dataset to')
+    parser.add_argument('--npeptides', type=int, required=True,
+                        help='number of identified peptides')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED,
+                        help='random seed')
+    parser.add_argument('--invalidfraction', type=float, default=DEFAULT_INVALID_FRACTION,
+                        help='fraction of species and genera with names that Unipept considers invalid')
+    parser.add_argument('--debug', action="store_true", help='Enable debug logging')
+    return parser.parse_args()
+
+
+def main():
+    args = declare_gather_args()
+    # logging
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s: %(message)s")
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    generate_dataset(args.outdir, args.npeptides, seed=args.seed, invalid_fraction=args.invalidfraction)
+    print("Wrote dataset to %s" % args.outdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Convert a tide index peptide->protein export into a memory-mapped index directory, for
+infer_taxa_withblast.py --pepprotindex
+"""
+
+import argparse
+import logging
+from datetime import datetime
+from pymeta import pepprotindex
+from pyvalise.util import files
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+
+def declare_gather_args():
+    """
+    Declare all arguments, parse them, and return the args dict.
+    Does no validation beyond the implicit validation done by argparse.
+    return: a dict mapping arg names to values
+    """
+
+    # declare args
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('pepprotmap', type=files.CompressedFileType('r'),
+                        help='map from peptides to proteins (tide index export, may be gzipped)')
+    parser.add_argument('--out', required=True,
+                        help='output index directory')
+    parser.add_argument('--debug', action="store_true", help='Enable debug logging')
+    return parser.parse_args()
+
+
+def main():
+    args = declare_gather_args()
+    # logging
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s: %(message)s")
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        # any module-specific debugging goes below
+        pepprotindex.logger.setLevel(logging.DEBUG)
+
+    script_start_time = datetime.now()
+    logger.debug("Start time: %s" % script_start_time)
+
+    n_peptides = pepprotindex.build_index(args.pepprotmap, args.out)
+    print("Indexed %d peptides in %s" % (n_peptides, args.out))
+    logger.debug("End time: %s. Elapsed time: %s" % (datetime.now(), datetime.now() - script_start_time))
+
+
+if __name__ == '__main__':
+    main()
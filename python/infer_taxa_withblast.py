@@ -4,16 +4,20 @@ A shell of a Python script
 """
 
 import argparse
+import hashlib
 import logging
+import os
 from datetime import datetime
 
 import pymeta.ncbi
 from pymeta import unipept
 import csv
 from pyvalise.ext import uniprot
-from pyvalise.util import charts
+from pyvalise.util import files
+from pyvalise.util import lazycharts
+from pyvalise.util import metrics
 from pymeta import blast
-import math
+from pymeta import stagecache
 
 __author__ = "Damon May"
 __copyright__ = "Copyright (c) 2015 Damon May"
@@ -24,6 +28,15 @@ logger = logging.getLogger(__name__)
 
 DEFAULT_MAX_BLAST_DELTA_LOG10_E = 1000
 
+OUTPUT_FORMATS = ['tsv', 'parquet', 'arrow']
+# names for per-sample output files written to --outdir, by output format
+PER_SAMPLE_OUTPUT_SUFFIXES = {'tsv': '.peptlcas.tsv',
+                              'parquet': '.peptlcas.parquet',
+                              'arrow': '.peptlcas.arrow'}
+
+# write buffer for LCA output files
+OUTPUT_BUFFER_BYTES = 1 << 20
+
 
 def declare_gather_args():
     """
@@ -34,10 +47,21 @@ def declare_gather_args():
 
     # declare args
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('--pepseqsfile', required=True, type=argparse.FileType('r'),
-                        help='input file with all peptide sequences identified')
-    parser.add_argument('--pepprotmap', required=True, type=argparse.FileType('r'),
-                        help='map from peptides to proteins')
+    pepseqs_group = parser.add_mutually_exclusive_group(required=True)
+    pepseqs_group.add_argument('--pepseqsfile', type=argparse.FileType('r'), nargs='+',
+                               help='input file with all peptide sequences identified. If more than one is given, '
+                                    'the samples are processed together and one output file per sample is written '
+                                    'to --outdir')
+    pepseqs_group.add_argument('--manifest', type=argparse.FileType('r'),
+                               help='tab-delimited file with columns pepseqsfile and outpeptlcas, one row per '
+                                    'sample. Paths are relative to the manifest. All samples are processed together')
+    pepprot_group = parser.add_mutually_exclusive_group(required=True)
+    pepprot_group.add_argument('--pepprotmap', type=files.CompressedFileType('r'),
+                               help='map from peptides to proteins (may be gzipped or bzipped)')
+    pepprot_group.add_argument('--pepprotindex',
+                               help='map from peptides to proteins, as an index directory built from the '
+                                    '--pepprotmap file by build_pepprot_index.py. Only the identified peptides '
+                                    'are read')
     parser.add_argument('--fastablast', required=True, type=argparse.FileType('r'),
                         help='BLAST results from metagenome_fasta')
     parser.add_argument('--prottaxonmap', required=True, type=argparse.FileType('r'),
@@ -46,15 +70,416 @@ def declare_gather_args():
                         help='Maximum BLAST e-value to keep')
     parser.add_argument('--maxblastdeltalog10e', type=float, default=DEFAULT_MAX_BLAST_DELTA_LOG10_E,
                         help='Maximum difference between BLAST e-value of a hit and the best hit for that bait to keep')
-    parser.add_argument('--outpeptlcas', type=argparse.FileType('w'),
+    parser.add_argument('--outpeptlcas',
                         help='output file with lca taxa inferred using BLAST on proteins from identified peptides')
+    parser.add_argument('--outdir',
+                        help='output directory for per-sample lca files. Required with multiple --pepseqsfile')
     parser.add_argument('--includeprotids', action="store_true",
                         help='Include IDs of proteins for each peptide, separated by ;?')
-    parser.add_argument('--outpdf', type=argparse.FileType('w'),
+    parser.add_argument('--outformat', choices=OUTPUT_FORMATS, default='tsv',
+                        help='format of the LCA output files. parquet and arrow are columnar, with integer lineage '
+                             'columns, dictionary-encoded names and list-typed protein columns. Requires pyarrow')
+    parser.add_argument('--outpdf', type=argparse.FileType('wb'),
                         help='output charts pdf')
+    parser.add_argument('--sparse', action="store_true",
+                        help='Associate peptides with BLAST hits and taxa using integer-encoded sparse matrices. '
+                             'Same results, less memory and faster for large datasets')
+    parser.add_argument('--externalsort', action="store_true",
+                        help='Sort the BLAST hits by bait protein on disk and stream them, for BLAST files too big '
+                             'to load into memory. Ignores --sparse, and the BLAST hits are not cached')
+    parser.add_argument('--sortmemorymb', type=int, default=1024,
+                        help='With --externalsort, memory (MB) for buffering BLAST hits before writing a sorted run')
+    parser.add_argument('--tmpdir',
+                        help='With --externalsort, directory for sorted runs. Default: the system temp directory')
+    parser.add_argument('--sweepmaxblaste', type=float, nargs='+',
+                        help='Sweep these values of --maxblaste in one pass, writing LCAs for each threshold')
+    parser.add_argument('--sweepmaxblastdeltalog10e', type=float, nargs='+',
+                        help='Sweep these values of --maxblastdeltalog10e in one pass, writing LCAs for each '
+                             'threshold. With --sweepmaxblaste, every combination is swept. Output file names '
+                             'get the thresholds added, e.g. out.maxe1000.delta5.tsv')
+    parser.add_argument('--sweepsummary', type=argparse.FileType('w'),
+                        help='output tab-delimited summary of a sweep: peptide counts and the number of '
+                             'peptides with an LCA at each rank, one row per threshold')
+    parser.add_argument('--prefetchlineages', action="store_true",
+                        help='Start fetching taxon lineages from Unipept in the background while the '
+                             'protein-taxon map is still loading. Fetches lineages for every BLAST-hit taxon, '
+                             'including some that are later filtered out')
+    parser.add_argument('--shard', type=parse_shard,
+                        help='i/N: only process the peptides in shard i (0 <= i < N) of N, partitioned by a '
+                             'hash of the peptide sequence. Only those peptides\' proteins and BLAST hits are '
+                             'loaded. Rows are written sorted by peptide. Combine the shards\' outputs with '
+                             'merge_lca_shards.py')
+    parser.add_argument('--cachedir',
+                        help='Directory for caching the output of each stage, keyed by a hash of its inputs and '
+                             'parameters. Unchanged stages are reused, and only new peptides go through LCA inference')
+    parser.add_argument('--metrics-out', type=argparse.FileType('w'),
+                        help='output JSON file with wall time, CPU time, peak memory and item counts for each '
+                             'stage, and Unipept HTTP call latencies')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes for LCA inference and for drawing --outpdf pages. Lineages '
+                             'are shared with the workers, not copied')
 
     parser.add_argument('--debug', action="store_true", help='Enable debug logging')
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.pepseqsfile and len(args.pepseqsfile) > 1 and args.outpeptlcas:
+        parser.error('--outpeptlcas writes one sample. With multiple --pepseqsfile, use --outdir')
+    if args.pepseqsfile and len(args.pepseqsfile) > 1 and not args.outdir:
+        parser.error('With multiple --pepseqsfile, use --outdir')
+    if args.manifest and (args.outdir or args.outpeptlcas):
+        parser.error('--manifest gives each sample\'s output file. Don\'t use --outdir or --outpeptlcas with it')
+    if (args.sweepmaxblaste or args.sweepmaxblastdeltalog10e) and args.externalsort:
+        parser.error('--externalsort does not support threshold sweeps')
+    return args
+
+
+def parse_shard(shard_str):
+    """
+    Parse an i/N shard argument
+    :param shard_str:
+    :return: (shard index, number of shards)
+    """
+    try:
+        shard_idx, n_shards = [int(x) for x in shard_str.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be i/N, e.g. 0/8, not %s' % shard_str)
+    if n_shards < 1 or not 0 <= shard_idx < n_shards:
+        raise argparse.ArgumentTypeError('shard index must be from 0 to N-1, not %s' % shard_str)
+    return shard_idx, n_shards
+
+
+def calc_peptide_shard(peptide, n_shards):
+    """
+    The shard a peptide belongs to. Depends only on the sequence, so every node agrees
+    :param peptide:
+    :param n_shards:
+    :return:
+    """
+    return int(hashlib.md5(peptide).hexdigest()[:15], 16) % n_shards
+
+
+def load_samples(args):
+    """
+    Build the list of samples to process from --pepseqsfile or --manifest
+    :param args:
+    :return: a list of Sample objects
+    """
+    samples = []
+    if args.manifest:
+        manifest_dir = os.path.dirname(os.path.abspath(args.manifest.name))
+        for row in csv.DictReader(args.manifest, delimiter='\t'):
+            assert('pepseqsfile' in row and 'outpeptlcas' in row)
+            with open(os.path.join(manifest_dir, row['pepseqsfile'])) as pepseqs_file:
+                pepseqs = load_pepseqs(pepseqs_file)
+            samples.append(Sample(row['pepseqsfile'], pepseqs, os.path.join(manifest_dir, row['outpeptlcas'])))
+        return samples
+    if len(args.pepseqsfile) == 1 and (args.outpeptlcas or not args.outdir):
+        return [Sample(args.pepseqsfile[0].name, load_pepseqs(args.pepseqsfile[0]), args.outpeptlcas)]
+    for pepseqs_file in args.pepseqsfile:
+        name = os.path.splitext(os.path.basename(pepseqs_file.name))[0]
+        out_path = os.path.join(args.outdir, name + PER_SAMPLE_OUTPUT_SUFFIXES[args.outformat])
+        samples.append(Sample(pepseqs_file.name, load_pepseqs(pepseqs_file), out_path))
+    return samples
+
+
+def load_pepseqs(pepseqs_file):
+    """
+    Load the set of identified peptide sequences, one per line
+    :param pepseqs_file:
+    :return:
+    """
+    return set([line.strip() for line in pepseqs_file])
+
+
+def load_pep_prots_maps(pepprot_file, pepseqs):
+    """
+    Load the map from peptides to proteins (and proteins to peptides) from a tide index export,
+    keeping only the peptides we've identified
+    :param pepprot_file:
+    :param pepseqs:
+    :return: map from peptide to list of proteins, map from protein to list of peptides
+    """
+    peps_prots_map = {}
+    prots_peps_map = {}
+    for row in csv.DictReader(pepprot_file, delimiter='\t'):
+        pepseq = row['sequence']
+        if pepseq in pepseqs:
+            proteins = [protstr.strip() for protstr in row['protein id'].split(';')]
+            peps_prots_map[pepseq] = proteins
+            for protein in proteins:
+                if protein not in prots_peps_map:
+                    prots_peps_map[protein] = []
+                prots_peps_map[protein].append(pepseq)
+    return peps_prots_map, prots_peps_map
+
+
+def load_blastprotein_taxonid_map(prottaxon_file, blastproteins, taxonomy_prefetcher=None):
+    """
+    Load taxon IDs for the BLAST-hit proteins we care about
+    :param prottaxon_file:
+    :param blastproteins:
+    :param taxonomy_prefetcher: if not None, a unipept.TaxonomyPrefetcher to request each taxon from as it's read
+    :return:
+    """
+    result = {}
+    for row in csv.DictReader(prottaxon_file, delimiter='\t'):
+        assert('accession' in row and 'taxon_id' in row)
+        protein = row['accession']
+        if protein in blastproteins:
+            result[protein] = int(row['taxon_id'])
+            if taxonomy_prefetcher:
+                taxonomy_prefetcher.add(result[protein])
+    return result
+
+
+def associate_peptides_blasthits_taxa(pepseqs, peps_prots_map, bait_matches_evalues_map, blastprotein_taxonid_map,
+                                      max_blast_delta_log10_e):
+    """
+    Find the BLAST-hit proteins and taxa for each peptide. The delta-filtered hits and their taxa are
+    computed once per bait protein, and each peptide's sets are unions over its proteins' sets.
+    Many peptides map to exactly the same set of proteins with BLAST hits, so the unions are computed
+    once per distinct protein set, and peptides with the same protein set share the same (frozen) sets.
+    :param pepseqs:
+    :param peps_prots_map:
+    :param bait_matches_evalues_map:
+    :param blastprotein_taxonid_map:
+    :param max_blast_delta_log10_e:
+    :return: a map from peptide to set of blast-hit proteins, for peptides with any of their proteins in the BLAST
+    results, and a map from peptide to set of taxon IDs, for peptides with at least one taxon
+    """
+    bait_blasthits_map = blast.calc_bait_delta_filtered_hits(bait_matches_evalues_map, max_blast_delta_log10_e)
+    return associate_peptides_bait_blasthits_taxa(pepseqs, peps_prots_map, bait_blasthits_map,
+                                                  blastprotein_taxonid_map)
+
+
+def associate_peptides_bait_blasthits_taxa(pepseqs, peps_prots_map, bait_blasthits_map, blastprotein_taxonid_map):
+    """
+    The second half of associate_peptides_blasthits_taxa(), from already delta-filtered hits
+    :param pepseqs:
+    :param peps_prots_map:
+    :param bait_blasthits_map: map from bait protein to frozenset of delta-filtered blast-hit proteins
+    :param blastprotein_taxonid_map:
+    :return: same as associate_peptides_blasthits_taxa()
+    """
+    bait_taxonids_map = {}
+    for bait, blasthits in bait_blasthits_map.iteritems():
+        bait_taxonids_map[bait] = frozenset([blastprotein_taxonid_map[blasthit] for blasthit in blasthits
+                                             if blasthit in blastprotein_taxonid_map])
+
+    # map from a distinct set of baits to its (blast-hit proteins, taxon IDs)
+    baitset_hitstaxa_map = {}
+    peptide_protblasthits_map = {}
+    peptide_taxonids_map = {}
+    for peptide in pepseqs:
+        if peptide not in peps_prots_map:
+            continue
+        baits_this_peptide = frozenset([protein for protein in peps_prots_map[peptide]
+                                        if protein in bait_blasthits_map])
+        if not baits_this_peptide:
+            continue
+        if baits_this_peptide not in baitset_hitstaxa_map:
+            protblasthits = set()
+            taxon_ids = set()
+            for bait in baits_this_peptide:
+                protblasthits.update(bait_blasthits_map[bait])
+                taxon_ids.update(bait_taxonids_map[bait])
+            baitset_hitstaxa_map[baits_this_peptide] = (frozenset(protblasthits), frozenset(taxon_ids))
+        protblasthits, taxon_ids = baitset_hitstaxa_map[baits_this_peptide]
+        peptide_protblasthits_map[peptide] = protblasthits
+        if taxon_ids:
+            peptide_taxonids_map[peptide] = taxon_ids
+    logger.debug("associate: %d peptides with hits in %d protein-set classes" %
+                 (len(peptide_protblasthits_map), len(baitset_hitstaxa_map)))
+    return peptide_protblasthits_map, peptide_taxonids_map
+
+
+def associate_peptides_sorted_bait_hits_taxa(pepseqs, peps_prots_map, sorted_bait_hits, blastprotein_taxonid_map,
+                                             max_blast_delta_log10_e):
+    """
+    Out-of-core version of associate_peptides_blasthits_taxa(), for BLAST hits streamed in ascending bait
+    order by blast.iter_sorted_bait_hits(). Peptides are grouped into classes by their set of proteins, and
+    a bait-sorted list of (protein, class) pairs is merge-joined against the hits. Each bait's
+    delta-filtered hits and taxa are added to its classes' sets as the bait streams past, and then dropped,
+    so the hits held are those of one batch of baits, plus the classes' sets that make up the output
+    :param pepseqs:
+    :param peps_prots_map:
+    :param sorted_bait_hits: iterator over (bait protein, BaitHits), in ascending bait order
+    :param blastprotein_taxonid_map:
+    :param max_blast_delta_log10_e:
+    :return: same as associate_peptides_blasthits_taxa(), and a list of the number of hits read for each bait
+    """
+    # each distinct set of proteins is a class, with the peptides that have it and their hits and taxa
+    protset_classidx_map = {}
+    class_peptides = []
+    for peptide in pepseqs:
+        if peptide not in peps_prots_map:
+            continue
+        protset = frozenset(peps_prots_map[peptide])
+        if protset not in protset_classidx_map:
+            protset_classidx_map[protset] = len(class_peptides)
+            class_peptides.append([])
+        class_peptides[protset_classidx_map[protset]].append(peptide)
+    protein_classidxs = sorted([(protein, class_idx) for protset, class_idx in protset_classidx_map.iteritems()
+                                for protein in protset])
+    protset_classidx_map = None
+    class_protblasthits = [set() for peptides in class_peptides]
+    class_taxon_ids = [set() for peptides in class_peptides]
+
+    bait_hit_counts = []
+    join_idx = 0
+    for bait, blasthits, n_read in blast.iter_sorted_bait_delta_filtered_hits(sorted_bait_hits,
+                                                                             max_blast_delta_log10_e):
+        bait_hit_counts.append(n_read)
+        while join_idx < len(protein_classidxs) and protein_classidxs[join_idx][0] < bait:
+            join_idx += 1
+        if join_idx == len(protein_classidxs) or protein_classidxs[join_idx][0] != bait or not blasthits:
+            continue
+        taxon_ids = [blastprotein_taxonid_map[blasthit] for blasthit in blasthits
+                     if blasthit in blastprotein_taxonid_map]
+        while join_idx < len(protein_classidxs) and protein_classidxs[join_idx][0] == bait:
+            class_idx = protein_classidxs[join_idx][1]
+            class_protblasthits[class_idx].update(blasthits)
+            class_taxon_ids[class_idx].update(taxon_ids)
+            join_idx += 1
+
+    peptide_protblasthits_map = {}
+    peptide_taxonids_map = {}
+    for class_idx in xrange(0, len(class_peptides)):
+        if not class_protblasthits[class_idx]:
+            continue
+        protblasthits = frozenset(class_protblasthits[class_idx])
+        taxon_ids = frozenset(class_taxon_ids[class_idx])
+        for peptide in class_peptides[class_idx]:
+            peptide_protblasthits_map[peptide] = protblasthits
+            if taxon_ids:
+                peptide_taxonids_map[peptide] = taxon_ids
+        # free each class's sets as soon as they're frozen
+        class_protblasthits[class_idx] = None
+        class_taxon_ids[class_idx] = None
+    logger.debug("associate: %d peptides with hits in %d protein-set classes, from %d baits" %
+                 (len(peptide_protblasthits_map), len(class_peptides), len(bait_hit_counts)))
+    return peptide_protblasthits_map, peptide_taxonids_map, bait_hit_counts
+
+
+def infer_peptide_lcas(peptide_taxonids_map, taxonid_taxon_map, taxonids_lca_map=None):
+    """
+    Validate each peptide's taxa and infer its LCA. Peptides with the same set of taxa share an LCA,
+    so each distinct taxon set is only validated and resolved once
+    :param peptide_taxonids_map:
+    :param taxonid_taxon_map:
+    :param taxonids_lca_map: if not None, a map from frozenset of taxon IDs to LCA (or None) to reuse and add to,
+                             for callers that infer LCAs over and over with the same taxa
+    :return: a map from peptide to LCA Taxon, for peptides with at least one valid taxon
+    """
+    if taxonids_lca_map is None:
+        taxonids_lca_map = {}
+    peptide_lca_map = dict(iter_peptide_lcas(peptide_taxonids_map, taxonid_taxon_map,
+                                             taxonids_lca_map=taxonids_lca_map))
+    logger.debug("infer_peptide_lcas: %d peptides in %d taxon-set classes" %
+                 (len(peptide_taxonids_map), len(taxonids_lca_map)))
+    return peptide_lca_map
+
+
+def iter_peptide_lcas(peptide_taxonids_map, taxonid_taxon_map, taxonids_lca_map=None, peptides=None):
+    """
+    Streaming version of infer_peptide_lcas(). Each peptide's LCA is passed on as soon as its taxon set's
+    LCA is resolved, so only the distinct taxon sets' LCAs are held, not a map over all the peptides
+    :param peptide_taxonids_map:
+    :param taxonid_taxon_map:
+    :param taxonids_lca_map: as in infer_peptide_lcas()
+    :param peptides: the peptides of peptide_taxonids_map, in the order to infer them. Default: the map's order
+    :return: an iterator over (peptide, LCA Taxon), for peptides with at least one valid taxon
+    """
+    if taxonids_lca_map is None:
+        taxonids_lca_map = {}
+    if peptides is None:
+        peptides = peptide_taxonids_map
+    for peptide in peptides:
+        taxon_ids_this_peptide = frozenset(peptide_taxonids_map[peptide])
+        if taxon_ids_this_peptide not in taxonids_lca_map:
+            taxonids_lca_map[taxon_ids_this_peptide] = infer_taxa_lca(taxon_ids_this_peptide, taxonid_taxon_map)
+        if taxonids_lca_map[taxon_ids_this_peptide]:
+            yield peptide, taxonids_lca_map[taxon_ids_this_peptide]
+
+
+def count_lca_ranks(peptide_lcas, rank_count_map):
+    """
+    Pass (peptide, LCA) pairs through, counting the LCAs' ranks
+    :param peptide_lcas:
+    :param rank_count_map: map from rank to count, to add to
+    :return:
+    """
+    for peptide, lca in peptide_lcas:
+        if lca.rank not in rank_count_map:
+            rank_count_map[lca.rank] = 0
+        rank_count_map[lca.rank] += 1
+        yield peptide, lca
+
+
+def infer_taxa_lca(taxon_ids, taxonid_taxon_map):
+    """
+    Validate a set of taxa and infer their LCA
+    :param taxon_ids:
+    :param taxonid_taxon_map:
+    :return: the LCA Taxon, or None if none of the taxa are valid
+    """
+    taxa = []
+    for taxon_id in taxon_ids:
+        if taxon_id in taxonid_taxon_map:
+            taxa.append(taxonid_taxon_map[taxon_id])
+    validated_taxa = []
+    for taxon in taxa:
+        fixed_taxon = unipept.validate_rebuild_taxon(taxon)
+        if fixed_taxon:
+            validated_taxa.append(fixed_taxon)
+            if fixed_taxon.name != taxon.name:
+                logger.debug("VALIDATION CHANGED TAXON: %s,%s -> %s,%s" % (taxon.rank, taxon.name, fixed_taxon.rank, fixed_taxon.name))
+        else:
+            logger.debug("INVALID TAXON: %s,%s" % (taxon.rank, taxon.name))
+    if not validated_taxa:
+        return None
+    return unipept.infer_lca(validated_taxa)
+
+
+def make_lca_render_key(taxon):
+    """
+    Key for memoizing the rendered lineage of an LCA. The taxon ID alone isn't enough: two LCAs with
+    the same ID can have different rank maps, if some of the taxa behind one of them lack a rank
+    :param taxon:
+    :return:
+    """
+    return taxon.id, tuple(sorted([(rank, rank_taxon.id) for rank, rank_taxon in taxon.rank_taxon_map.iteritems()]))
+
+
+def write_peptide_lcas(outfile, peptide_lcas, peps_prots_map, peptide_protblasthits_map, include_protids):
+    """
+    Write peptide LCAs, one row at a time as they come in.
+    The lineage columns are rendered once per distinct LCA, since many peptides share an LCA
+    :param outfile:
+    :param peptide_lcas: (peptide, LCA Taxon) pairs to write, in order. Can be a generator
+    :param peps_prots_map:
+    :param peptide_protblasthits_map:
+    :param include_protids: include the peptide's proteins and BLAST-hit proteins
+    :return: the number of peptides written
+    """
+    headerline = 'peptide\t'
+    if include_protids:
+        headerline += 'proteins\tblastproteins\t'
+    headerline = headerline + unipept.make_unipept_headerline(False)
+    outfile.write(headerline + '\n')
+    key_lineagestr_map = {}
+    n_written = 0
+    for peptide, lca in peptide_lcas:
+        render_key = make_lca_render_key(lca)
+        if render_key not in key_lineagestr_map:
+            key_lineagestr_map[render_key] = str(lca)
+        outline = peptide + '\t'
+        if include_protids:
+            outline += ';'.join(peps_prots_map[peptide]) + '\t'
+            outline += ';'.join(peptide_protblasthits_map[peptide]) + '\t'
+        outfile.write(outline + key_lineagestr_map[render_key] + '\n')
+        n_written += 1
+    logger.debug("Wrote %d peptides with %d distinct LCAs" % (n_written, len(key_lineagestr_map)))
+    return n_written
 
 
 def main():
@@ -71,29 +496,64 @@ def main():
     script_start_time = datetime.now()
     logger.debug("Start time: %s" % script_start_time)
 
-    all_pepseqs = set([line.strip() for line in args.pepseqsfile])
-    print("Loaded %d total sequences" % len(all_pepseqs))
+    run_metrics = metrics.PipelineMetrics()
+    run_metrics.start_stage('load_peptides')
+    if args.outdir and not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    samples = load_samples(args)
+    if args.shard:
+        shard_idx, n_shards = args.shard
+        for sample in samples:
+            sample.pepseqs = set([peptide for peptide in sample.pepseqs
+                                  if calc_peptide_shard(peptide, n_shards) == shard_idx])
+    all_pepseqs = set()
+    for sample in samples:
+        all_pepseqs.update(sample.pepseqs)
+    if len(samples) > 1:
+        print("Loaded %d total sequences from %d samples" % (len(all_pepseqs), len(samples)))
+    else:
+        print("Loaded %d total sequences" % len(all_pepseqs))
+    if args.shard:
+        print("Keeping the peptides in shard %d of %d" % args.shard)
+    run_metrics.end_stage(samples=len(samples), peptides=len(all_pepseqs))
+
+    cache = None
+    input_digests = {}
+    if args.cachedir:
+        cache = stagecache.StageCache(args.cachedir)
+        for argname in ['pepprotmap', 'fastablast', 'prottaxonmap']:
+            if getattr(args, argname):
+                input_digests[argname] = cache.file_digest(getattr(args, argname))
+        input_digests['pepseqs'] = stagecache.digest_strings(all_pepseqs)
+
+    # (max e-value, max delta log10 e-value) for each point of a threshold sweep
+    sweep_thresholds = None
+    if args.sweepmaxblaste or args.sweepmaxblastdeltalog10e:
+        sweep_thresholds = [(max_e, max_delta_log10_e) for max_e in (args.sweepmaxblaste or [args.maxblaste])
+                            for max_delta_log10_e in (args.sweepmaxblastdeltalog10e or [args.maxblastdeltalog10e])]
 
     mycharts = []
 
     print("Loading tide index...")
-    idd_peps_prots_map = {}
-    idd_prots_peps_map = {}
-    for row in csv.DictReader(args.pepprotmap, delimiter='\t'):
-        pepseq = row['sequence']
-        if pepseq in all_pepseqs:
-            proteins = [protstr.strip() for protstr in row['protein id'].split(';')]
-            idd_peps_prots_map[pepseq] = proteins
-            for protein in proteins:
-                if protein not in idd_prots_peps_map:
-                    idd_prots_peps_map[protein] = []
-                idd_prots_peps_map[protein].append(pepseq)
+    run_metrics.start_stage('load_pep_prots')
+    if args.pepprotindex:
+        from pymeta import pepprotindex
+        index = pepprotindex.PepProtIndex(args.pepprotindex)
+        # the index knows the digest of the file it was built from, so it shares cache entries with that file
+        input_digests['pepprotmap'] = index.source_digest
+        load_pep_prots_function = lambda: index.lookup(all_pepseqs)
+    else:
+        load_pep_prots_function = lambda: load_pep_prots_maps(args.pepprotmap, all_pepseqs)
+    idd_peps_prots_map, idd_prots_peps_map = stagecache.cached(
+        cache, 'pep_prots', [input_digests.get('pepprotmap'), input_digests.get('pepseqs')],
+        load_pep_prots_function)
     print("Loaded. %d of %d peptides present in index. %d id'd proteins in index." % (len(idd_peps_prots_map),
                                                                          len(all_pepseqs),
                                                                          len(idd_prots_peps_map)))
+    run_metrics.end_stage(peptides=len(idd_peps_prots_map), proteins=len(idd_prots_peps_map))
     if args.outpdf:
-        mycharts.append(charts.hist([len(prots) for prots in idd_peps_prots_map.values()],
-                                    title='proteins per peptide'))
+        mycharts.append(lazycharts.hist([len(prots) for prots in idd_peps_prots_map.values()],
+                                        title='proteins per peptide'))
 
 
 
@@ -103,131 +563,352 @@ def main():
         all_idd_bait_proteins.update(prots)
     # map from metagenome proteins to their BLAST hits
     print("Loading blast map...")
-    blast_bait_matches_evalues_map = blast.load_blast_protein_proteins_evalues_map(args.fastablast,
-                                                                   baitproteins_tokeep=all_idd_bait_proteins,
-                                                                   max_e=args.maxblaste,
-                                                                                   trim_accessions=True)
+    run_metrics.start_stage('load_blast')
+    blast_chart_idx = len(mycharts)
+    sorter = None
+    if args.externalsort:
+        # out of core: sort the hits we want by bait on disk. They're merge-joined with the peptides' proteins below
+        from pymeta import extsort
+        sorter = extsort.ExternalSorter(max_memory_bytes=args.sortmemorymb << 20, tmpdir=args.tmpdir)
+        blastproteins = blast.sort_blast_hits_by_bait(args.fastablast, sorter,
+                                                      baitproteins_tokeep=all_idd_bait_proteins,
+                                                      max_e=args.maxblaste, trim_accessions=True)
+        print("Sorted %d blast hits into %d runs." % (sorter.n_lines, len(sorter.run_paths)))
+        run_metrics.end_stage(hits=sorter.n_lines, sorted_runs=len(sorter.run_paths))
+    else:
+        # when caching, don't prune by delta while loading, so that changing the delta reuses the cached hits
+        load_max_e = args.maxblaste
+        load_max_delta_log10_e = args.maxblastdeltalog10e
+        if sweep_thresholds:
+            # load everything the widest threshold keeps
+            load_max_e = max(max_e for max_e, max_delta_log10_e in sweep_thresholds)
+            load_max_delta_log10_e = max(max_delta_log10_e for max_e, max_delta_log10_e in sweep_thresholds)
+        if cache:
+            load_max_delta_log10_e = None
+            input_digests['baits'] = stagecache.digest_strings(all_idd_bait_proteins)
+        blast_bait_matches_evalues_map = stagecache.cached(
+            cache, 'bait_hits', [input_digests.get('fastablast'), input_digests.get('baits'), load_max_e,
+                                 blast.BAIT_HITS_VERSION],
+            lambda: blast.load_blast_protein_proteins_evalues_map(args.fastablast,
+                                                                  baitproteins_tokeep=all_idd_bait_proteins,
+                                                                  max_e=load_max_e,
+                                                                  trim_accessions=True,
+                                                                  max_delta_log10_e=load_max_delta_log10_e))
 
-    print("Loaded %d proteins from blast map." % len(blast_bait_matches_evalues_map))
-    if args.outpdf:
-        mycharts.append(charts.hist([len(prots) for prots in blast_bait_matches_evalues_map.values()],
-                                    title='blast matches per protein'))
+        print("Loaded %d proteins from blast map." % len(blast_bait_matches_evalues_map))
+        # counts of the hits read, not of the hits left after pruning by delta, which depends on whether we're
+        # caching. Same as the --externalsort counts
+        run_metrics.end_stage(baits=len(blast_bait_matches_evalues_map),
+                              hits=sum(hits.n_read for hits in blast_bait_matches_evalues_map.values()))
+        if args.outpdf:
+            mycharts.append(lazycharts.hist([hits.n_read for hits in blast_bait_matches_evalues_map.values()],
+                                            title='blast matches per protein'))
 
-    blastproteins = set()
-    for prot_evalue_list in blast_bait_matches_evalues_map.values():
-        blastproteins.update(set([x[0] for x in prot_evalue_list]))
+        blastproteins = set()
+        for prot_evalue_list in blast_bait_matches_evalues_map.values():
+            blastproteins.update(set([x[0] for x in prot_evalue_list]))
     print("Loaded a total of %d blast-hit proteins" % len(blastproteins))
     print("Loading protein-taxon map...")
-    blastprotein_taxonid_map = {}
-    for row in csv.DictReader(args.prottaxonmap, delimiter='\t'):
-        assert('accession' in row and 'taxon_id' in row)
-        protein = row['accession']
-        if protein in blastproteins:
-            blastprotein_taxonid_map[protein] = int(row['taxon_id'])
+    run_metrics.start_stage('load_prot_taxa')
+    fetch_taxonomy = lambda taxon_ids: unipept.taxonomy(taxon_ids, validate=True)
+    taxonomy_prefetcher = None
+    if args.prefetchlineages:
+        taxonomy_prefetcher = unipept.TaxonomyPrefetcher(validate=True)
+        fetch_taxonomy = taxonomy_prefetcher.get
+    if cache:
+        input_digests['blastproteins'] = stagecache.digest_strings(blastproteins)
+    blastprotein_taxonid_map = stagecache.cached(
+        cache, 'prot_taxa', [input_digests.get('prottaxonmap'), input_digests.get('blastproteins')],
+        lambda: load_blastprotein_taxonid_map(args.prottaxonmap, blastproteins,
+                                              taxonomy_prefetcher=taxonomy_prefetcher))
     print("Loaded taxa for %d of %d blast-hit proteins" % (len(blastprotein_taxonid_map), len(blastproteins)))
+    run_metrics.end_stage(blast_proteins=len(blastproteins), blast_proteins_with_taxa=len(blastprotein_taxonid_map))
+    if taxonomy_prefetcher:
+        # if the map came from the cache, nothing was requested while loading it. Request its taxa now,
+        # except those the taxonomy stage has cached and so won't ask for
+        cached_taxonid_taxon_map = stagecache.cached_item_map(cache, 'taxonomy', ['unipept'])
+        for taxon_id in set(blastprotein_taxonid_map.itervalues()):
+            if taxon_id not in cached_taxonid_taxon_map:
+                taxonomy_prefetcher.add(taxon_id)
+        # send off the last partial batch, to be fetched while we associate peptides with taxa
+        taxonomy_prefetcher.flush()
+
+    if sweep_thresholds:
+        run_threshold_sweep(args, samples, sweep_thresholds, all_pepseqs, idd_peps_prots_map,
+                            blast_bait_matches_evalues_map, blastprotein_taxonid_map, cache, fetch_taxonomy,
+                            run_metrics, mycharts)
+        if taxonomy_prefetcher:
+            taxonomy_prefetcher.close()
+        write_charts_metrics(args, mycharts, run_metrics)
+        logger.debug("End time: %s. Elapsed time: %s" % (datetime.now(), datetime.now() - script_start_time))
+        return
 
     # map from peptides to blast-hit proteins
     print("Associating peptide with blast-hit proteins")
-    peptide_protblasthits_map = {}
-    peptide_taxonids_map = {}
-    for peptide in all_pepseqs:
-        if peptide not in idd_peps_prots_map:
-            continue
-        for protein in idd_peps_prots_map[peptide]:
-            if protein in blast_bait_matches_evalues_map:
-                if peptide not in peptide_protblasthits_map:
-                    peptide_protblasthits_map[peptide] = set()
-                match_proteins_evalues = blast_bait_matches_evalues_map[protein]
-                match_log10_evalues = [math.log(max(1e-181, match[1]), 10) for match in match_proteins_evalues]
-                min_blastlog10e = min(match_log10_evalues)
-                protblasthits = set()
-                for i in xrange(0, len(match_proteins_evalues)):
-                    if match_log10_evalues[i] - min_blastlog10e < args.maxblastdeltalog10e:
-                        protblasthits.add(match_proteins_evalues[i][0])
-                peptide_protblasthits_map[peptide].update(protblasthits)
-        if peptide in peptide_protblasthits_map:
-            for protblasthit in peptide_protblasthits_map[peptide]:
-                if protblasthit in blastprotein_taxonid_map:
-                    if peptide not in peptide_taxonids_map:
-                        peptide_taxonids_map[peptide] = set()
-                    peptide_taxonids_map[peptide].add(blastprotein_taxonid_map[protblasthit])
+    run_metrics.start_stage('associate')
+    if sorter:
+        try:
+            peptide_protblasthits_map, peptide_taxonids_map, bait_hit_counts = \
+                associate_peptides_sorted_bait_hits_taxa(
+                    all_pepseqs, idd_peps_prots_map,
+                    blast.iter_sorted_bait_hits(sorter.iter_sorted(), max_delta_log10_e=args.maxblastdeltalog10e),
+                    blastprotein_taxonid_map, args.maxblastdeltalog10e)
+        finally:
+            sorter.close()
+        if args.outpdf:
+            mycharts.insert(blast_chart_idx, lazycharts.hist(bait_hit_counts, title='blast matches per protein'))
+    else:
+        associate_function = associate_peptides_blasthits_taxa
+        if args.sparse:
+            from pymeta import relations
+            associate_function = relations.associate_peptides_blasthits_taxa
+        peptide_protblasthits_map, peptide_taxonids_map = associate_function(
+            all_pepseqs, idd_peps_prots_map, blast_bait_matches_evalues_map, blastprotein_taxonid_map,
+            args.maxblastdeltalog10e)
     print("%d peptides have BLAST matches." % len(peptide_protblasthits_map))
     print("%d peptides have taxa from BLAST matches." % len(peptide_taxonids_map))
+    run_metrics.end_stage(peptides_with_hits=len(peptide_protblasthits_map),
+                          peptides_with_taxa=len(peptide_taxonids_map))
 
     if args.outpdf:
-        mycharts.append(charts.hist([len(values) for values in peptide_protblasthits_map.values()],
-                                    title='Protein blast hits per peptide with at least 1'))
-        mycharts.append(charts.hist([len(values) for values in peptide_taxonids_map.values()],
-                                    title='Taxa per peptide with at least 1 taxon'))
+        mycharts.append(lazycharts.hist([len(values) for values in peptide_protblasthits_map.values()],
+                                        title='Protein blast hits per peptide with at least 1'))
+        mycharts.append(lazycharts.hist([len(values) for values in peptide_taxonids_map.values()],
+                                        title='Taxa per peptide with at least 1 taxon'))
 
     print("Divining LCAs for %d peptides with taxa..." % len(peptide_taxonids_map))
     all_pep_taxa = set()
     for peptide_taxa in peptide_taxonids_map.values():
         all_pep_taxa.update(set(peptide_taxa))
     print("Calling unipept on %d taxa..." % len(all_pep_taxa))
-    taxonid_taxon_map = unipept.taxonomy(list(all_pep_taxa), validate=True)
+    run_metrics.start_stage('taxonomy')
+    taxonid_taxon_map = stagecache.cached_items(cache, 'taxonomy', ['unipept'], sorted(all_pep_taxa),
+                                                fetch_taxonomy)
     print("Done. Found %d taxa. Inferring LCAs..." % len(taxonid_taxon_map))
-    peptide_lca_map = {}
-    for peptide in peptide_taxonids_map:
-        taxa_this_peptide = []
-        for taxon_id in peptide_taxonids_map[peptide]:
-            if taxon_id in taxonid_taxon_map:
-                taxa_this_peptide.append(taxonid_taxon_map[taxon_id])
-        validated_taxa_this_peptide = []
-        for taxon in taxa_this_peptide:
-            fixed_taxon = unipept.validate_rebuild_taxon(taxon)
-            if fixed_taxon:
-                validated_taxa_this_peptide.append(fixed_taxon)
-                if fixed_taxon.name != taxon.name:
-                    logger.debug("VALIDATION CHANGED TAXON: %s,%s -> %s,%s" % (taxon.rank, taxon.name, fixed_taxon.rank, fixed_taxon.name))
-            else:
-                logger.debug("INVALID TAXON: %s,%s" % (taxon.rank, taxon.name))
-        if validated_taxa_this_peptide:
-            peptide_lca_map[peptide] = unipept.infer_lca(validated_taxa_this_peptide)
-    print("%d of %d peptides assigned LCAs." % (len(peptide_lca_map), len(peptide_taxonids_map)))
+    run_metrics.end_stage(taxa_requested=len(all_pep_taxa), taxa_found=len(taxonid_taxon_map))
+    if taxonomy_prefetcher:
+        taxonomy_prefetcher.close()
+    pdf_render = None
+    rank_count_map = {}
+    if len(samples) == 1 and samples[0].out_path and args.outformat == 'tsv' and not cache and args.workers == 1:
+        # one sample, nothing to cache: write each peptide's row as its LCA is inferred, so there's
+        # no map from every peptide to its LCA
+        sample = samples[0]
+        run_metrics.start_stage('infer_write_lcas')
+        with open(sample.out_path, 'w', OUTPUT_BUFFER_BYTES) as outfile:
+            # shards are written sorted by peptide, for merge_lca_shards.py
+            peptide_lcas = iter_peptide_lcas(peptide_taxonids_map, taxonid_taxon_map,
+                                             peptides=sorted(peptide_taxonids_map) if args.shard else None)
+            n_written = write_peptide_lcas(outfile, count_lca_ranks(peptide_lcas, rank_count_map),
+                                           idd_peps_prots_map, peptide_protblasthits_map, args.includeprotids)
+        print("%d of %d peptides assigned LCAs." % (n_written, len(peptide_taxonids_map)))
+        print("Wrote %d lca matches to %s" % (n_written, sample.out_path))
+        run_metrics.end_stage(peptides_with_lcas=n_written, rows_written=n_written)
+        if args.outpdf:
+            mycharts.append(make_lca_rank_chart(rank_count_map))
+    else:
+        run_metrics.start_stage('infer_lcas')
+
+        def infer_lcas_for_peptides(peptides):
+            peptide_taxonids_map_tocompute = dict([(peptide, peptide_taxonids_map[peptide])
+                                                   for peptide in peptides])
+            if args.workers > 1:
+                from pymeta import lineagetable
+                return lineagetable.LineageTable(taxonid_taxon_map).infer_lcas(peptide_taxonids_map_tocompute,
+                                                                               n_workers=args.workers)
+            return infer_peptide_lcas(peptide_taxonids_map_tocompute, taxonid_taxon_map)
+        peptide_lca_map = stagecache.cached_items(cache, 'peptide_lcas',
+                                                  [input_digests.get('pepprotmap'), input_digests.get('fastablast'),
+                                                   input_digests.get('prottaxonmap'), args.maxblaste,
+                                                   args.maxblastdeltalog10e],
+                                                  sorted(peptide_taxonids_map.keys()), infer_lcas_for_peptides)
+        print("%d of %d peptides assigned LCAs." % (len(peptide_lca_map), len(peptide_taxonids_map)))
+        run_metrics.end_stage(peptides_with_lcas=len(peptide_lca_map))
 
+        if args.outpdf:
+            for lca in peptide_lca_map.itervalues():
+                if lca.rank not in rank_count_map:
+                    rank_count_map[lca.rank] = 0
+                rank_count_map[lca.rank] += 1
+            mycharts.append(make_lca_rank_chart(rank_count_map))
+            # all the charts are in. Render them while we write the LCAs
+            pdf_render = lazycharts.write_pdf(mycharts, args.outpdf, background=True, n_workers=args.workers)
+
+        run_metrics.start_stage('write')
+        n_written_total = 0
+        for sample in samples:
+            if sample.out_path:
+                n_written = write_sample_lcas(args, sample.pepseqs, sample.out_path, peptide_lca_map,
+                                              idd_peps_prots_map, peptide_protblasthits_map)
+                print("Wrote %d lca matches to %s" % (n_written, sample.out_path))
+                n_written_total += n_written
+        run_metrics.end_stage(rows_written=n_written_total)
     print("Done assigning LCAs")
 
-    if args.outpeptlcas:
-        headerline = 'peptide\t'
-        if args.includeprotids:
-            headerline += 'proteins\tblastproteins\t'
-        headerline = headerline + unipept.make_unipept_headerline(False)
-        args.outpeptlcas.write(headerline + '\n')
-        unipept_matches = [unipept.UnipeptMatch(peptide, peptide_lca_map[peptide]) for peptide in peptide_lca_map]
-        for unipept_match in unipept_matches:
-            outline = unipept_match.peptide + '\t'
-            if args.includeprotids:
-                protids = idd_peps_prots_map[unipept_match.peptide]
-                outline += ';'.join(protids) + '\t'
-                blast_protids = peptide_protblasthits_map[unipept_match.peptide]
-                outline += ';'.join(blast_protids) + '\t'
-            outline += str(unipept_match.taxon)
-            outline += '\n'
-            args.outpeptlcas.write(outline)
-        #unipept.write_pept2lca_matches(unipept_matches, args.outpeptlcas)
-        args.outpeptlcas.close()
-        print("Wrote %d lca matches to %s" % (len(unipept_matches), args.outpeptlcas.name))
+    write_charts_metrics(args, mycharts, run_metrics, pdf_render=pdf_render)
+    logger.debug("End time: %s. Elapsed time: %s" % (datetime.now(), datetime.now() - script_start_time))
+
+
+def make_lca_rank_chart(rank_count_map):
+    """
+    Bar chart of the number of peptides with an LCA at each rank
+    :param rank_count_map:
+    :return: a lazycharts ChartSpec
+    """
+    labels = []
+    values = []
+    for rank in pymeta.ncbi.RANKS:
+        if rank in rank_count_map:
+            labels.append(rank)
+            values.append(rank_count_map[rank])
+    return lazycharts.bar(values, labels=labels, title='LCA ranks', rotate_labels=True)
+
+
+def write_sample_lcas(args, sample_pepseqs, out_path, peptide_lca_map, peps_prots_map, peptide_protblasthits_map):
+    """
+    Write the LCAs of one sample's peptides in the --outformat format
+    :param args:
+    :param sample_pepseqs:
+    :param out_path:
+    :param peptide_lca_map:
+    :param peps_prots_map:
+    :param peptide_protblasthits_map:
+    :return: the number of peptides written
+    """
+    sample_peptides = (peptide for peptide in peptide_lca_map if peptide in sample_pepseqs)
+    if args.shard:
+        # shards are written sorted by peptide, for merge_lca_shards.py
+        sample_peptides = sorted(sample_peptides)
+    if args.outformat == 'tsv':
+        with open(out_path, 'w', OUTPUT_BUFFER_BYTES) as outfile:
+            return write_peptide_lcas(outfile, ((peptide, peptide_lca_map[peptide]) for peptide in sample_peptides),
+                                      peps_prots_map, peptide_protblasthits_map, args.includeprotids)
+    from pymeta import columnar
+    return columnar.write_peptide_lcas_columnar(out_path, args.outformat, list(sample_peptides), peptide_lca_map,
+                                                peps_prots_map, peptide_protblasthits_map, args.includeprotids)
+
+
+def make_sweep_out_path(out_path, max_e, max_delta_log10_e):
+    """
+    Output path for one threshold of a sweep: the thresholds go before the extension
+    :param out_path:
+    :param max_e:
+    :param max_delta_log10_e:
+    :return:
+    """
+    root, ext = os.path.splitext(out_path)
+    return '%s.maxe%g.delta%g%s' % (root, max_e, max_delta_log10_e, ext)
+
+
+def run_threshold_sweep(args, samples, sweep_thresholds, all_pepseqs, peps_prots_map, bait_hits_map,
+                        blastprotein_taxonid_map, cache, fetch_taxonomy, run_metrics, mycharts):
+    """
+    Associate, infer and write LCAs for every threshold of a sweep, with pymeta.sweep. Hits are filtered,
+    and LCAs inferred, as they would be for each threshold on its own
+    :param args:
+    :param samples:
+    :param sweep_thresholds: list of (max e-value, max delta log10 e-value)
+    :param all_pepseqs:
+    :param peps_prots_map:
+    :param bait_hits_map: BLAST hits loaded with the widest thresholds
+    :param blastprotein_taxonid_map:
+    :param cache:
+    :param fetch_taxonomy: function from a list of taxon IDs to a map from ID to Taxon
+    :param run_metrics:
+    :param mycharts:
+    :return:
+    """
+    from pymeta import sweep
+    print("Sweeping %d BLAST thresholds" % len(sweep_thresholds))
+    run_metrics.start_stage('associate')
+    threshold_sweep = sweep.ThresholdSweep(all_pepseqs, peps_prots_map, bait_hits_map, blastprotein_taxonid_map)
+    all_pep_taxa = threshold_sweep.calc_taxon_ids(max(max_e for max_e, max_delta_log10_e in sweep_thresholds),
+                                                  max(max_delta_log10_e for max_e, max_delta_log10_e
+                                                      in sweep_thresholds))
+    run_metrics.end_stage(peptide_classes=len(threshold_sweep.classes))
+    print("Calling unipept on %d taxa..." % len(all_pep_taxa))
+    run_metrics.start_stage('taxonomy')
+    taxonid_taxon_map = stagecache.cached_items(cache, 'taxonomy', ['unipept'], sorted(all_pep_taxa),
+                                                fetch_taxonomy)
+    print("Done. Found %d taxa." % len(taxonid_taxon_map))
+    run_metrics.end_stage(taxa_requested=len(all_pep_taxa), taxa_found=len(taxonid_taxon_map))
+
+    run_metrics.start_stage('sweep')
+    if args.sweepsummary:
+        args.sweepsummary.write('\t'.join(['maxblaste', 'maxblastdeltalog10e', 'peptides_with_hits',
+                                           'peptides_with_taxa', 'peptides_with_lcas'] +
+                                          pymeta.ncbi.RANKS) + '\n')
+    threshold_labels = []
+    threshold_lca_counts = []
+    n_written_total = 0
+    for result in threshold_sweep.iter_results(sweep_thresholds,
+                                               lambda taxon_ids: infer_taxa_lca(taxon_ids, taxonid_taxon_map)):
+        print("maxblaste %g, maxblastdeltalog10e %g: %d peptides with BLAST matches, %d with taxa, %d with LCAs" %
+              (result.max_e, result.max_delta_log10_e, len(result.peptide_protblasthits_map),
+               len(result.peptide_taxonids_map), len(result.peptide_lca_map)))
+        for sample in samples:
+            if sample.out_path:
+                out_path = make_sweep_out_path(sample.out_path, result.max_e, result.max_delta_log10_e)
+                n_written = write_sample_lcas(args, sample.pepseqs, out_path, result.peptide_lca_map,
+                                              peps_prots_map, result.peptide_protblasthits_map)
+                print("Wrote %d lca matches to %s" % (n_written, out_path))
+                n_written_total += n_written
+        if args.sweepsummary:
+            rank_count_map = result.calc_rank_counts()
+            args.sweepsummary.write('\t'.join(['%g' % result.max_e, '%g' % result.max_delta_log10_e] +
+                                              [str(count) for count in
+                                               [len(result.peptide_protblasthits_map),
+                                                len(result.peptide_taxonids_map), len(result.peptide_lca_map)] +
+                                               [rank_count_map.get(rank, 0) for rank in pymeta.ncbi.RANKS]]) + '\n')
+        threshold_labels.append('%g/%g' % (result.max_e, result.max_delta_log10_e))
+        threshold_lca_counts.append(len(result.peptide_lca_map))
+    if args.sweepsummary:
+        args.sweepsummary.close()
+        print("Wrote sweep summary %s" % args.sweepsummary.name)
+    run_metrics.end_stage(thresholds=len(sweep_thresholds), rows_written=n_written_total)
 
     if args.outpdf:
-        rank_count_map = {}
-        for lca in peptide_lca_map.values():
-            if lca.rank not in rank_count_map:
-                rank_count_map[lca.rank] = 0
-            rank_count_map[lca.rank] += 1
-        labels = []
-        values = []
-        for rank in pymeta.ncbi.RANKS:
-            if rank in rank_count_map:
-                labels.append(rank)
-                values.append(rank_count_map[rank])
-        mycharts.append(charts.bar(values, labels=labels, title='LCA ranks', rotate_labels=True))
+        mycharts.append(lazycharts.bar(threshold_lca_counts, labels=threshold_labels,
+                                       title='Peptides with LCAs by maxblaste/maxblastdeltalog10e',
+                                       rotate_labels=True))
+
 
+def write_charts_metrics(args, mycharts, run_metrics, pdf_render=None):
+    """
+    Write the charts PDF and the metrics JSON, if requested
+    :param args:
+    :param mycharts:
+    :param run_metrics:
+    :param pdf_render: if the PDF is already being rendered in the background, its lazycharts.BackgroundRender
+    :return:
+    """
     if args.outpdf:
-        charts.write_pdf(mycharts, args.outpdf)
+        run_metrics.start_stage('charts')
+        if pdf_render:
+            pdf_render.wait()
+        else:
+            lazycharts.write_pdf(mycharts, args.outpdf, n_workers=args.workers)
         print("Wrote PDF %s" % args.outpdf.name)
+        run_metrics.end_stage(charts=len(mycharts))
+    if args.metrics_out:
+        http_call_stats = unipept.summarize_http_calls()
+        for url in http_call_stats:
+            http_call_stats[url].update(metrics.summarize_latencies(http_call_stats[url].pop('latencies_secs')))
+        run_metrics.add_section('unipept_http_calls', http_call_stats)
+        run_metrics.write_json(args.metrics_out)
+        args.metrics_out.close()
     print("Done.")
-    logger.debug("End time: %s. Elapsed time: %s" % (datetime.now(), datetime.now() - script_start_time))
 
 
-main()
+class Sample:
+    """
+    One sample's identified peptides, and where to write its LCAs
+    """
+    def __init__(self, name, pepseqs, out_path):
+        self.name = name
+        self.pepseqs = pepseqs
+        self.out_path = out_path
+
+
+if __name__ == '__main__':
+    main()
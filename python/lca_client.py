@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Thin client for lca_daemon.py. Sends one annotate, pept2lca or taxonomy request to a running daemon
+and waits for the result. Imports nothing heavy, so it starts in a fraction of a second.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+
+def declare_gather_args():
+    """
+    Declare all arguments, parse them, and return the args dict.
+    Does no validation beyond the implicit validation done by argparse.
+    return: a dict mapping arg names to values
+    """
+
+    # declare args
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--socket', required=True,
+                        help='Unix socket of the lca_daemon.py to send the request to')
+    subparsers = parser.add_subparsers(dest='op')
+    annotate_parser = subparsers.add_parser('annotate', help='same as annotate_blast_with_taxonids.py')
+    annotate_parser.add_argument('blastfile',
+                                 help='input blast file (may be gzipped or bzipped)')
+    annotate_parser.add_argument('--out', required=True,
+                                 help='output file. If it ends with .gz or .bz2 it is compressed')
+    pept2lca_parser = subparsers.add_parser('pept2lca', help='same as infer_taxa_withblast.py for one sample')
+    pept2lca_parser.add_argument('--pepseqsfile', required=True,
+                                 help='input file with all peptide sequences identified')
+    pept2lca_parser.add_argument('--outpeptlcas', required=True,
+                                 help='output file with lca taxa')
+    pept2lca_parser.add_argument('--maxblastdeltalog10e', type=float,
+                                 help='Maximum difference between BLAST e-value of a hit and the best hit for that '
+                                      'bait to keep. Default: the infer_taxa_withblast.py default')
+    pept2lca_parser.add_argument('--includeprotids', action="store_true",
+                                 help='Include IDs of proteins for each peptide')
+    taxonomy_parser = subparsers.add_parser('taxonomy', help='print the lineages of taxa')
+    taxonomy_parser.add_argument('taxon_ids', type=int, nargs='+')
+    subparsers.add_parser('ping', help='check that the daemon is up')
+    subparsers.add_parser('shutdown', help='stop the daemon')
+    return parser.parse_args()
+
+
+def send_request(socket_path, request):
+    """
+    Send a request to the daemon and wait for the response
+    :param socket_path:
+    :param request: dict
+    :return: response dict
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock_file = sock.makefile('rw')
+        sock_file.write(json.dumps(request) + '\n')
+        sock_file.flush()
+        response_line = sock_file.readline()
+    finally:
+        sock.close()
+    if not response_line:
+        raise IOError('lca_daemon at %s closed the connection without responding' % socket_path)
+    return json.loads(response_line)
+
+
+def main():
+    args = declare_gather_args()
+    request = {'op': args.op}
+    # the daemon has its own working directory
+    if args.op == 'annotate':
+        request.update({'blastfile': os.path.abspath(args.blastfile), 'out': os.path.abspath(args.out)})
+    elif args.op == 'pept2lca':
+        request.update({'pepseqsfile': os.path.abspath(args.pepseqsfile),
+                        'outpeptlcas': os.path.abspath(args.outpeptlcas),
+                        'includeprotids': args.includeprotids})
+        if args.maxblastdeltalog10e is not None:
+            request['maxblastdeltalog10e'] = args.maxblastdeltalog10e
+    elif args.op == 'taxonomy':
+        request['taxon_ids'] = args.taxon_ids
+
+    response = send_request(args.socket, request)
+    if not response.pop('ok'):
+        sys.stderr.write('lca_daemon error: %s\n' % response['error'])
+        sys.exit(1)
+    if args.op == 'annotate':
+        print("Done. Found taxa for %d of %d lines written" % (response['n_withtaxa'], response['n_written']))
+    elif args.op == 'pept2lca':
+        print("Wrote %d lca matches for %d peptides to %s" % (response['n_written'], response['n_peptides'],
+                                                             args.outpeptlcas))
+    elif args.op == 'taxonomy':
+        for taxon_id in args.taxon_ids:
+            if str(taxon_id) in response['lineages']:
+                print(response['lineages'][str(taxon_id)])
+            else:
+                print("%d\tunknown" % taxon_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""
+Long-running LCA server. Loads the accession->taxon map, and optionally a peptide-protein index
+and a BLAST file, once, and keeps Unipept lineages as they're fetched. Serves annotate, pept2lca and
+taxonomy requests from lca_client.py over a Unix socket, so that many small jobs don't each pay
+for interpreter startup, imports and loading.
+
+Protocol: one JSON object per line in each direction. Each request has an 'op' key; each response
+has 'ok', and either the op's results or 'error'. Paths in requests must be absolute.
+"""
+
+import SocketServer
+import argparse
+import json
+import logging
+import os
+import stat
+import time
+from datetime import datetime
+
+import annotate_blast_with_taxonids
+import infer_taxa_withblast
+from pymeta import blast
+from pymeta import unipept
+from pyvalise.util import files
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+
+def declare_gather_args():
+    """
+    Declare all arguments, parse them, and return the args dict.
+    Does no validation beyond the implicit validation done by argparse.
+    return: a dict mapping arg names to values
+    """
+
+    # declare args
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--socket', required=True,
+                        help='path of the Unix socket to listen on')
+    parser.add_argument('--accessiontaxonfile', required=True, type=files.CompressedFileType('r'),
+                        help='file mapping accession to taxon (the --prottaxonmap of infer_taxa_withblast.py)')
+    parser.add_argument('--pepprotindex',
+                        help='peptide-protein index directory built by build_pepprot_index.py. Needed for '
+                             'pept2lca')
+    parser.add_argument('--fastablast', type=files.CompressedFileType('r'),
+                        help='BLAST results from metagenome_fasta. Needed for pept2lca')
+    parser.add_argument('--maxblaste', type=float, default=1000,
+                        help='Maximum BLAST e-value to keep. Fixed for the life of the daemon')
+    parser.add_argument('--debug', action="store_true", help='Enable debug logging')
+    return parser.parse_args()
+
+
+class LcaService:
+    """
+    The resident data, and the ops that use it
+    """
+    def __init__(self, accession_taxon_map, pepprot_index=None, bait_hits_map=None):
+        """
+        :param accession_taxon_map: map from accession to taxon ID string
+        :param pepprot_index: a pepprotindex.PepProtIndex, or None
+        :param bait_hits_map: map from every bait protein to its BaitHits, or None
+        """
+        self.accession_taxon_map = accession_taxon_map
+        self.pepprot_index = pepprot_index
+        self.bait_hits_map = bait_hits_map
+        self.taxonid_taxon_map = {}
+        # IDs Unipept has no taxon for, so we don't ask again
+        self.unknown_taxon_ids = set()
+        # LCAs of the taxon sets seen so far. Lineages don't change while we're up, so neither do these
+        self.taxonids_lca_map = {}
+        self.should_shutdown = False
+
+    def handle(self, request):
+        """
+        Dispatch a request to its op
+        :param request: dict
+        :return: response dict
+        """
+        op = request.get('op')
+        if op == 'ping':
+            return {}
+        if op == 'shutdown':
+            self.should_shutdown = True
+            return {}
+        if op == 'taxonomy':
+            return self.taxonomy(request)
+        if op == 'annotate':
+            return self.annotate(request)
+        if op == 'pept2lca':
+            return self.pept2lca(request)
+        raise ValueError('Unknown op %s' % op)
+
+    def get_taxa(self, taxon_ids):
+        """
+        Lineages for taxon_ids, fetching any we haven't seen from Unipept
+        :param taxon_ids:
+        :return: map from ID to Taxon, for the IDs Unipept knows
+        """
+        taxon_ids_tofetch = sorted(set([taxon_id for taxon_id in taxon_ids if taxon_id not in self.taxonid_taxon_map
+                                        and taxon_id not in self.unknown_taxon_ids]))
+        if taxon_ids_tofetch:
+            logger.debug("Fetching %d new taxa" % len(taxon_ids_tofetch))
+            self.taxonid_taxon_map.update(unipept.taxonomy(taxon_ids_tofetch, validate=True))
+            self.unknown_taxon_ids.update([taxon_id for taxon_id in taxon_ids_tofetch
+                                           if taxon_id not in self.taxonid_taxon_map])
+        return dict([(taxon_id, self.taxonid_taxon_map[taxon_id]) for taxon_id in taxon_ids
+                     if taxon_id in self.taxonid_taxon_map])
+
+    def taxonomy(self, request):
+        """
+        request: taxon_ids
+        :return: lineages: map from taxon ID to comma-delimited lineage
+        """
+        taxonid_taxon_map = self.get_taxa([int(taxon_id) for taxon_id in request['taxon_ids']])
+        return {'lineages': dict([(str(taxon_id), str(taxon)) for taxon_id, taxon in taxonid_taxon_map.iteritems()])}
+
+    def annotate(self, request):
+        """
+        Same as annotate_blast_with_taxonids.py, without checkpointing.
+        request: blastfile, out
+        :return: n_written, n_withtaxa
+        """
+        n_written = 0
+        n_withtaxa = 0
+        with files.open_file(request['blastfile'], 'r') as blast_file:
+            with files.open_file(request['out'], 'w') as out:
+                for line in blast_file:
+                    try:
+                        outline, has_taxon = annotate_blast_with_taxonids.annotate_blast_line(
+                            line, self.accession_taxon_map)
+                    except ValueError:
+                        continue
+                    if has_taxon:
+                        n_withtaxa += 1
+                    n_written += 1
+                    out.write(outline)
+        return {'n_written': n_written, 'n_withtaxa': n_withtaxa}
+
+    def pept2lca(self, request):
+        """
+        Same as infer_taxa_withblast.py for one sample, writing tab-delimited output.
+        request: pepseqsfile, outpeptlcas, and optionally maxblastdeltalog10e and includeprotids
+        :return: n_peptides, n_written
+        """
+        if self.pepprot_index is None or self.bait_hits_map is None:
+            raise ValueError('pept2lca needs the daemon to be started with --pepprotindex and --fastablast')
+        max_delta_log10_e = request.get('maxblastdeltalog10e', infer_taxa_withblast.DEFAULT_MAX_BLAST_DELTA_LOG10_E)
+        with open(request['pepseqsfile']) as pepseqs_file:
+            pepseqs = infer_taxa_withblast.load_pepseqs(pepseqs_file)
+        peps_prots_map, prots_peps_map = self.pepprot_index.lookup(pepseqs)
+        bait_hits_map = dict([(protein, self.bait_hits_map[protein]) for protein in prots_peps_map
+                              if protein in self.bait_hits_map])
+        blastprotein_taxonid_map = {}
+        for bait_hits in bait_hits_map.values():
+            for hit_protein in bait_hits.proteins:
+                if hit_protein in self.accession_taxon_map:
+                    blastprotein_taxonid_map[hit_protein] = int(self.accession_taxon_map[hit_protein])
+        peptide_protblasthits_map, peptide_taxonids_map = infer_taxa_withblast.associate_peptides_blasthits_taxa(
+            pepseqs, peps_prots_map, bait_hits_map, blastprotein_taxonid_map, max_delta_log10_e)
+        all_pep_taxa = set()
+        for taxon_ids in peptide_taxonids_map.values():
+            all_pep_taxa.update(taxon_ids)
+        peptide_lca_map = infer_taxa_withblast.infer_peptide_lcas(peptide_taxonids_map, self.get_taxa(all_pep_taxa),
+                                                                  taxonids_lca_map=self.taxonids_lca_map)
+        with open(request['outpeptlcas'], 'w', infer_taxa_withblast.OUTPUT_BUFFER_BYTES) as outfile:
+            n_written = infer_taxa_withblast.write_peptide_lcas(outfile, peptide_lca_map.iteritems(), peps_prots_map,
+                                                                peptide_protblasthits_map,
+                                                                request.get('includeprotids', False))
+        return {'n_peptides': len(pepseqs), 'n_written': n_written}
+
+
+class LcaRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Reads JSON requests, one per line, until the client closes the connection
+    """
+    def handle(self):
+        for line in self.rfile:
+            start_time = time.time()
+            request = {}
+            try:
+                request = json.loads(line)
+                response = self.server.service.handle(request)
+                response['ok'] = True
+            except Exception as e:
+                logger.exception("Request failed: %s" % line.strip())
+                response = {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+            logger.info("%s: %.3fs" % (request.get('op'), time.time() - start_time))
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+            if self.server.service.should_shutdown:
+                self.server.shutdown_requested = True
+                return
+
+
+class LcaServer(SocketServer.UnixStreamServer):
+    """
+    Serves one connection at a time, so the resident data needs no locking
+    """
+    def __init__(self, socket_path, service):
+        SocketServer.UnixStreamServer.__init__(self, socket_path, LcaRequestHandler)
+        self.service = service
+        self.shutdown_requested = False
+
+    def serve_until_shutdown(self):
+        while not self.shutdown_requested:
+            self.handle_request()
+
+
+def main():
+    args = declare_gather_args()
+    # logging
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s: %(message)s")
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        # any module-specific debugging goes below
+        unipept.logger.setLevel(logging.DEBUG)
+
+    script_start_time = datetime.now()
+    logger.debug("Start time: %s" % script_start_time)
+
+    accession_taxon_map = annotate_blast_with_taxonids.load_accession_taxon_map(args.accessiontaxonfile)
+    print("Loaded taxa for %d accessions" % len(accession_taxon_map))
+    pepprot_index = None
+    if args.pepprotindex:
+        from pymeta import pepprotindex
+        pepprot_index = pepprotindex.PepProtIndex(args.pepprotindex)
+        print("Opened index of %d peptides" % len(pepprot_index))
+    bait_hits_map = None
+    if args.fastablast:
+        bait_hits_map = blast.load_blast_protein_proteins_evalues_map(args.fastablast, max_e=args.maxblaste,
+                                                                     trim_accessions=True)
+        print("Loaded blast hits for %d proteins" % len(bait_hits_map))
+
+    if os.path.exists(args.socket):
+        # left over from a daemon that didn't shut down cleanly. Don't clobber anything else
+        if not stat.S_ISSOCK(os.stat(args.socket).st_mode):
+            raise ValueError('%s exists and is not a socket' % args.socket)
+        os.remove(args.socket)
+    server = LcaServer(args.socket, LcaService(accession_taxon_map, pepprot_index=pepprot_index,
+                                               bait_hits_map=bait_hits_map))
+    print("Listening on %s" % args.socket)
+    try:
+        server.serve_until_shutdown()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+    print("Done.")
+    logger.debug("End time: %s. Elapsed time: %s" % (datetime.now(), datetime.now() - script_start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Merge the tab-delimited peptide LCA files written by infer_taxa_withblast.py --shard runs into one
+file. Each shard's rows are sorted by peptide, so the merge streams through them and the result is
+sorted by peptide too.
+Optionally write the LCA rank chart for the merged peptides.
+"""
+
+import argparse
+import heapq
+import logging
+from datetime import datetime
+
+import pymeta.ncbi
+from pyvalise.util import lazycharts
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+RANK_STRINGS = set(pymeta.ncbi.RANKS + ['no rank'])
+
+
+def declare_gather_args():
+    """
+    Declare all arguments, parse them, and return the args dict.
+    Does no validation beyond the implicit validation done by argparse.
+    return: a dict mapping arg names to values
+    """
+
+    # declare args
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--shards', required=True, type=argparse.FileType('r'), nargs='+',
+                        help='peptide LCA files from each shard of one sample, each sorted by peptide')
+    parser.add_argument('--outpeptlcas', required=True, type=argparse.FileType('w'),
+                        help='merged output file')
+    parser.add_argument('--outpdf', type=argparse.FileType('wb'),
+                        help='output charts pdf')
+    parser.add_argument('--debug', action="store_true", help='Enable debug logging')
+    return parser.parse_args()
+
+
+def read_shard_headers(shard_files):
+    """
+    Read the header line of each shard, and check they all have the same columns
+    :param shard_files:
+    :return: the header line, or None if the shards are empty
+    """
+    headerline = None
+    for shard_file in shard_files:
+        shard_headerline = shard_file.readline()
+        if headerline is None:
+            headerline = shard_headerline
+        elif shard_headerline != headerline:
+            raise ValueError('%s has different columns from the other shards' % shard_file.name)
+    return headerline
+
+
+def iter_shard_rows(shard_file):
+    """
+    Stream the rows of one shard, after its header, checking that they're sorted by peptide
+    :param shard_file:
+    :return: an iterator over (peptide, line)
+    """
+    prev_peptide = None
+    for line in shard_file:
+        peptide = line[:line.find('\t')]
+        if prev_peptide is not None and peptide <= prev_peptide:
+            raise ValueError('%s is not sorted by peptide (%s after %s). Was it written by '
+                             'infer_taxa_withblast.py --shard?' % (shard_file.name, peptide, prev_peptide))
+        prev_peptide = peptide
+        yield peptide, line
+
+
+def iter_merged_shard_lines(shard_files):
+    """
+    Merge the shards' rows, which are each sorted by peptide, holding one row per shard at a time
+    :param shard_files: files positioned after their headers
+    :return: an iterator over the rows, sorted by peptide
+    """
+    prev_peptide = None
+    for peptide, line in heapq.merge(*[iter_shard_rows(shard_file) for shard_file in shard_files]):
+        if peptide == prev_peptide:
+            raise ValueError('Peptide %s is in more than one shard. Were the shards run with the same N?' %
+                             peptide)
+        prev_peptide = peptide
+        yield line
+
+
+def parse_lca_rank(line):
+    """
+    Pull the LCA's rank out of an output row. The lineage is the comma-delimited last column, starting
+    with the LCA's ID, name and rank. Taxon names can contain commas, so take the first field after the
+    ID that's a rank
+    :param line:
+    :return:
+    """
+    lineage_fields = line.rstrip('\n').split('\t')[-1].split(',')
+    for field in lineage_fields[2:]:
+        if field in RANK_STRINGS:
+            return field
+    return None
+
+
+def main():
+    args = declare_gather_args()
+    # logging
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s: %(message)s")
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    script_start_time = datetime.now()
+    logger.debug("Start time: %s" % script_start_time)
+
+    headerline = read_shard_headers(args.shards)
+    if headerline is None:
+        raise ValueError('Shard files are empty')
+    args.outpeptlcas.write(headerline)
+    rank_count_map = {}
+    n_written = 0
+    for line in iter_merged_shard_lines(args.shards):
+        args.outpeptlcas.write(line)
+        n_written += 1
+        if args.outpdf:
+            rank = parse_lca_rank(line)
+            if rank not in rank_count_map:
+                rank_count_map[rank] = 0
+            rank_count_map[rank] += 1
+    args.outpeptlcas.close()
+    print("Wrote %d lca matches from %d shards to %s" % (n_written, len(args.shards), args.outpeptlcas.name))
+
+    if args.outpdf:
+        labels = []
+        values = []
+        for rank in pymeta.ncbi.RANKS:
+            if rank in rank_count_map:
+                labels.append(rank)
+                values.append(rank_count_map[rank])
+        lazycharts.write_pdf([lazycharts.bar(values, labels=labels, title='LCA ranks', rotate_labels=True)],
+                             args.outpdf)
+        print("Wrote PDF %s" % args.outpdf.name)
+    logger.debug("End time: %s. Elapsed time: %s" % (datetime.now(), datetime.now() - script_start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+"""
+Read BLAST tabular (-outfmt 6) results
+"""
+
+import logging
+import math
+from array import array
+from itertools import izip
+
+import numpy as np
+
+from pyvalise.ext import uniprot
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+# columns of BLAST -outfmt 6. Anything after these (e.g., a taxon ID added by
+# annotate_blast_with_taxonids.py) is ignored
+BLAST_COLNAMES = ['qseqid', 'sseqid', 'pident', 'length', 'mismatch', 'gapopen',
+                  'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore']
+N_BLAST_COLUMNS = len(BLAST_COLNAMES)
+COLIDX_BAIT = 0
+COLIDX_HIT = 1
+COLIDX_EVALUE = 10
+
+# BLAST reports e-values below this as 0. Floor e-values here before taking logs
+MIN_EVALUE = 1e-181
+
+# baits per vectorized delta-filter pass when streaming hits grouped by bait
+DELTA_FILTER_BATCH_BAITS = 10000
+
+# bump when BaitHits' fields change, so that pickled BaitHits from before aren't reused
+BAIT_HITS_VERSION = 2
+
+
+def calc_log10_evalue(evalue):
+    """
+    log10 of an e-value, flooring at MIN_EVALUE so that e-values of 0 are finite
+    :param evalue:
+    :return:
+    """
+    return math.log(max(MIN_EVALUE, evalue), 10)
+
+
+def calc_log10_evalues(evalues):
+    """
+    calc_log10_evalue() over a numpy array of e-values. Computed as ln(e) / ln(10), as math.log(e, 10) does,
+    rather than with np.log10(), so that both give identical values and the vectorized delta filters keep
+    exactly the hits BaitHits pruning keeps, even at whole-decade deltas
+    :param evalues:
+    :return:
+    """
+    return np.log(np.maximum(MIN_EVALUE, evalues)) / math.log(10)
+
+
+def trim_accession(protein):
+    """
+    Trim a UniProt-style protein ID down to the accession. Leave other IDs alone
+    :param protein:
+    :return:
+    """
+    try:
+        return uniprot.protid2uniprotaccession(protein)
+    except ValueError:
+        return protein
+
+
+def parse_blast_line(line):
+    """
+    Parse one line of BLAST tabular output.
+    Raises ValueError if the line is a comment or isn't valid tabular BLAST output
+    :param line:
+    :return: a BlastHit
+    """
+    if line.startswith('#'):
+        raise ValueError('Comment line')
+    fields = line.rstrip('\r\n').split('\t')
+    if len(fields) < N_BLAST_COLUMNS:
+        raise ValueError('Expected at least %d columns, got %d' % (N_BLAST_COLUMNS, len(fields)))
+    return BlastHit(fields[0], fields[1], float(fields[2]), int(fields[3]), int(fields[4]), int(fields[5]),
+                    int(fields[6]), int(fields[7]), int(fields[8]), int(fields[9]),
+                    float(fields[10]), float(fields[11]))
+
+
+def iter_blast_bait_hits(blast_file, baitproteins_tokeep=None, max_e=None, trim_accessions=False):
+    """
+    Stream (bait protein, hit protein, e-value) out of a BLAST tabular file. Only the bait, hit and
+    e-value columns are parsed, and only for baits we're keeping
+    :param blast_file:
+    :param baitproteins_tokeep: if not None, only keep hits for these baits
+    :param max_e: if not None, only keep hits with e-values <= max_e
+    :param trim_accessions: trim hit protein IDs to UniProt accessions
+    :return:
+    """
+    n_lines = 0
+    n_kept = 0
+    n_bad = 0
+    trimmed_hit_cache = {}
+    for line in blast_file:
+        n_lines += 1
+        tab_idx = line.find('\t')
+        if tab_idx < 0 or line.startswith('#'):
+            n_bad += 1
+            continue
+        bait = line[:tab_idx]
+        if baitproteins_tokeep is not None and bait not in baitproteins_tokeep:
+            continue
+        fields = line.split('\t', N_BLAST_COLUMNS - 1)
+        try:
+            evalue = float(fields[COLIDX_EVALUE])
+        except (IndexError, ValueError):
+            n_bad += 1
+            continue
+        if max_e is not None and evalue > max_e:
+            continue
+        hit_protein = fields[COLIDX_HIT]
+        if trim_accessions:
+            if hit_protein not in trimmed_hit_cache:
+                trimmed_hit_cache[hit_protein] = intern(trim_accession(hit_protein))
+            hit_protein = trimmed_hit_cache[hit_protein]
+        else:
+            hit_protein = intern(hit_protein)
+        n_kept += 1
+        yield bait, hit_protein, evalue
+    if n_bad:
+        logger.debug("iter_blast_bait_hits: skipped %d bad lines" % n_bad)
+    logger.debug("iter_blast_bait_hits: read %d lines, kept %d hits" % (n_lines, n_kept))
+
+
+def load_blast_protein_proteins_evalues_map(blast_file, baitproteins_tokeep=None, max_e=None,
+                                            trim_accessions=False, max_delta_log10_e=None):
+    """
+    Stream through a BLAST tabular file and build a map from each bait (query) protein to its hits.
+    Only the bait, hit and e-value columns are parsed, and only for baits we're keeping, so
+    memory is bounded by the number of hits retained rather than by the size of the file.
+    :param blast_file:
+    :param baitproteins_tokeep: if not None, only keep hits for these baits
+    :param max_e: if not None, only keep hits with e-values <= max_e
+    :param trim_accessions: trim hit protein IDs to UniProt accessions
+    :param max_delta_log10_e: if not None, only keep hits whose log10 e-value is less than this much
+                              worse than the bait's best hit. Applied as hits arrive
+    :return: a map from bait protein to BaitHits, which acts like a list of (hit protein, e-value) pairs
+    """
+    result = {}
+    for bait, hit_protein, evalue in iter_blast_bait_hits(blast_file, baitproteins_tokeep=baitproteins_tokeep,
+                                                          max_e=max_e, trim_accessions=trim_accessions):
+        if bait not in result:
+            result[bait] = BaitHits()
+        result[bait].add(hit_protein, evalue, max_delta_log10_e=max_delta_log10_e)
+    for bait_hits in result.itervalues():
+        bait_hits.finish(max_delta_log10_e)
+    logger.debug("load_blast_protein_proteins_evalues_map: %d baits, %d hits after pruning" %
+                 (len(result), sum(len(x) for x in result.values())))
+    return result
+
+
+def sort_blast_hits_by_bait(blast_file, sorter, baitproteins_tokeep=None, max_e=None, trim_accessions=False):
+    """
+    Feed the hits we're keeping from a BLAST tabular file into an extsort.ExternalSorter, as compact
+    bait, hit, e-value lines, so they can be streamed back grouped by bait with iter_sorted_bait_hits()
+    :param blast_file:
+    :param sorter:
+    :param baitproteins_tokeep: if not None, only keep hits for these baits
+    :param max_e: if not None, only keep hits with e-values <= max_e
+    :param trim_accessions: trim hit protein IDs to UniProt accessions
+    :return: the set of hit proteins
+    """
+    hit_proteins = set()
+    for bait, hit_protein, evalue in iter_blast_bait_hits(blast_file, baitproteins_tokeep=baitproteins_tokeep,
+                                                          max_e=max_e, trim_accessions=trim_accessions):
+        # repr() round-trips the e-value exactly
+        sorter.add('%s\t%s\t%r\n' % (bait, hit_protein, evalue))
+        hit_proteins.add(hit_protein)
+    return hit_proteins
+
+
+def iter_sorted_bait_hits(sorted_lines, max_delta_log10_e=None):
+    """
+    Group bait-sorted lines written by sort_blast_hits_by_bait() back into each bait's hits. Since
+    a tab sorts before any character of a protein ID, baits come out in ascending order
+    :param sorted_lines:
+    :param max_delta_log10_e: if not None, prune hits as in load_blast_protein_proteins_evalues_map()
+    :return: an iterator over (bait protein, BaitHits), one bait at a time
+    """
+    current_bait = None
+    current_hits = None
+    for line in sorted_lines:
+        bait, hit_protein, evalue_str = line.rstrip('\n').split('\t')
+        if bait != current_bait:
+            if current_hits is not None:
+                current_hits.finish(max_delta_log10_e)
+                yield current_bait, current_hits
+            current_bait = bait
+            current_hits = BaitHits()
+        current_hits.add(intern(hit_protein), float(evalue_str), max_delta_log10_e=max_delta_log10_e)
+    if current_hits is not None:
+        current_hits.finish(max_delta_log10_e)
+        yield current_bait, current_hits
+
+
+def iter_sorted_bait_delta_filtered_hits(sorted_bait_hits, max_delta_log10_e, batch_baits=DELTA_FILTER_BATCH_BAITS):
+    """
+    Streaming version of calc_bait_delta_filtered_hits(), for hits grouped by bait with
+    iter_sorted_bait_hits(). Only a batch of baits' hits is held at a time
+    :param sorted_bait_hits: iterator over (bait protein, BaitHits), in ascending bait order
+    :param max_delta_log10_e:
+    :param batch_baits: number of baits to filter together
+    :return: an iterator over (bait protein, frozenset of hit proteins, number of hits read for the bait before
+             any pruning), in ascending bait order
+    """
+    batch = {}
+    prev_bait = None
+    for bait, bait_hits in sorted_bait_hits:
+        if prev_bait is not None and bait <= prev_bait:
+            raise ValueError('BLAST hits are not sorted by bait: %s after %s' % (bait, prev_bait))
+        prev_bait = bait
+        batch[bait] = bait_hits
+        if len(batch) >= batch_baits:
+            for result in _iter_batch_delta_filtered_hits(batch, max_delta_log10_e):
+                yield result
+            batch = {}
+    for result in _iter_batch_delta_filtered_hits(batch, max_delta_log10_e):
+        yield result
+
+
+def _iter_batch_delta_filtered_hits(bait_hits_map, max_delta_log10_e):
+    bait_blasthits_map = calc_bait_delta_filtered_hits(bait_hits_map, max_delta_log10_e)
+    for bait in sorted(bait_hits_map.keys()):
+        yield bait, bait_blasthits_map.get(bait, frozenset()), bait_hits_map[bait].n_read
+
+
+def calc_bait_delta_filtered_hits(bait_hits_map, max_delta_log10_e):
+    """
+    For every bait, find the set of hit proteins whose log10 e-value is less than max_delta_log10_e
+    worse than the bait's best hit. The logs and per-bait minima are computed in one vectorized pass
+    over the e-values of all the baits together.
+    :param bait_hits_map: map from bait protein to BaitHits
+    :param max_delta_log10_e:
+    :return: a map from bait protein to a frozenset of hit proteins
+    """
+    baits = [bait for bait in bait_hits_map if len(bait_hits_map[bait]) > 0]
+    result = {}
+    if not baits:
+        return result
+    lengths = np.array([len(bait_hits_map[bait]) for bait in baits], dtype=np.int64)
+    starts = np.zeros(len(baits), dtype=np.int64)
+    starts[1:] = np.cumsum(lengths)[:-1]
+    all_evalues = np.concatenate([np.frombuffer(bait_hits_map[bait].evalues, dtype=np.float64)
+                                  for bait in baits])
+    all_log10_evalues = calc_log10_evalues(all_evalues)
+    bait_min_log10_evalues = np.minimum.reduceat(all_log10_evalues, starts)
+    keep_mask = all_log10_evalues - np.repeat(bait_min_log10_evalues, lengths) < max_delta_log10_e
+    for i in xrange(0, len(baits)):
+        proteins = bait_hits_map[baits[i]].proteins
+        bait_keep_mask = keep_mask[starts[i]:starts[i] + lengths[i]]
+        if bait_keep_mask.all():
+            result[baits[i]] = frozenset(proteins)
+        else:
+            result[baits[i]] = frozenset(proteins[j] for j in np.flatnonzero(bait_keep_mask))
+    return result
+
+
+class BlastHit:
+    """
+    One line of BLAST tabular output
+    """
+    def __init__(self, bait_protein, hit_protein, percent_identity, alignment_length, n_mismatches, n_gap_opens,
+                 bait_start, bait_end, hit_start, hit_end, evalue, bitscore):
+        self.bait_protein = bait_protein
+        self.hit_protein = hit_protein
+        self.percent_identity = percent_identity
+        self.alignment_length = alignment_length
+        self.n_mismatches = n_mismatches
+        self.n_gap_opens = n_gap_opens
+        self.bait_start = bait_start
+        self.bait_end = bait_end
+        self.hit_start = hit_start
+        self.hit_end = hit_end
+        self.evalue = evalue
+        self.bitscore = bitscore
+
+
+class BaitHits(object):
+    """
+    The hits for one bait protein, stored compactly as a list of (interned) hit protein IDs and a parallel
+    array of e-values. Acts like a list of (hit protein, e-value) tuples
+    """
+    __slots__ = ('proteins', 'evalues', 'best_log10_e', 'worst_log10_e', 'n_after_prune', 'n_read')
+
+    def __init__(self):
+        self.proteins = []
+        self.evalues = array('d')
+        self.best_log10_e = float('inf')
+        self.worst_log10_e = float('-inf')
+        # number of hits the last prune() kept
+        self.n_after_prune = 0
+        # number of hits add()ed, including any dropped by pruning
+        self.n_read = 0
+
+    def add(self, protein, evalue, max_delta_log10_e=None):
+        """
+        Add a hit. If max_delta_log10_e is specified, drop the hit if it's too far from the best hit.
+        Existing hits that a new best hit leaves too far behind are dropped lazily, once the hits have
+        doubled since the last prune, so hits arriving worst-first don't make adding quadratic.
+        Call finish() after the last hit to drop the rest
+        :param protein:
+        :param evalue:
+        :param max_delta_log10_e:
+        :return:
+        """
+        self.n_read += 1
+        log10_e = calc_log10_evalue(evalue)
+        if max_delta_log10_e is not None and log10_e - self.best_log10_e >= max_delta_log10_e:
+            return
+        self.proteins.append(protein)
+        self.evalues.append(evalue)
+        self.best_log10_e = min(self.best_log10_e, log10_e)
+        self.worst_log10_e = max(self.worst_log10_e, log10_e)
+        if max_delta_log10_e is not None and self.worst_log10_e - self.best_log10_e >= max_delta_log10_e and \
+                len(self.proteins) >= 2 * self.n_after_prune:
+            self.prune(max_delta_log10_e)
+
+    def finish(self, max_delta_log10_e=None):
+        """
+        Drop any hits left too far from the best hit by add()'s lazy pruning
+        :param max_delta_log10_e:
+        :return:
+        """
+        if max_delta_log10_e is not None and self.worst_log10_e - self.best_log10_e >= max_delta_log10_e:
+            self.prune(max_delta_log10_e)
+
+    def prune(self, max_delta_log10_e):
+        """
+        Drop all hits whose log10 e-value is max_delta_log10_e or more worse than the best hit
+        :param max_delta_log10_e:
+        :return:
+        """
+        kept_proteins = []
+        kept_evalues = array('d')
+        worst_log10_e = float('-inf')
+        for protein, evalue in izip(self.proteins, self.evalues):
+            log10_e = calc_log10_evalue(evalue)
+            if log10_e - self.best_log10_e < max_delta_log10_e:
+                kept_proteins.append(protein)
+                kept_evalues.append(evalue)
+                worst_log10_e = max(worst_log10_e, log10_e)
+        self.proteins = kept_proteins
+        self.evalues = kept_evalues
+        self.worst_log10_e = worst_log10_e
+        self.n_after_prune = len(kept_proteins)
+
+    def __len__(self):
+        return len(self.proteins)
+
+    def __getitem__(self, idx):
+        return self.proteins[idx], self.evalues[idx]
+
+    def __iter__(self):
+        return izip(self.proteins, self.evalues)
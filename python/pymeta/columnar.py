@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Write peptide LCAs in columnar form, as Parquet or Arrow IPC files. The lineage of each LCA is
+laid out as integer taxon ID columns and dictionary-encoded name columns, one pair per rank in
+pymeta.ncbi.RANKS, with the same column names as the tab-delimited output. Proteins and BLAST-hit
+proteins, if included, are list-of-string columns.
+Requires pyarrow.
+"""
+
+import logging
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pymeta.ncbi import RANKS
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ['parquet', 'arrow']
+
+# peptides per record batch (Parquet row group). Bounds the memory taken by the per-row columns
+DEFAULT_BATCH_ROWS = 100000
+
+NAME_TYPE = pa.dictionary(pa.int32(), pa.string())
+PROTEINS_TYPE = pa.list_(pa.string())
+
+
+class LineageColumns:
+    """
+    The lineage columns (taxon_id, taxon_name, taxon_rank, then ID and name for each rank) of a set
+    of distinct LCAs. Rows of the output pick out LCAs by index, so each lineage is only laid out once
+    """
+    def __init__(self):
+        self.lca_key_idx_map = {}
+        self.lca_taxa = []
+
+    def add_lca(self, taxon):
+        """
+        Get the index of an LCA, adding it if it's new
+        :param taxon:
+        :return:
+        """
+        lca_key = taxon.tostring('\t')
+        if lca_key not in self.lca_key_idx_map:
+            self.lca_key_idx_map[lca_key] = len(self.lca_taxa)
+            self.lca_taxa.append(taxon)
+        return self.lca_key_idx_map[lca_key]
+
+    def build(self):
+        """
+        Lay out the columns for all the LCAs added. Must be called after the last add_lca()
+        :return:
+        """
+        self.fields = [pa.field('taxon_id', pa.int32(), nullable=False),
+                       pa.field('taxon_name', NAME_TYPE),
+                       pa.field('taxon_rank', NAME_TYPE)]
+        self.column_values = [(np.array([taxon.id for taxon in self.lca_taxa], dtype=np.int32), None),
+                              self._encode_names([taxon.name for taxon in self.lca_taxa]),
+                              self._encode_names([taxon.rank for taxon in self.lca_taxa])]
+        for rank in RANKS:
+            rank_taxa = [taxon.rank_taxon_map.get(rank) for taxon in self.lca_taxa]
+            self.fields.append(pa.field(rank + '_id', pa.int32()))
+            self.fields.append(pa.field(rank + '_name', NAME_TYPE))
+            self.column_values.append((np.array([rank_taxon.id if rank_taxon else 0 for rank_taxon in rank_taxa],
+                                                dtype=np.int32),
+                                       np.array([rank_taxon is None for rank_taxon in rank_taxa], dtype=np.bool_)))
+            self.column_values.append(self._encode_names([rank_taxon.name if rank_taxon else None
+                                                          for rank_taxon in rank_taxa]))
+
+    def _encode_names(self, names):
+        """
+        Dictionary-encode a column of names
+        :param names: names, or None where missing
+        :return: (codes, dictionary). Codes are -1 where the name is missing
+        """
+        name_code_map = {}
+        dictionary = []
+        codes = np.empty(len(names), dtype=np.int32)
+        for i in xrange(0, len(names)):
+            if names[i] is None:
+                codes[i] = -1
+                continue
+            if names[i] not in name_code_map:
+                name_code_map[names[i]] = len(dictionary)
+                dictionary.append(names[i])
+            codes[i] = name_code_map[names[i]]
+        return codes, pa.array(dictionary, type=pa.string())
+
+    def make_arrays(self, lca_idxs):
+        """
+        The lineage columns for a batch of rows
+        :param lca_idxs: numpy array of the LCA index for each row
+        :return: list of pyarrow arrays
+        """
+        result = []
+        for field, (values, extra) in zip(self.fields, self.column_values):
+            if field.type == NAME_TYPE:
+                codes = values[lca_idxs]
+                result.append(pa.DictionaryArray.from_arrays(pa.array(codes, mask=codes < 0), extra))
+            elif extra is None:
+                result.append(pa.array(values[lca_idxs]))
+            else:
+                result.append(pa.array(values[lca_idxs], mask=extra[lca_idxs]))
+        return result
+
+
+def write_peptide_lcas_columnar(out_path, out_format, peptides, peptide_lca_map, peps_prots_map,
+                                peptide_protblasthits_map, include_protids, batch_rows=DEFAULT_BATCH_ROWS):
+    """
+    Columnar version of infer_taxa_withblast.write_peptide_lcas(). Peptides without LCAs are skipped
+    :param out_path:
+    :param out_format: 'parquet' or 'arrow'
+    :param peptides: the peptides to write, in order
+    :param peptide_lca_map:
+    :param peps_prots_map:
+    :param peptide_protblasthits_map:
+    :param include_protids: include list columns of the peptide's proteins and BLAST-hit proteins
+    :param batch_rows:
+    :return: the number of peptides written
+    """
+    assert(out_format in OUTPUT_FORMATS)
+    lineage_columns = LineageColumns()
+    peptides_towrite = [peptide for peptide in peptides if peptide in peptide_lca_map]
+    lca_idxs = np.array([lineage_columns.add_lca(peptide_lca_map[peptide]) for peptide in peptides_towrite],
+                        dtype=np.int32)
+    lineage_columns.build()
+    logger.debug("Writing %d peptides with %d distinct LCAs to %s" %
+                 (len(peptides_towrite), len(lineage_columns.lca_taxa), out_path))
+
+    fields = [pa.field('peptide', pa.string(), nullable=False)]
+    if include_protids:
+        fields.extend([pa.field('proteins', PROTEINS_TYPE), pa.field('blastproteins', PROTEINS_TYPE)])
+    fields.extend(lineage_columns.fields)
+    schema = pa.schema(fields)
+
+    if out_format == 'parquet':
+        writer = pq.ParquetWriter(out_path, schema)
+    else:
+        sink = pa.OSFile(out_path, 'wb')
+        writer = pa.ipc.RecordBatchFileWriter(sink, schema)
+    try:
+        for start in xrange(0, len(peptides_towrite), batch_rows):
+            batch_peptides = peptides_towrite[start:start + batch_rows]
+            arrays = [pa.array(batch_peptides, type=pa.string())]
+            if include_protids:
+                arrays.append(pa.array([peps_prots_map[peptide] for peptide in batch_peptides], type=PROTEINS_TYPE))
+                arrays.append(pa.array([sorted(peptide_protblasthits_map[peptide]) for peptide in batch_peptides],
+                                       type=PROTEINS_TYPE))
+            arrays.extend(lineage_columns.make_arrays(lca_idxs[start:start + batch_rows]))
+            batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+            if out_format == 'parquet':
+                writer.write_table(pa.Table.from_batches([batch], schema=schema))
+            else:
+                writer.write_batch(batch)
+    finally:
+        writer.close()
+        if out_format == 'arrow':
+            sink.close()
+    return len(peptides_towrite)
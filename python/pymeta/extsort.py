@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+External (out-of-core) sort of text lines: lines are buffered up to a memory ceiling, each full
+buffer is sorted and written to a temporary run file, and the runs are streamed back in order
+with a k-way merge.
+"""
+
+import heapq
+import logging
+import os
+import tempfile
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_MEMORY_BYTES = 1 << 30
+# rough memory cost of a buffered line beyond its characters: the str object header and the list slot
+LINE_OVERHEAD_BYTES = 48
+# most run files to merge at once. More runs than this are merged in several passes
+MAX_MERGE_FANIN = 256
+RUN_BUFFER_BYTES = 1 << 16
+
+
+class ExternalSorter:
+    """
+    Sorts lines that may not fit in memory. add() every line, then iterate over iter_sorted() once,
+    then close() to remove the temporary files
+    """
+    def __init__(self, max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES, tmpdir=None):
+        """
+        :param max_memory_bytes: approximate ceiling on the memory taken by buffered lines
+        :param tmpdir: directory for run files. Default: the system temporary directory
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.tmpdir = tmpdir
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.run_paths = []
+        self.n_lines = 0
+
+    def add(self, line):
+        """
+        Add a line. It must end with a newline
+        :param line:
+        :return:
+        """
+        self.buffer.append(line)
+        self.buffer_bytes += len(line) + LINE_OVERHEAD_BYTES
+        self.n_lines += 1
+        if self.buffer_bytes >= self.max_memory_bytes:
+            self._flush()
+
+    def _flush(self):
+        """
+        Sort the buffer and write it out as a run
+        :return:
+        """
+        self.buffer.sort()
+        self.run_paths.append(self._write_run(self.buffer))
+        logger.debug("Wrote sorted run %d of %d lines" % (len(self.run_paths), len(self.buffer)))
+        self.buffer = []
+        self.buffer_bytes = 0
+
+    def _write_run(self, lines):
+        fd, run_path = tempfile.mkstemp(suffix='.run', dir=self.tmpdir)
+        with os.fdopen(fd, 'w', RUN_BUFFER_BYTES) as run_file:
+            run_file.writelines(lines)
+        return run_path
+
+    def _merge_runs(self, run_paths):
+        """
+        Merge some runs into one new run, and remove them
+        :param run_paths:
+        :return: the path of the merged run
+        """
+        run_files = [open(run_path, 'r', RUN_BUFFER_BYTES) for run_path in run_paths]
+        try:
+            merged_path = self._write_run(heapq.merge(*run_files))
+        finally:
+            for run_file in run_files:
+                run_file.close()
+        for run_path in run_paths:
+            os.remove(run_path)
+        return merged_path
+
+    def iter_sorted(self):
+        """
+        Stream all the lines added, in sorted order
+        :return:
+        """
+        if not self.run_paths:
+            self.buffer.sort()
+            for line in self.buffer:
+                yield line
+            return
+        if self.buffer:
+            self._flush()
+        while len(self.run_paths) > MAX_MERGE_FANIN:
+            logger.debug("Merging %d runs in groups of %d" % (len(self.run_paths), MAX_MERGE_FANIN))
+            self.run_paths = [self._merge_runs(self.run_paths[i:i + MAX_MERGE_FANIN])
+                              for i in xrange(0, len(self.run_paths), MAX_MERGE_FANIN)]
+        logger.debug("Merging %d sorted runs of %d lines" % (len(self.run_paths), self.n_lines))
+        run_files = [open(run_path, 'r', RUN_BUFFER_BYTES) for run_path in self.run_paths]
+        try:
+            for line in heapq.merge(*run_files):
+                yield line
+        finally:
+            for run_file in run_files:
+                run_file.close()
+
+    def close(self):
+        """
+        Remove any run files
+        :return:
+        """
+        for run_path in self.run_paths:
+            if os.path.exists(run_path):
+                os.remove(run_path)
+        self.run_paths = []
+        self.buffer = []
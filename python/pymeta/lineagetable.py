@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+A compact, shareable table of validated taxon lineages, for inferring many LCAs in parallel.
+Each validated taxon is a row of NCBI taxon IDs, one column per rank in pymeta.ncbi.RANKS (0 where
+the lineage has no taxon at that rank). The table lives in shared memory, so worker processes
+forked to infer LCAs read it in place rather than each getting a pickled copy.
+"""
+
+import ctypes
+import logging
+import multiprocessing
+from multiprocessing import sharedctypes
+
+import numpy as np
+
+from pymeta import unipept
+from pymeta.ncbi import RANKS, Taxon
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+# number of distinct taxon sets handed to a worker at a time
+DEFAULT_CHUNK_SIZE = 2000
+
+# the lineage matrix, as seen by worker processes. Set just before the pool forks
+_worker_lineages = None
+
+
+def calc_common_rank_idxs(lineages, rows):
+    """
+    Find the ranks at which all the lineages in rows have the same taxon. This is the same test
+    unipept.infer_lca() does rank by rank
+    :param lineages: lineage matrix
+    :param rows: row indexes of the taxa
+    :return: a tuple of indexes into RANKS
+    """
+    row_lineages = lineages[rows]
+    first_lineage = row_lineages[0]
+    is_common = first_lineage != 0
+    if len(rows) > 1:
+        is_common &= (row_lineages == first_lineage).all(axis=0)
+    return tuple(np.flatnonzero(is_common).tolist())
+
+
+def _calc_common_rank_idxs_chunk(rowses):
+    """
+    Worker function: common ranks for a chunk of peptides, against the shared lineage matrix
+    :param rowses:
+    :return:
+    """
+    return [calc_common_rank_idxs(_worker_lineages, list(rows)) for rows in rowses]
+
+
+class LineageTable:
+    """
+    Validated lineages of a set of taxa, as a shared-memory matrix of taxon IDs
+    """
+    def __init__(self, taxonid_taxon_map):
+        """
+        Validate each taxon (once) and build the lineage matrix
+        :param taxonid_taxon_map: map from taxon ID to unvalidated Taxon, e.g., from unipept.taxonomy()
+        """
+        self.taxonid_row_map = {}
+        self.validated_taxa = []
+        for taxon_id in sorted(taxonid_taxon_map.keys()):
+            taxon = taxonid_taxon_map[taxon_id]
+            fixed_taxon = unipept.validate_rebuild_taxon(taxon)
+            if fixed_taxon:
+                self.taxonid_row_map[taxon_id] = len(self.validated_taxa)
+                self.validated_taxa.append(fixed_taxon)
+            else:
+                logger.debug("INVALID TAXON: %s,%s" % (taxon.rank, taxon.name))
+        n_ranks = len(RANKS)
+        self.shared_lineages = sharedctypes.RawArray(ctypes.c_int32, max(1, len(self.validated_taxa)) * n_ranks)
+        self.lineages = np.frombuffer(self.shared_lineages, dtype=np.int32).reshape(-1, n_ranks)
+        for row in xrange(0, len(self.validated_taxa)):
+            rank_taxon_map = self.validated_taxa[row].rank_taxon_map
+            for rank_idx in xrange(0, n_ranks):
+                if RANKS[rank_idx] in rank_taxon_map:
+                    self.lineages[row, rank_idx] = rank_taxon_map[RANKS[rank_idx]].id
+        self.lca_cache = {}
+
+    def calc_rows(self, taxon_ids):
+        """
+        Rows for the valid taxa among taxon_ids, in a deterministic order
+        :param taxon_ids:
+        :return:
+        """
+        return sorted([self.taxonid_row_map[taxon_id] for taxon_id in taxon_ids if taxon_id in self.taxonid_row_map])
+
+    def build_lca(self, first_row, common_rank_idxs):
+        """
+        Build the LCA Taxon from the common ranks of a set of lineages, one of which is first_row.
+        LCAs are cached, so peptides with the same LCA share one Taxon object
+        :param first_row:
+        :param common_rank_idxs:
+        :return:
+        """
+        if not common_rank_idxs:
+            return Taxon(1, "root", "no rank")
+        cache_key = tuple(self.lineages[first_row, list(common_rank_idxs)].tolist()) + common_rank_idxs
+        if cache_key not in self.lca_cache:
+            rank_taxon_map = self.validated_taxa[first_row].rank_taxon_map
+            lca = rank_taxon_map[RANKS[common_rank_idxs[-1]]]
+            result = Taxon(lca.id, lca.name, lca.rank)
+            result.rank_taxon_map = dict([(RANKS[rank_idx], rank_taxon_map[RANKS[rank_idx]])
+                                          for rank_idx in common_rank_idxs])
+            self.lca_cache[cache_key] = result
+        return self.lca_cache[cache_key]
+
+    def infer_lcas(self, peptide_taxonids_map, n_workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Infer the LCA of each peptide's valid taxa, partitioning the peptides across a pool of n_workers
+        processes. Peptides with the same valid taxa are inferred once. Results are merged in sorted
+        order, so they don't depend on scheduling
+        :param peptide_taxonids_map:
+        :param n_workers:
+        :param chunk_size: number of distinct taxon sets handed to a worker at a time
+        :return: a map from peptide to LCA Taxon, for peptides with at least one valid taxon
+        """
+        global _worker_lineages
+        rowstuple_peptides_map = {}
+        for peptide in peptide_taxonids_map:
+            rows = tuple(self.calc_rows(peptide_taxonids_map[peptide]))
+            if rows:
+                if rows not in rowstuple_peptides_map:
+                    rowstuple_peptides_map[rows] = []
+                rowstuple_peptides_map[rows].append(peptide)
+        rowses = sorted(rowstuple_peptides_map.keys())
+        chunks = [rowses[i:i + chunk_size] for i in xrange(0, len(rowses), chunk_size)]
+        logger.debug("Inferring LCAs for %d peptides (%d distinct taxon sets) in %d chunks on %d workers" %
+                     (sum(len(peptides) for peptides in rowstuple_peptides_map.values()), len(rowses), len(chunks),
+                      n_workers))
+        if n_workers > 1 and len(chunks) > 1:
+            _worker_lineages = self.lineages
+            pool = multiprocessing.Pool(n_workers)
+            try:
+                chunk_results = pool.map(_calc_common_rank_idxs_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+                _worker_lineages = None
+        else:
+            chunk_results = [[calc_common_rank_idxs(self.lineages, list(rows)) for rows in chunk] for chunk in chunks]
+        result = {}
+        i = 0
+        for chunk_result in chunk_results:
+            for common_rank_idxs in chunk_result:
+                lca = self.build_lca(rowses[i][0], common_rank_idxs)
+                for peptide in rowstuple_peptides_map[rowses[i]]:
+                    result[peptide] = lca
+                i += 1
+        return result
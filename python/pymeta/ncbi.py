@@ -152,8 +152,7 @@ def build_taxon_withpath(taxon_id, conn):
     for taxon in path_taxa:
         if taxon.id == taxon_id:
             result = taxon
-        else:
-            rank_taxon_map[taxon.rank] = taxon
+        rank_taxon_map[taxon.rank] = taxon
     result.rank_taxon_map = rank_taxon_map
     return result
 
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+A pre-built, memory-mapped peptide -> protein index, converted once from a tide index export
+(tab-delimited, with 'sequence' and 'protein id' columns). The index is a directory of numpy arrays:
+sorted peptides, offsets of each peptide's proteins into an int32 protein ID array, and a table of
+protein names. Looking up a set of peptides touches only the parts of the index those peptides
+need, so it costs time proportional to the query, not to the size of the index.
+"""
+
+import csv
+import json
+import logging
+import os
+
+import numpy as np
+
+from pymeta import stagecache
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+PEPTIDES_FILENAME = 'peptides.npy'
+OFFSETS_FILENAME = 'offsets.npy'
+PROTEIN_IDS_FILENAME = 'protein_ids.npy'
+PROTEINS_FILENAME = 'proteins.npy'
+# written last, so its presence means the index is complete
+META_FILENAME = 'meta.json'
+
+
+def build_index(pepprot_file, index_dir):
+    """
+    Convert a tide index export into an index directory
+    :param pepprot_file:
+    :param index_dir:
+    :return: the number of peptides indexed
+    """
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    protein_id_map = {}
+    proteins = []
+    peptide_proteinids_map = {}
+    for row in csv.DictReader(pepprot_file, delimiter='\t'):
+        protein_ids = []
+        for protstr in row['protein id'].split(';'):
+            protein = protstr.strip()
+            if protein not in protein_id_map:
+                protein_id_map[protein] = len(proteins)
+                proteins.append(protein)
+            protein_ids.append(protein_id_map[protein])
+        peptide_proteinids_map[row['sequence']] = protein_ids
+    logger.debug("Read %d peptides and %d proteins" % (len(peptide_proteinids_map), len(proteins)))
+
+    peptides = sorted(peptide_proteinids_map.keys())
+    offsets = np.zeros(len(peptides) + 1, dtype=np.int64)
+    for i in xrange(0, len(peptides)):
+        offsets[i + 1] = offsets[i] + len(peptide_proteinids_map[peptides[i]])
+    protein_ids = np.empty(offsets[-1], dtype=np.int32)
+    for i in xrange(0, len(peptides)):
+        protein_ids[offsets[i]:offsets[i + 1]] = peptide_proteinids_map[peptides[i]]
+    # numpy can't tell a missing fixed-width string from an empty one, so give it a width of at least 1
+    np.save(os.path.join(index_dir, PEPTIDES_FILENAME), np.array(peptides, dtype=np.string_) if peptides
+            else np.array([], dtype='S1'))
+    np.save(os.path.join(index_dir, OFFSETS_FILENAME), offsets)
+    np.save(os.path.join(index_dir, PROTEIN_IDS_FILENAME), protein_ids)
+    np.save(os.path.join(index_dir, PROTEINS_FILENAME), np.array(proteins, dtype=np.string_) if proteins
+            else np.array([], dtype='S1'))
+    with open(os.path.join(index_dir, META_FILENAME), 'w') as meta_file:
+        json.dump({'format_version': FORMAT_VERSION,
+                   'n_peptides': len(peptides),
+                   'n_proteins': len(proteins),
+                   'source_name': getattr(pepprot_file, 'name', None),
+                   'source_digest': calc_source_digest(pepprot_file)}, meta_file, indent=2, sort_keys=True)
+    return len(peptides)
+
+
+def calc_source_digest(pepprot_file):
+    """
+    Digest of the file an index is built from. Same as stagecache.StageCache.file_digest(), so runs with
+    the index share cache entries with runs that read the file itself
+    :param pepprot_file:
+    :return: the digest, or None if the file isn't a regular file (e.g., stdin)
+    """
+    path = getattr(pepprot_file, 'name', None)
+    if not path or not os.path.isfile(path):
+        return None
+    return stagecache.digest_file(path)
+
+
+class PepProtIndex:
+    """
+    A peptide -> protein index directory written by build_index(), memory-mapped
+    """
+    def __init__(self, index_dir):
+        meta_path = os.path.join(index_dir, META_FILENAME)
+        if not os.path.exists(meta_path):
+            raise ValueError('%s is not a complete peptide-protein index' % index_dir)
+        with open(meta_path) as meta_file:
+            self.meta = json.load(meta_file)
+        if self.meta['format_version'] != FORMAT_VERSION:
+            raise ValueError('Peptide-protein index %s has format version %d, expected %d' %
+                             (index_dir, self.meta['format_version'], FORMAT_VERSION))
+        # SHA-1 of the tide index export the index was built from, or None if it couldn't be hashed
+        self.source_digest = self.meta['source_digest'] and str(self.meta['source_digest'])
+        self.peptides = np.load(os.path.join(index_dir, PEPTIDES_FILENAME), mmap_mode='r')
+        self.offsets = np.load(os.path.join(index_dir, OFFSETS_FILENAME), mmap_mode='r')
+        self.protein_ids = np.load(os.path.join(index_dir, PROTEIN_IDS_FILENAME), mmap_mode='r')
+        self.proteins = np.load(os.path.join(index_dir, PROTEINS_FILENAME), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.peptides)
+
+    def lookup(self, pepseqs):
+        """
+        Indexed version of infer_taxa_withblast.load_pep_prots_maps(): the proteins of each peptide in
+        pepseqs that's in the index
+        :param pepseqs:
+        :return: map from peptide to list of proteins, map from protein to list of peptides
+        """
+        # longer peptides can't be in the index, and would be truncated to fit the array
+        query_peptides = sorted([peptide for peptide in pepseqs if len(peptide) <= self.peptides.itemsize])
+        peps_prots_map = {}
+        prots_peps_map = {}
+        if not query_peptides or len(self.peptides) == 0:
+            return peps_prots_map, prots_peps_map
+        query_array = np.array(query_peptides, dtype=self.peptides.dtype)
+        positions = np.searchsorted(self.peptides, query_array)
+        clipped_positions = np.minimum(positions, len(self.peptides) - 1)
+        found_idxs = np.flatnonzero((positions < len(self.peptides)) &
+                                    (self.peptides[clipped_positions] == query_array))
+        found_positions = positions[found_idxs]
+        starts = self.offsets[found_positions]
+        ends = self.offsets[found_positions + 1]
+        peptide_proteinids = [self.protein_ids[start:end] for start, end in zip(starts, ends)]
+        # only decode the names of the proteins we need
+        protein_name_map = {}
+        if peptide_proteinids:
+            needed_protein_ids = np.unique(np.concatenate(peptide_proteinids))
+            protein_name_map = dict(zip(needed_protein_ids.tolist(), self.proteins[needed_protein_ids].tolist()))
+        for found_idx, protein_ids in zip(found_idxs, peptide_proteinids):
+            pepseq = query_peptides[found_idx]
+            proteins = [protein_name_map[protein_id] for protein_id in protein_ids.tolist()]
+            peps_prots_map[pepseq] = proteins
+            for protein in proteins:
+                if protein not in prots_peps_map:
+                    prots_peps_map[protein] = []
+                prots_peps_map[protein].append(pepseq)
+        logger.debug("lookup: %d of %d peptides found in index of %d" %
+                     (len(peps_prots_map), len(query_peptides), len(self.peptides)))
+        return peps_prots_map, prots_peps_map
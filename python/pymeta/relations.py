@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+Integer-encoded sparse-matrix representation of the peptide -> protein -> BLAST hit -> taxon relations.
+Identifiers are interned to consecutive integers and each relation is a boolean SciPy CSR matrix,
+so the whole chain can be joined with sparse matrix products instead of nested Python loops.
+"""
+
+import logging
+
+import numpy as np
+from scipy import sparse
+
+from pymeta import blast
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+
+class IdInterner:
+    """
+    Assigns consecutive integer IDs to identifiers, in order of first appearance
+    """
+    def __init__(self):
+        self.name_id_map = {}
+        self.names = []
+
+    def intern(self, name):
+        """
+        Get the integer ID for name, assigning one if this is the first time we've seen it
+        :param name:
+        :return:
+        """
+        if name not in self.name_id_map:
+            self.name_id_map[name] = len(self.names)
+            self.names.append(name)
+        return self.name_id_map[name]
+
+    def __len__(self):
+        return len(self.names)
+
+
+def build_bool_csr(row_ids, col_ids, n_rows, n_cols):
+    """
+    Build a boolean CSR matrix with True at each (row_ids[i], col_ids[i])
+    :param row_ids:
+    :param col_ids:
+    :param n_rows:
+    :param n_cols:
+    :return:
+    """
+    data = np.ones(len(row_ids), dtype=np.bool_)
+    result = sparse.csr_matrix((data, (np.asarray(row_ids, dtype=np.int32), np.asarray(col_ids, dtype=np.int32))),
+                               shape=(n_rows, n_cols), dtype=np.bool_)
+    # duplicate entries are summed on conversion. For booleans that's an OR, which is what we want
+    result.sum_duplicates()
+    return result
+
+
+def decode_rows(matrix, row_interner, col_interner):
+    """
+    Turn the nonempty rows of a CSR matrix back into a map from row name to set of column names
+    :param matrix:
+    :param row_interner:
+    :param col_interner:
+    :return:
+    """
+    result = {}
+    indptr = matrix.indptr
+    indices = matrix.indices
+    col_names = col_interner.names
+    for row_id in np.flatnonzero(np.diff(indptr)):
+        result[row_interner.names[row_id]] = set([col_names[col_id]
+                                                  for col_id in indices[indptr[row_id]:indptr[row_id + 1]]])
+    return result
+
+
+def associate_peptides_blasthits_taxa(pepseqs, peps_prots_map, bait_matches_evalues_map, blastprotein_taxonid_map,
+                                      max_blast_delta_log10_e):
+    """
+    Sparse-matrix version of infer_taxa_withblast.associate_peptides_blasthits_taxa(), with the same
+    filters and results. Peptide -> hit and peptide -> taxon relations are computed as boolean
+    products of the peptide x bait, bait x hit and hit x taxon matrices.
+    :param pepseqs:
+    :param peps_prots_map:
+    :param bait_matches_evalues_map:
+    :param blastprotein_taxonid_map:
+    :param max_blast_delta_log10_e:
+    :return: a map from peptide to set of blast-hit proteins, for peptides with any of their proteins in the BLAST
+    results, and a map from peptide to set of taxon IDs, for peptides with at least one taxon
+    """
+    bait_blasthits_map = blast.calc_bait_delta_filtered_hits(bait_matches_evalues_map, max_blast_delta_log10_e)
+
+    peptides = IdInterner()
+    baits = IdInterner()
+    hits = IdInterner()
+    taxa = IdInterner()
+
+    pep_rows = []
+    bait_cols = []
+    for peptide in pepseqs:
+        if peptide not in peps_prots_map:
+            continue
+        for protein in peps_prots_map[peptide]:
+            if protein in bait_blasthits_map:
+                pep_rows.append(peptides.intern(peptide))
+                bait_cols.append(baits.intern(protein))
+
+    bait_rows = []
+    hit_cols = []
+    for bait_id in xrange(0, len(baits)):
+        for blasthit in bait_blasthits_map[baits.names[bait_id]]:
+            bait_rows.append(bait_id)
+            hit_cols.append(hits.intern(blasthit))
+
+    hit_rows = []
+    taxon_cols = []
+    for hit_id in xrange(0, len(hits)):
+        blasthit = hits.names[hit_id]
+        if blasthit in blastprotein_taxonid_map:
+            hit_rows.append(hit_id)
+            taxon_cols.append(taxa.intern(blastprotein_taxonid_map[blasthit]))
+
+    pep_bait_matrix = build_bool_csr(pep_rows, bait_cols, len(peptides), len(baits))
+    bait_hit_matrix = build_bool_csr(bait_rows, hit_cols, len(baits), len(hits))
+    hit_taxon_matrix = build_bool_csr(hit_rows, taxon_cols, len(hits), len(taxa))
+    logger.debug("Sparse matrices: %d peptides x %d baits (%d), %d hits (%d), %d taxa (%d)" %
+                 (len(peptides), len(baits), pep_bait_matrix.nnz, len(hits), bait_hit_matrix.nnz,
+                  len(taxa), hit_taxon_matrix.nnz))
+
+    pep_hit_matrix = (pep_bait_matrix * bait_hit_matrix).tocsr()
+    pep_taxon_matrix = (pep_hit_matrix * hit_taxon_matrix).tocsr()
+    pep_hit_matrix.eliminate_zeros()
+    pep_taxon_matrix.eliminate_zeros()
+    return decode_rows(pep_hit_matrix, peptides, hits), decode_rows(pep_taxon_matrix, peptides, taxa)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+On-disk cache of pipeline stage outputs, keyed by a hash of each stage's inputs and parameters.
+Input files are identified by a hash of their content, so an unchanged stage is reused no matter
+where its inputs live, and a changed input invalidates exactly the stages downstream of it.
+"""
+
+import cPickle
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+# file in the cache directory that remembers file content digests by path, size and mtime,
+# so that big input files are only hashed once
+DIGESTS_FILENAME = 'file_digests.json'
+
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def digest_strings(strings):
+    """
+    Order-independent digest of a collection of strings, e.g., a set of peptides
+    :param strings:
+    :return:
+    """
+    hasher = hashlib.sha1()
+    for string in sorted(strings):
+        hasher.update(string)
+        hasher.update('\n')
+    return hasher.hexdigest()
+
+
+def digest_file(path):
+    """
+    SHA-1 of a file's raw bytes. For a compressed file, that's the compressed bytes
+    :param path:
+    :return:
+    """
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        while True:
+            chunk = infile.read(HASH_CHUNK_BYTES)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class StageCache:
+    """
+    A directory of pickled stage outputs
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.digests_path = os.path.join(cache_dir, DIGESTS_FILENAME)
+        self.file_digests = {}
+        if os.path.exists(self.digests_path):
+            with open(self.digests_path) as digests_file:
+                self.file_digests = json.load(digests_file)
+
+    def file_digest(self, fileobj):
+        """
+        SHA-1 of a file's raw bytes, as in digest_file(). The file is left rewound to the start. Digests are
+        remembered by (path, inode, size, mtime), so an unchanged file isn't re-read on the next run. The mtime is
+        kept at full precision, so a file rewritten within the same second at the same size is re-read
+        :param fileobj:
+        :return: the hex digest, or None if fileobj isn't a regular file (e.g., stdin), and so can't be cached
+        """
+        try:
+            path = os.path.realpath(fileobj.name)
+            stat = os.fstat(fileobj.fileno())
+            fileobj.seek(0)
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+        memo_key = "%s:%d:%d:%r" % (path, stat.st_ino, stat.st_size, stat.st_mtime)
+        if memo_key not in self.file_digests:
+            logger.debug("Hashing %s" % path)
+            self.file_digests[memo_key] = digest_file(path)
+            self._write_atomically(self.digests_path, lambda outfile: json.dump(self.file_digests, outfile))
+        return self.file_digests[memo_key]
+
+    def make_key(self, key_parts):
+        """
+        Hash the inputs and parameters of a stage into a cache key
+        :param key_parts: list of strings and numbers. If any is None, the stage can't be cached
+        :return: the key, or None
+        """
+        if any(part is None for part in key_parts):
+            return None
+        return hashlib.sha1(repr([str(part) for part in key_parts])).hexdigest()
+
+    def get_or_compute(self, stage_name, key_parts, compute_function):
+        """
+        Return the cached output of a stage, if present. Otherwise compute it and cache it
+        :param stage_name:
+        :param key_parts: the stage's inputs and parameters
+        :param compute_function: no-argument function that computes the stage output
+        :return:
+        """
+        key = self.make_key(key_parts)
+        if key is None:
+            logger.debug("Stage %s has uncacheable inputs" % stage_name)
+            return compute_function()
+        path = self._make_path(stage_name, key)
+        if os.path.exists(path):
+            logger.info("Reusing cached %s (%s)" % (stage_name, key[:12]))
+            return self._load(path)
+        result = compute_function()
+        self._save(path, result)
+        return result
+
+    def get_or_compute_items(self, stage_name, key_parts, items, compute_function):
+        """
+        Incremental version of get_or_compute() for stages that map independent items to values.
+        Only the items that aren't already cached are computed. Items whose value is None
+        (e.g., a taxon Unipept doesn't know) are cached as missing and left out of the result
+        :param stage_name:
+        :param key_parts: the stage's inputs and parameters, not including the items
+        :param items:
+        :param compute_function: function from a list of items to a map from item to value
+        :return: map from item to value
+        """
+        key = self.make_key(key_parts)
+        if key is None:
+            return compute_function(list(items))
+        path = self._make_path(stage_name, key)
+        item_value_map = {}
+        if os.path.exists(path):
+            item_value_map = self._load(path)
+        items_tocompute = [item for item in items if item not in item_value_map]
+        logger.info("%s: %d of %d items cached" % (stage_name, len(items) - len(items_tocompute), len(items)))
+        if items_tocompute:
+            computed_map = compute_function(items_tocompute)
+            for item in items_tocompute:
+                item_value_map[item] = computed_map.get(item)
+            self._save(path, item_value_map)
+        result = {}
+        for item in items:
+            if item_value_map[item] is not None:
+                result[item] = item_value_map[item]
+        return result
+
+    def get_items(self, stage_name, key_parts):
+        """
+        What an item-wise stage has cached so far, without computing anything
+        :param stage_name:
+        :param key_parts:
+        :return: map from item to value, with None for items cached as missing
+        """
+        key = self.make_key(key_parts)
+        if key is None:
+            return {}
+        path = self._make_path(stage_name, key)
+        if not os.path.exists(path):
+            return {}
+        return self._load(path)
+
+    def _make_path(self, stage_name, key):
+        return os.path.join(self.cache_dir, "%s-%s.pickle" % (stage_name, key))
+
+    def _load(self, path):
+        with open(path, 'rb') as infile:
+            return cPickle.load(infile)
+
+    def _save(self, path, value):
+        self._write_atomically(path, lambda outfile: cPickle.dump(value, outfile, cPickle.HIGHEST_PROTOCOL))
+
+    def _write_atomically(self, path, write_function):
+        """
+        Write to a temporary file and rename it into place, so a crash can't leave a partial cache entry
+        :param path:
+        :param write_function:
+        :return:
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as outfile:
+            write_function(outfile)
+        os.rename(tmp_path, path)
+
+
+def cached(cache, stage_name, key_parts, compute_function):
+    """
+    Run a stage through the cache, or directly if there is no cache
+    :param cache: a StageCache, or None
+    :param stage_name:
+    :param key_parts:
+    :param compute_function:
+    :return:
+    """
+    if cache is None:
+        return compute_function()
+    return cache.get_or_compute(stage_name, key_parts, compute_function)
+
+
+def cached_items(cache, stage_name, key_parts, items, compute_function):
+    """
+    Run an item-wise stage through the cache, or directly if there is no cache
+    :param cache: a StageCache, or None
+    :param stage_name:
+    :param key_parts:
+    :param items:
+    :param compute_function:
+    :return:
+    """
+    if cache is None:
+        return compute_function(list(items))
+    return cache.get_or_compute_items(stage_name, key_parts, items, compute_function)
+
+
+def cached_item_map(cache, stage_name, key_parts):
+    """
+    What an item-wise stage has cached so far
+    :param cache: a StageCache, or None
+    :param stage_name:
+    :param key_parts:
+    :return: map from item to value, with None for items cached as missing. Empty if there is no cache
+    """
+    if cache is None:
+        return {}
+    return cache.get_items(stage_name, key_parts)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Sweep the BLAST e-value thresholds (maximum e-value, and maximum log10 e-value difference from the
+bait's best hit) in one pass. Each bait's hits are sorted by e-value once. Either threshold keeps a
+prefix of that sorted list, and widening the thresholds only ever lengthens the prefix, so each
+threshold's taxon sets and LCAs are built from the previous threshold's by adding the newly kept
+hits. Only the peptides whose taxon sets grew need new LCAs.
+Peptides are handled in classes of peptides with the same set of baits, as in
+infer_taxa_withblast.associate_peptides_blasthits_taxa().
+"""
+
+import logging
+
+import numpy as np
+
+from pymeta.blast import calc_log10_evalues
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+
+class BaitSetClass:
+    """
+    Peptides that map to the same set of baits, and the hits and taxa they have at the current threshold
+    """
+    __slots__ = ('peptides', 'protblasthits', 'taxon_ids', 'lca')
+
+    def __init__(self, peptides):
+        self.peptides = peptides
+        self.reset()
+
+    def reset(self):
+        self.protblasthits = frozenset()
+        self.taxon_ids = frozenset()
+        self.lca = None
+
+
+class SweepResult:
+    """
+    Peptide hits, taxa and LCAs at one threshold
+    """
+    def __init__(self, max_e, max_delta_log10_e, peptide_protblasthits_map, peptide_taxonids_map,
+                 peptide_lca_map):
+        self.max_e = max_e
+        self.max_delta_log10_e = max_delta_log10_e
+        self.peptide_protblasthits_map = peptide_protblasthits_map
+        self.peptide_taxonids_map = peptide_taxonids_map
+        self.peptide_lca_map = peptide_lca_map
+
+    def calc_rank_counts(self):
+        """
+        :return: map from rank to the number of peptides with an LCA at that rank
+        """
+        rank_count_map = {}
+        for lca in self.peptide_lca_map.values():
+            if lca.rank not in rank_count_map:
+                rank_count_map[lca.rank] = 0
+            rank_count_map[lca.rank] += 1
+        return rank_count_map
+
+
+class ThresholdSweep:
+    """
+    Incremental association of peptides with BLAST hits, taxa and LCAs over a series of thresholds
+    """
+    def __init__(self, pepseqs, peps_prots_map, bait_hits_map, blastprotein_taxonid_map):
+        """
+        :param pepseqs:
+        :param peps_prots_map:
+        :param bait_hits_map: map from bait protein to BaitHits, loaded with the widest thresholds
+        :param blastprotein_taxonid_map:
+        """
+        self.blastprotein_taxonid_map = blastprotein_taxonid_map
+        self.baits = sorted([bait for bait in bait_hits_map if len(bait_hits_map[bait]) > 0])
+        bait_idx_map = dict((bait, i) for i, bait in enumerate(self.baits))
+        # each bait's hits, sorted by e-value, laid end to end
+        self.bait_hit_proteins = []
+        lengths = np.array([len(bait_hits_map[bait]) for bait in self.baits], dtype=np.int64)
+        self.starts = np.zeros(len(self.baits), dtype=np.int64)
+        if len(self.baits) > 0:
+            self.starts[1:] = np.cumsum(lengths)[:-1]
+        evalue_arrays = []
+        for bait in self.baits:
+            bait_hits = bait_hits_map[bait]
+            bait_evalues = np.frombuffer(bait_hits.evalues, dtype=np.float64)
+            order = np.argsort(bait_evalues, kind='mergesort')
+            self.bait_hit_proteins.append([bait_hits.proteins[j] for j in order])
+            evalue_arrays.append(bait_evalues[order])
+        self.all_evalues = np.concatenate(evalue_arrays) if evalue_arrays else np.zeros(0)
+        # log10 e-value of each hit minus that of its bait's best hit, computed just as
+        # blast.calc_bait_delta_filtered_hits() and BaitHits pruning compute it
+        all_log10_evalues = calc_log10_evalues(self.all_evalues)
+        self.all_delta_log10_evalues = all_log10_evalues - np.repeat(all_log10_evalues[self.starts], lengths) \
+            if len(self.baits) > 0 else all_log10_evalues
+
+        baitset_peptides_map = {}
+        for peptide in pepseqs:
+            if peptide not in peps_prots_map:
+                continue
+            baits_this_peptide = frozenset([protein for protein in peps_prots_map[peptide]
+                                            if protein in bait_idx_map])
+            if not baits_this_peptide:
+                continue
+            if baits_this_peptide not in baitset_peptides_map:
+                baitset_peptides_map[baits_this_peptide] = []
+            baitset_peptides_map[baits_this_peptide].append(peptide)
+        self.classes = []
+        self.bait_classes = [[] for bait in self.baits]
+        for baitset, peptides in baitset_peptides_map.iteritems():
+            peptide_class = BaitSetClass(peptides)
+            self.classes.append(peptide_class)
+            for bait in baitset:
+                self.bait_classes[bait_idx_map[bait]].append(peptide_class)
+        self.hit_counts = np.zeros(len(self.baits), dtype=np.int64)
+        logger.debug("ThresholdSweep: %d baits, %d hits, %d peptide classes" %
+                     (len(self.baits), len(self.all_evalues), len(self.classes)))
+
+    def calc_hit_counts(self, max_e, max_delta_log10_e):
+        """
+        The number of each bait's sorted hits kept at a threshold
+        :param max_e:
+        :param max_delta_log10_e:
+        :return: array with the number of hits kept for each bait
+        """
+        if len(self.baits) == 0:
+            return np.zeros(0, dtype=np.int64)
+        keep_mask = (self.all_evalues <= max_e) & (self.all_delta_log10_evalues < max_delta_log10_e)
+        return np.add.reduceat(keep_mask.astype(np.int64), self.starts)
+
+    def calc_taxon_ids(self, max_e, max_delta_log10_e):
+        """
+        All the taxa of hits kept at a threshold. At the widest threshold, that's every taxon the sweep needs
+        :param max_e:
+        :param max_delta_log10_e:
+        :return:
+        """
+        taxon_ids = set()
+        for i, hit_count in enumerate(self.calc_hit_counts(max_e, max_delta_log10_e)):
+            for protein in self.bait_hit_proteins[i][:hit_count]:
+                if protein in self.blastprotein_taxonid_map:
+                    taxon_ids.add(self.blastprotein_taxonid_map[protein])
+        return taxon_ids
+
+    def iter_results(self, thresholds, infer_lca):
+        """
+        Sweep the thresholds. Narrower thresholds come first. If a threshold keeps fewer hits of some bait
+        than the one before it (e.g., a larger max e-value with a smaller max delta), the sweep starts over
+        from nothing for that threshold
+        :param thresholds: list of (max e-value, max delta log10 e-value) pairs
+        :param infer_lca: function from a frozenset of taxon IDs to their LCA Taxon, or None. Called once
+                          per distinct taxon set over the whole sweep
+        :return: an iterator over a SweepResult for each threshold. Each result's maps are built fresh
+        """
+        taxonids_lca_map = {}
+        for max_e, max_delta_log10_e in sorted(thresholds):
+            hit_counts = self.calc_hit_counts(max_e, max_delta_log10_e)
+            if (hit_counts < self.hit_counts).any():
+                logger.debug("Threshold %g, %g keeps fewer hits than the last. Starting over" %
+                             (max_e, max_delta_log10_e))
+                for peptide_class in self.classes:
+                    peptide_class.reset()
+                self.hit_counts = np.zeros(len(self.baits), dtype=np.int64)
+            changed_classes = set()
+            for i in np.flatnonzero(hit_counts > self.hit_counts):
+                new_hits = self.bait_hit_proteins[i][self.hit_counts[i]:hit_counts[i]]
+                new_taxon_ids = frozenset([self.blastprotein_taxonid_map[protein] for protein in new_hits
+                                           if protein in self.blastprotein_taxonid_map])
+                for peptide_class in self.bait_classes[i]:
+                    peptide_class.protblasthits = peptide_class.protblasthits.union(new_hits)
+                    if not new_taxon_ids.issubset(peptide_class.taxon_ids):
+                        peptide_class.taxon_ids = peptide_class.taxon_ids.union(new_taxon_ids)
+                        changed_classes.add(peptide_class)
+            self.hit_counts = hit_counts
+            for peptide_class in changed_classes:
+                if peptide_class.taxon_ids not in taxonids_lca_map:
+                    taxonids_lca_map[peptide_class.taxon_ids] = infer_lca(peptide_class.taxon_ids)
+                peptide_class.lca = taxonids_lca_map[peptide_class.taxon_ids]
+            logger.debug("Threshold %g, %g: %d peptide classes changed, %d distinct taxon sets so far" %
+                         (max_e, max_delta_log10_e, len(changed_classes), len(taxonids_lca_map)))
+
+            peptide_protblasthits_map = {}
+            peptide_taxonids_map = {}
+            peptide_lca_map = {}
+            for peptide_class in self.classes:
+                if not peptide_class.protblasthits:
+                    continue
+                for peptide in peptide_class.peptides:
+                    peptide_protblasthits_map[peptide] = peptide_class.protblasthits
+                    if peptide_class.taxon_ids:
+                        peptide_taxonids_map[peptide] = peptide_class.taxon_ids
+                    if peptide_class.lca:
+                        peptide_lca_map[peptide] = peptide_class.lca
+            yield SweepResult(max_e, max_delta_log10_e, peptide_protblasthits_map, peptide_taxonids_map,
+                              peptide_lca_map)
@@ -3,10 +3,13 @@
 parse unipept results
 """
 
+import Queue
 import csv
 import json
 import logging
 import re
+import threading
+import time
 
 import requests
 # requests gets really annoying otherwise
@@ -67,6 +70,9 @@ INVALID_TAXON_IDS = [
 
 DEFAULT_TAXONOMY_BATCH_SIZE = 500
 
+# One (endpoint, seconds, number of inputs) tuple per call to the Unipept API, for instrumentation
+http_call_log = []
+
 RANK_FIELDS = []
 for rank in RANKS:
     RANK_FIELDS.extend([rank + '_id', rank + '_name'])
@@ -97,6 +103,86 @@ def taxonomy(taxon_ids, batch_size=DEFAULT_TAXONOMY_BATCH_SIZE,
     return result
 
 
+class TaxonomyPrefetcher:
+    """
+    Fetches taxa from the taxonomy API on a background thread as their IDs are added, in batches, so that
+    the network calls overlap with whatever the caller does in the meantime. get() waits for the taxa
+    asked for. Acts like taxonomy() otherwise
+    """
+    def __init__(self, batch_size=DEFAULT_TAXONOMY_BATCH_SIZE, validate=True):
+        self.batch_size = batch_size
+        self.validate = validate
+        self.requested_taxon_ids = set()
+        self.pending_taxon_ids = []
+        self.taxonid_taxon_map = {}
+        self.error = None
+        self.batch_queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._fetch_batches, name='unipept-prefetch')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, taxon_id):
+        """
+        Request a taxon. Taxa already requested are ignored
+        :param taxon_id:
+        :return:
+        """
+        if taxon_id in self.requested_taxon_ids:
+            return
+        self.requested_taxon_ids.add(taxon_id)
+        self.pending_taxon_ids.append(taxon_id)
+        if len(self.pending_taxon_ids) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Send off the partial batch of requested taxa
+        :return:
+        """
+        if self.pending_taxon_ids:
+            self.batch_queue.put(self.pending_taxon_ids)
+            self.pending_taxon_ids = []
+
+    def get(self, taxon_ids):
+        """
+        Fetch any of taxon_ids not already requested, and wait for all requests to finish.
+        Raises the first error from the background thread, if any
+        :param taxon_ids:
+        :return: a map from ids to taxa, for the taxa Unipept returned
+        """
+        for taxon_id in taxon_ids:
+            self.add(taxon_id)
+        self.flush()
+        self.batch_queue.join()
+        if self.error:
+            raise self.error
+        return dict([(taxon_id, self.taxonid_taxon_map[taxon_id]) for taxon_id in taxon_ids
+                     if taxon_id in self.taxonid_taxon_map])
+
+    def close(self):
+        """
+        Stop the background thread once it's done with the requests so far
+        :return:
+        """
+        self.batch_queue.put(None)
+        self.thread.join()
+
+    def _fetch_batches(self):
+        while True:
+            batch = self.batch_queue.get()
+            try:
+                if batch is None:
+                    return
+                if self.error:
+                    continue
+                logger.debug("Prefetching batch of %d taxa" % len(batch))
+                self.taxonid_taxon_map.update(taxonomy_onebatch(batch, validate=self.validate))
+            except Exception as e:
+                self.error = e
+            finally:
+                self.batch_queue.task_done()
+
+
 def taxonomy_onebatch(taxon_ids, validate=True):
     """
     Call the Unipept taxonomy API. Return a map from ids to taxa
@@ -109,9 +195,7 @@ def taxonomy_onebatch(taxon_ids, validate=True):
     params_list.append('extra=true')
     params_list.append('names=true')
     params = '&'.join(params_list)
-    r = requests.post(
-        'http://api.unipept.ugent.be/api/v1/taxonomy.json',
-        params=params)
+    r = post_unipept('http://api.unipept.ugent.be/api/v1/taxonomy.json', params, len(taxon_ids))
     data = None
     try:
         data = byteify(json.loads(r.text))
@@ -143,6 +227,35 @@ def taxonomy_onebatch(taxon_ids, validate=True):
     return result
 
 
+def post_unipept(url, params, n_inputs):
+    """
+    POST to the Unipept API, logging the call's latency in http_call_log
+    :param url:
+    :param params:
+    :param n_inputs: number of inputs in the request
+    :return: the response
+    """
+    start_time = time.time()
+    r = requests.post(url, params=params)
+    http_call_log.append((url, time.time() - start_time, n_inputs))
+    return r
+
+
+def summarize_http_calls():
+    """
+    Summarize http_call_log by endpoint
+    :return: a map from endpoint URL to a dict with the number of calls, number of inputs and the latencies
+    """
+    result = {}
+    for url, secs, n_inputs in http_call_log:
+        if url not in result:
+            result[url] = {'n_calls': 0, 'n_inputs': 0, 'latencies_secs': []}
+        result[url]['n_calls'] += 1
+        result[url]['n_inputs'] += n_inputs
+        result[url]['latencies_secs'].append(secs)
+    return result
+
+
 def taxa2lca(taxon_ids):
     """
     Call the Unipept taxa2lca api
@@ -155,9 +268,7 @@ def taxa2lca(taxon_ids):
     params_list.append('extra=true')
     params_list.append('names=true')
     params = '&'.join(params_list)
-    r = requests.post(
-        'http://api.unipept.ugent.be/api/v1/taxa2lca',
-        params=params)
+    r = post_unipept('http://api.unipept.ugent.be/api/v1/taxa2lca', params, len(taxon_ids))
     data = byteify(json.loads(r.text))
     return parse_taxon_info_map(data)
 
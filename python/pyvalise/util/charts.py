@@ -7,6 +7,10 @@ import matplotlib
 # so that I can run without X
 matplotlib.use('Agg')
 import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
 from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
 from statsmodels.graphics import gofplots
@@ -31,6 +35,11 @@ ALPHA_FOR_MULTISCATTER = 0.85
 
 DEFAULT_POINTSIZE = 1
 
+# scatter charts with more points than this are drawn as a binned density image, not point by point
+DEFAULT_DENSITY_THRESHOLD_POINTS = 100000
+# number of density image bins along each axis
+DEFAULT_DENSITY_GRIDSIZE = 400
+
 DEFAULT_AXIS_TICK_FONTSIZE = 20
 
 __author__ = "Damon May"
@@ -78,14 +87,92 @@ DEFAULT_HIST_BINS = 40
 # hack for printing numeric values on piechart segments
 piechart_valuesum = 0
 
+# page-drawing functions and page directory, as seen by write_pdf_pages() worker processes.
+# Set just before the pool forks
+_worker_page_functions = None
+_worker_page_dir = None
+
 
-def write_pdf(figures, pdf_file):
-    """write an iterable of figures to a PDF"""
+def write_pdf(figures, pdf_file, n_workers=1):
+    """write an iterable of figures to a PDF. With n_workers > 1, see write_pdf_pages(). The figures are all
+    built before this is called and aren't closed, so memory isn't bounded the way write_pdf_pages() bounds it"""
+    if n_workers > 1:
+        write_pdf_pages([(lambda figure=figure: figure) for figure in figures], pdf_file, n_workers=n_workers)
+        return
     with PdfPages(pdf_file) as pdf:
         for plot in figures:
             plot.savefig(pdf, format='pdf')
 
 
+def write_pdf_pages(page_functions, pdf_file, n_workers=1):
+    """
+    Write a multi-page PDF with one page per function. Each function draws and returns a figure, which
+    is closed once it's written. With n_workers > 1, the pages are drawn by a pool of forked processes,
+    each into its own one-page PDF, and the pages are concatenated in order with PyPDF2. Without PyPDF2,
+    pages are drawn one at a time in this process.
+    The concatenated pages don't share fonts and other resources, so that PDF is bigger than the one a
+    single process writes (about 2.5x for infer_taxa_withblast.py's charts)
+    :param page_functions: list of functions with no arguments that return figures, in page order
+    :param pdf_file: path, or file opened in binary mode
+    :param n_workers:
+    :return:
+    """
+    global _worker_page_functions, _worker_page_dir
+    pdf_merger_class = None
+    if n_workers > 1 and len(page_functions) > 1:
+        try:
+            from PyPDF2 import PdfFileMerger as pdf_merger_class
+        except ImportError:
+            logger.info("PyPDF2 is not installed, so drawing PDF pages one at a time")
+    if pdf_merger_class is None:
+        write_pdf(iter_closing(page_function() for page_function in page_functions), pdf_file)
+        return
+    logger.debug("Drawing %d PDF pages on %d workers" % (len(page_functions), n_workers))
+    page_dir = tempfile.mkdtemp(prefix='pdfpages')
+    try:
+        _worker_page_functions = page_functions
+        _worker_page_dir = page_dir
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            page_paths = pool.map(_write_pdf_page, xrange(0, len(page_functions)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _worker_page_functions = None
+            _worker_page_dir = None
+        pdf_merger = pdf_merger_class()
+        for page_path in page_paths:
+            pdf_merger.append(page_path)
+        pdf_merger.write(pdf_file)
+        pdf_merger.close()
+    finally:
+        shutil.rmtree(page_dir)
+
+
+def _write_pdf_page(page_idx):
+    """
+    Draw one page of write_pdf_pages() into its own PDF
+    :param page_idx:
+    :return: the page's path
+    """
+    figure = _worker_page_functions[page_idx]()
+    page_path = os.path.join(_worker_page_dir, 'page%06d.pdf' % page_idx)
+    figure.savefig(page_path, format='pdf')
+    plt.close(figure)
+    return page_path
+
+
+def iter_closing(figures):
+    """
+    Pass figures through, closing each one when the next is asked for, so that only one is open at a time
+    :param figures:
+    :return:
+    """
+    for figure in figures:
+        yield figure
+        plt.close(figure)
+
+
 def write_png(figure, png_file):
     """
     Write a figure to a .png
@@ -218,9 +305,11 @@ def _violin_plot(ax, data, pos, bp=True, color='y'):
 
 def multihist(valueses, title=None, bins=DEFAULT_HIST_BINS, colors=None,
               legend_labels=None, legend_on_chart=False, histtype='bar',
-              should_normalize=False, y_axis_limits=None):
+              should_normalize=False, y_axis_limits=None, weightses=None):
     """histogram of multiple datasets.
-    valueses: a list of lists of values"""
+    valueses: a list of lists of values
+    weightses: if not None, a list of lists of weights, one per value. To plot precomputed
+    bin counts, pass the bin values as valueses and the counts as weightses"""
     figure = plt.figure()
     ax = figure.add_subplot(1, 1, 1)
     mymin = float("inf")
@@ -235,10 +324,14 @@ def multihist(valueses, title=None, bins=DEFAULT_HIST_BINS, colors=None,
         colors = COLORS[0:len(valueses)]
     colorind = -1
 
-    for values in valueses:
+    for i, values in enumerate(valueses):
         colorind += 1
         weights = None
-        if should_normalize:
+        if weightses is not None:
+            weights = np.asarray(weightses[i], dtype=np.float64)
+            if should_normalize:
+                weights = weights / weights.sum()
+        elif should_normalize:
             weights = np.ones_like(values)/float(len(values))
         ax.hist(values, color=colors[colorind], alpha=0.5, range=myrange, bins=bins, histtype=histtype,
                 weights=weights)
@@ -252,15 +345,16 @@ def multihist(valueses, title=None, bins=DEFAULT_HIST_BINS, colors=None,
 
 
 def multihist_skinnybar(valueses, title=None, bins=DEFAULT_HIST_BINS, colors=None,
-                        legend_labels=None, legend_on_chart=False, normed=False):
+                        legend_labels=None, legend_on_chart=False, normed=False, weightses=None):
     """histogram of multiple datasets.
-    valueses: a list of lists of values"""
+    valueses: a list of lists of values
+    weightses: if not None, a list of lists of weights, one per value, as for multihist()"""
     figure = plt.figure()
     ax = figure.add_subplot(1, 1, 1)
     if not colors:
         colors = COLORS[0:len(valueses)]
 
-    ax.hist(valueses, bins=bins, color=colors, normed=normed)
+    ax.hist(valueses, bins=bins, color=colors, normed=normed, weights=weightses)
     if legend_labels:
         add_legend_to_chart(ax, legend_on_chart=legend_on_chart, labels=legend_labels)
     if title:
@@ -495,11 +589,137 @@ def cdfs(valueses, xlabel='value', labels=None, title='CDF', n_bins=500):
                      labels=labels)
 
 
+def should_draw_density(n_points, density, density_threshold):
+    """
+    Decide whether a scatter chart is drawn as a binned density image
+    :param n_points:
+    :param density: True or False to force it, or None to decide by n_points
+    :param density_threshold: draw density images for more points than this
+    :return:
+    """
+    if density is None:
+        return n_points > density_threshold
+    return density
+
+
+def calc_density_edges(x_valueses, y_valueses, gridsize=DEFAULT_DENSITY_GRIDSIZE,
+                       should_logx=False, should_logy=False, x_axis_limits=None, y_axis_limits=None):
+    """
+    Bin edges along each axis for density images of sets of points. All the sets share the edges, so
+    their grids line up. Along log axes the edges are evenly spaced in log space
+    :param x_valueses:
+    :param y_valueses:
+    :param gridsize: number of bins along each axis
+    :param should_logx:
+    :param should_logy:
+    :param x_axis_limits: if given, bin only this range
+    :param y_axis_limits:
+    :return: x edges, y edges
+    """
+    return (_calc_axis_density_edges(x_valueses, gridsize, should_logx, x_axis_limits),
+            _calc_axis_density_edges(y_valueses, gridsize, should_logy, y_axis_limits))
+
+
+def _calc_axis_density_edges(valueses, gridsize, should_log, axis_limits):
+    if axis_limits is not None:
+        low, high = axis_limits
+    else:
+        low = None
+        high = None
+        for values in valueses:
+            values = np.asarray(values, dtype=np.float64)
+            values = values[np.isfinite(values)]
+            if should_log:
+                values = values[values > 0]
+            if len(values) == 0:
+                continue
+            low = values.min() if low is None else min(low, values.min())
+            high = values.max() if high is None else max(high, values.max())
+        if low is None:
+            low, high = (1., 10.) if should_log else (0., 1.)
+    if low == high:
+        low, high = (low / 2., high * 2.) if should_log else (low - 0.5, high + 0.5)
+    if should_log:
+        return np.logspace(np.log10(low), np.log10(high), gridsize + 1)
+    return np.linspace(low, high, gridsize + 1)
+
+
+def calc_density_grid(x_values, y_values, x_edges, y_edges, weights=None):
+    """
+    Count points in each bin. Points outside the edges, or with non-finite coordinates, aren't counted
+    :param x_values:
+    :param y_values:
+    :param x_edges:
+    :param y_edges:
+    :param weights: if given, sum these instead of counting
+    :return: 2D array with a row for each y bin and a column for each x bin
+    """
+    x_values = np.asarray(x_values, dtype=np.float64)
+    y_values = np.asarray(y_values, dtype=np.float64)
+    keep = np.isfinite(x_values) & np.isfinite(y_values)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)[keep]
+    grid, _, _ = np.histogram2d(x_values[keep], y_values[keep], bins=[x_edges, y_edges], weights=weights)
+    return grid.T
+
+
+def composite_density_grids(grids, series_colors, max_alpha=ALPHA_FOR_MULTISCATTER):
+    """
+    Composite per-series count grids into one RGBA image. Each series is drawn in its own color, with
+    opacity rising with the log of the count, over the series before it, as overlapping scatter points are
+    :param grids: count grids, all the same shape
+    :param series_colors: a color for each grid
+    :param max_alpha: opacity of each series' densest bin
+    :return: array of shape grid shape + (4,)
+    """
+    premultiplied_rgb = np.zeros(grids[0].shape + (3,))
+    alpha = np.zeros(grids[0].shape)
+    for grid, series_color in zip(grids, series_colors):
+        if grid.max() <= 0:
+            continue
+        series_alpha = max_alpha * np.log1p(grid) / np.log1p(grid.max())
+        premultiplied_rgb = (np.asarray(colors.colorConverter.to_rgb(series_color)) * series_alpha[..., np.newaxis] +
+                             premultiplied_rgb * (1 - series_alpha[..., np.newaxis]))
+        alpha = series_alpha + alpha * (1 - series_alpha)
+    rgba = np.zeros(grids[0].shape + (4,))
+    drawn = alpha > 0
+    rgba[drawn, :3] = premultiplied_rgb[drawn] / alpha[drawn][:, np.newaxis]
+    rgba[..., 3] = alpha
+    return rgba
+
+
+def draw_density_image(ax, image, x_edges, y_edges, should_logx=False, should_logy=False, **kwargs):
+    """
+    Draw a density grid, or a composited RGBA image, as a single raster image, so that neither drawing
+    time nor file size depends on the number of points
+    :param ax:
+    :param image: 2D grid, or RGBA image from composite_density_grids()
+    :param x_edges:
+    :param y_edges:
+    :param should_logx: whether the x axis will be log-scaled. imshow() can only lay out evenly spaced
+                        bins, so log axes get a rasterized pcolormesh instead
+    :param should_logy:
+    :param kwargs: passed on, e.g., cmap and norm
+    :return: the image or mesh, for a colorbar
+    """
+    if not should_logx and not should_logy:
+        return ax.imshow(image, origin='lower', aspect='auto', interpolation='nearest',
+                         extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]), **kwargs)
+    if image.ndim == 2:
+        return ax.pcolormesh(x_edges, y_edges, image, rasterized=True, **kwargs)
+    mesh = ax.pcolormesh(x_edges, y_edges, np.zeros(image.shape[:2]), rasterized=True)
+    mesh.set_array(None)
+    mesh.set_facecolor(image.reshape(-1, 4))
+    mesh.set_edgecolor('none')
+    return mesh
+
+
 def multiscatter(x_valueses, y_valueses, title=None,
                  xlabel='', ylabel='', pointsize=DEFAULT_POINTSIZE, labels=None,
                  should_logx=False, should_logy=False, log_base=DEFAULT_LOG_BASE,
                  legend_on_chart=False, colors=COLORS, rotate_labels=False,
-                 draw_1to1=False):
+                 draw_1to1=False, density=None, density_threshold=DEFAULT_DENSITY_THRESHOLD_POINTS,
+                 density_gridsize=DEFAULT_DENSITY_GRIDSIZE, density_composite=True):
     """
     Scatterplot multiple sets of values in different colors
     :param x_valueses:
@@ -514,6 +734,12 @@ def multiscatter(x_valueses, y_valueses, title=None,
     :param should_logx:
     :param should_logy:
     :param log_base:
+    :param density: draw the points binned into one density image? None to do that only if there are
+                    more than density_threshold points in all
+    :param density_threshold:
+    :param density_gridsize: number of density bins along each axis
+    :param density_composite: if True, draw each set's density in its own color, composited. If False,
+                              draw the density of all the sets together with the default colormap
     :return:
     """
     assert(len(x_valueses) == len(y_valueses))
@@ -531,10 +757,28 @@ def multiscatter(x_valueses, y_valueses, title=None,
         ax.set_title(title)
     logger.debug("len(x_valueses): %d" % len(x_valueses))
 
-    for i in xrange(0, len(x_valueses)):
-        logger.debug("multiscatter set %d, color %s" % (i, colors[i]))
-        ax.scatter(x_valueses[i], y_valueses[i], s=pointsizes[i], facecolors=colors[i], edgecolors='none',
-                   alpha=ALPHA_FOR_MULTISCATTER)
+    n_points = sum([len(x_values) for x_values in x_valueses])
+    if should_draw_density(n_points, density, density_threshold):
+        logger.debug("multiscatter drawing density of %d points" % n_points)
+        x_edges, y_edges = calc_density_edges(x_valueses, y_valueses, gridsize=density_gridsize,
+                                              should_logx=should_logx, should_logy=should_logy)
+        grids = [calc_density_grid(x_valueses[i], y_valueses[i], x_edges, y_edges)
+                 for i in xrange(0, len(x_valueses))]
+        if density_composite:
+            draw_density_image(ax, composite_density_grids(grids, colors[0:len(grids)]), x_edges, y_edges,
+                               should_logx=should_logx, should_logy=should_logy)
+            # empty sets of points, so the legend has a marker for each set
+            for i in xrange(0, len(x_valueses)):
+                ax.scatter([], [], s=pointsizes[i], facecolors=colors[i], edgecolors='none')
+        else:
+            draw_density_image(ax, np.ma.masked_equal(sum(grids), 0), x_edges, y_edges,
+                               should_logx=should_logx, should_logy=should_logy,
+                               cmap=DEFAULT_COLORMAP_NAME, norm=matplotlib.colors.LogNorm())
+    else:
+        for i in xrange(0, len(x_valueses)):
+            logger.debug("multiscatter set %d, color %s" % (i, colors[i]))
+            ax.scatter(x_valueses[i], y_valueses[i], s=pointsizes[i], facecolors=colors[i], edgecolors='none',
+                       alpha=ALPHA_FOR_MULTISCATTER)
     if labels:
         add_legend_to_chart(ax, legend_on_chart=legend_on_chart, labels=labels, rotate_labels=rotate_labels)
     ax.set_xlabel(xlabel)
@@ -602,7 +846,9 @@ def scatterplot(x_values, y_values, title=None, lowess=False,
                 colors=None, cmap=DEFAULT_COLORMAP_NAME, show_colorbar=False,
                 should_logx=False, should_logy=False, log_base=DEFAULT_LOG_BASE,
                 alpha=0.5, axis_tick_font_size=DEFAULT_AXIS_TICK_FONTSIZE,
-                n_x_axis_ticks=None, x_axis_limits=None, y_axis_limits=None):
+                n_x_axis_ticks=None, x_axis_limits=None, y_axis_limits=None,
+                density=None, density_threshold=DEFAULT_DENSITY_THRESHOLD_POINTS,
+                density_gridsize=DEFAULT_DENSITY_GRIDSIZE):
     """
     scatter plot
     :param x_values:
@@ -616,11 +862,31 @@ def scatterplot(x_values, y_values, title=None, lowess=False,
     :param colors:
     :param cmap:
     :param show_colorbar:
+    :param density: draw the points binned into one density image? None to do that only if there are
+                    more than density_threshold points. Each bin is colored by its log point count, or,
+                    if colors are given, by its points' mean color value
+    :param density_threshold:
+    :param density_gridsize: number of density bins along each axis
     :return:
     """
     figure = plt.figure()
     ax = figure.add_subplot(1, 1, 1)
-    if colors is not None:
+    if should_draw_density(len(x_values), density, density_threshold):
+        logger.debug("scatterplot drawing density of %d points" % len(x_values))
+        x_edges, y_edges = calc_density_edges([x_values], [y_values], gridsize=density_gridsize,
+                                              should_logx=should_logx, should_logy=should_logy,
+                                              x_axis_limits=x_axis_limits, y_axis_limits=y_axis_limits)
+        counts = calc_density_grid(x_values, y_values, x_edges, y_edges)
+        if colors is not None:
+            color_sums = calc_density_grid(x_values, y_values, x_edges, y_edges, weights=colors)
+            image = np.ma.masked_where(counts == 0, color_sums / np.maximum(counts, 1))
+            norm = None
+        else:
+            image = np.ma.masked_equal(counts, 0)
+            norm = matplotlib.colors.LogNorm()
+        myscatter = draw_density_image(ax, image, x_edges, y_edges, should_logx=should_logx,
+                                       should_logy=should_logy, cmap=cmap, norm=norm)
+    elif colors is not None:
         myscatter = ax.scatter(x_values, y_values, s=pointsize, c=colors, cmap=cmap, edgecolors='none', alpha=alpha)
     else:
         myscatter = ax.scatter(x_values, y_values, s=pointsize, cmap=cmap, edgecolors='none', alpha=alpha)
@@ -940,23 +1206,24 @@ def big_hist_multihist_proportion(big_hist_datas, title='', labels=None,
     assert(len(set([big_hist_data.min_shown_value for big_hist_data in big_hist_datas])) == 1)
     assert(len(set([big_hist_data.max_shown_value for big_hist_data in big_hist_datas])) == 1)
     values_forhist = big_hist_datas[0].generate_xvals()
-    xvalueses = []
-    for big_hist_data in big_hist_datas:
-        yvals = big_hist_data.generate_proportion_yvals()
-        xvalues = []
-        for i in xrange(0, len(yvals)):
-            n_thishist_thisval = int(1000 * yvals[i])
-            xvalues.extend([values_forhist[i]] * n_thishist_thisval)
-        xvalueses.append(xvalues)
+    # each bin's value, weighted by the bin's proportion, so memory doesn't depend on the counts.
+    # Leave out bins that are empty in every histogram, so they don't stretch the range
+    nonempty_mask = np.any([big_hist_data.countdata > 0 for big_hist_data in big_hist_datas], axis=0)
+    xvalueses = [np.asarray(values_forhist)[nonempty_mask]] * len(big_hist_datas)
+    weightses = [np.asarray(big_hist_data.generate_proportion_yvals())[nonempty_mask]
+                 for big_hist_data in big_hist_datas]
     bins = DEFAULT_HIST_BINS
     if len(values_forhist) < bins:
         bins = len(values_forhist) + 5
-    return multihist_skinnybar(xvalueses, title=title, bins=bins, legend_labels=labels, normed=True)
+    return multihist_skinnybar(xvalueses, title=title, bins=bins, legend_labels=labels, normed=True,
+                               weightses=weightses)
 
 
 class BigHistData:
     """
-    A data structure for storing count data for big datasets, to be plotted as a line or multiline plot
+    A data structure for storing count data for big datasets, to be plotted as a line or multiline plot.
+    Counts are a numpy array, values can be added a whole array at a time, and histograms with the same
+    bins built separately (e.g., by worker processes or shards) can be merged
     """
     def __init__(self, max_shown_value, min_shown_value=0, binsize=1.0):
         assert(max_shown_value > min_shown_value)
@@ -964,7 +1231,7 @@ class BigHistData:
         self.max_shown_value = max_shown_value
         self.binsize = binsize
         self.n_bins = int((max_shown_value - min_shown_value + 1) / binsize) + 1
-        self.countdata = [0] * self.n_bins
+        self.countdata = np.zeros(self.n_bins, dtype=np.int64)
         self.min_real_value = float('inf')
         self.max_real_value = float('-inf')
 
@@ -975,6 +1242,45 @@ class BigHistData:
         self.min_real_value = min(value, self.min_real_value)
         self.max_real_value = max(value, self.max_real_value)
 
+    def add_values(self, values):
+        """
+        Vectorized add_value() for an array of values. NaNs are skipped
+        :param values: array-like of numbers
+        :return:
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        cropped_values = np.clip(values, self.min_shown_value, self.max_shown_value)
+        bin_idxs = ((cropped_values - self.min_shown_value) / self.binsize).astype(np.int64)
+        self.countdata += np.bincount(bin_idxs, minlength=self.n_bins)[:self.n_bins]
+        self.min_real_value = min(float(values.min()), self.min_real_value)
+        self.max_real_value = max(float(values.max()), self.max_real_value)
+
+    def merge(self, other):
+        """
+        Add another histogram's counts to this one. Raises ValueError if their bins differ
+        :param other: BigHistData
+        :return:
+        """
+        if (self.min_shown_value, self.max_shown_value, self.binsize) != \
+                (other.min_shown_value, other.max_shown_value, other.binsize):
+            raise ValueError("Can't merge histograms with different bins")
+        self.countdata += other.countdata
+        self.min_real_value = min(other.min_real_value, self.min_real_value)
+        self.max_real_value = max(other.max_real_value, self.max_real_value)
+
+    def save(self, outfile):
+        """
+        Write the histogram in compressed numpy .npz format. Read it back with load_big_hist_data()
+        :param outfile: path or file
+        :return:
+        """
+        np.savez_compressed(outfile, countdata=self.countdata,
+                            params=np.array([self.min_shown_value, self.max_shown_value, self.binsize,
+                                             self.min_real_value, self.max_real_value], dtype=np.float64))
+
     def get_count_for_value(self, value):
         return self.countdata[self.calc_idx_for_value(value)]
 
@@ -987,20 +1293,35 @@ class BigHistData:
         return [self.min_shown_value + self.binsize * bin_idx for bin_idx in xrange(0, self.n_bins)]
 
     def generate_proportion_yvals(self):
-        value_sum = sum(self.countdata)
+        value_sum = self.countdata.sum()
         proportion_yvals = self.countdata
         if value_sum > 0:
-            proportion_yvals = [float(y) / value_sum for y in self.countdata]
+            proportion_yvals = self.countdata / float(value_sum)
         return proportion_yvals
 
     def print_min_max_real_values(self):
         print("min=%f, max=%f" % (self.min_real_value, self.max_real_value))
 
     def __str__(self):
-        result = "BigHistData:\nmin=%f, max=%f\n" % (self.min_real_value, self.max_real_value)
-        for i in xrange(0, len(self.countdata)):
-            if i > 0:
-                result = result + ","
-            result = result + str(self.countdata[i])
-        result = result + '\n'
-        return result
+        return "BigHistData:\nmin=%f, max=%f\n%s\n" % (self.min_real_value, self.max_real_value,
+                                                       ','.join([str(count) for count in self.countdata]))
+
+
+def load_big_hist_data(infile):
+    """
+    Read a histogram written by BigHistData.save()
+    :param infile: path or file
+    :return: BigHistData
+    """
+    # read the arrays into memory, so the archive can be closed
+    with np.load(infile) as npz:
+        params = npz['params'].tolist()
+        countdata = np.array(npz['countdata'])
+    min_shown_value, max_shown_value, binsize, min_real_value, max_real_value = params
+    result = BigHistData(max_shown_value, min_shown_value=min_shown_value, binsize=binsize)
+    if len(countdata) != result.n_bins:
+        raise ValueError('Histogram has %d bins, expected %d' % (len(countdata), result.n_bins))
+    result.countdata = countdata
+    result.min_real_value = min_real_value
+    result.max_real_value = max_real_value
+    return result
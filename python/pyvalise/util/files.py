@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""File utilities: transparent handling of compressed files, and of input
+streams that need to be read more than once."""
+
+import argparse
+import bz2
+import gzip
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+# extensions we know how to decompress on the fly
+GZIP_EXTENSIONS = ['.gz', '.gzip']
+BZIP2_EXTENSIONS = ['.bz2']
+
+# read size when skipping through a stream we can't seek in
+SKIP_CHUNK_BYTES = 1 << 20
+
+
+def open_file(path, mode='r', bufsize=-1):
+    """
+    Open a file, transparently (de)compressing gzip and bzip2 files according to their extension.
+    '-' means stdin (for reading) or stdout (for writing)
+    :param path:
+    :param mode:
+    :param bufsize:
+    :return: a file-like object
+    """
+    if path == '-':
+        if 'r' in mode:
+            return sys.stdin
+        return sys.stdout
+    lower_path = path.lower()
+    for extension in GZIP_EXTENSIONS:
+        if lower_path.endswith(extension):
+            return gzip.open(path, mode.replace('U', ''))
+    for extension in BZIP2_EXTENSIONS:
+        if lower_path.endswith(extension):
+            return bz2.BZ2File(path, mode.replace('U', ''), buffering=max(bufsize, 0))
+    return open(path, mode, bufsize)
+
+
+class CompressedFileType(argparse.FileType):
+    """
+    Drop-in replacement for argparse.FileType that opens .gz and .bz2 files transparently
+    """
+    def __call__(self, string):
+        if string == '-':
+            return super(CompressedFileType, self).__call__(string)
+        try:
+            return open_file(string, self._mode, self._bufsize)
+        except IOError as e:
+            raise argparse.ArgumentTypeError("can't open '%s': %s" % (string, e))
+
+
+def is_compressed_path(path):
+    """
+    Will open_file() (de)compress this path?
+    :param path:
+    :return:
+    """
+    lower_path = path.lower()
+    return any(lower_path.endswith(extension) for extension in GZIP_EXTENSIONS + BZIP2_EXTENSIONS)
+
+
+def is_seekable(fileobj):
+    """
+    Can we rewind this file? Pipes and stdin can't be rewound.
+    :param fileobj:
+    :return:
+    """
+    try:
+        fileobj.seek(0, 1)
+        fileobj.tell()
+        return True
+    except (IOError, OSError, AttributeError, ValueError):
+        return False
+
+
+def make_rereadable(fileobj, tmpdir=None):
+    """
+    Return a file object positioned at the start of fileobj's content that can be rewound with seek(0).
+    If fileobj itself is seekable, it is rewound and returned. Otherwise (e.g., a pipe) its content
+    is spooled to an anonymous temporary file, which is returned.
+    :param fileobj:
+    :param tmpdir: directory for the temporary file, if one is needed
+    :return:
+    """
+    if is_seekable(fileobj):
+        fileobj.seek(0)
+        return fileobj
+    logger.debug("Input %s is not seekable. Spooling to a temporary file." % getattr(fileobj, 'name', fileobj))
+    spool = tempfile.TemporaryFile(dir=tmpdir)
+    shutil.copyfileobj(fileobj, spool)
+    spool.seek(0)
+    return spool
+
+
+def skip_to(fileobj, offset):
+    """
+    Position fileobj at offset. Seeks if possible; otherwise (e.g., a pipe) reads and discards
+    everything before offset
+    :param fileobj:
+    :param offset:
+    :return:
+    """
+    if is_seekable(fileobj):
+        fileobj.seek(offset)
+        return
+    remaining = offset
+    while remaining > 0:
+        chunk = fileobj.read(min(remaining, SKIP_CHUNK_BYTES))
+        if not chunk:
+            raise IOError("skip_to: input ended %d bytes before offset %d" % (remaining, offset))
+        remaining -= len(chunk)
+
+
+def calc_fraction_read(fileobj, position=None):
+    """
+    Estimate the fraction of a file that has been read, for progress reporting. For gzipped files this
+    is based on the position in the underlying compressed file.
+    :param fileobj:
+    :param position: current position in fileobj, if the caller is tracking it. Ignored for gzipped files
+    :return: a fraction between 0 and 1, or None if it can't be determined (e.g., a pipe)
+    """
+    raw_fileobj = fileobj
+    if isinstance(fileobj, gzip.GzipFile):
+        raw_fileobj = fileobj.fileobj
+        position = None
+    try:
+        size = os.fstat(raw_fileobj.fileno()).st_size
+        if position is None:
+            position = raw_fileobj.tell()
+    except (IOError, OSError, AttributeError, ValueError):
+        return None
+    if size <= 0:
+        return None
+    return min(1.0, float(position) / size)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""Deferred front end to pyvalise.util.charts. Each chart function here records its arguments as a
+ChartSpec instead of drawing, and nothing imports matplotlib until write_pdf() renders the specs.
+Scripts that only chart when asked to don't pay for the charting imports otherwise."""
+
+import logging
+import multiprocessing
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2012-2014 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+# the functions in pyvalise.util.charts that build and return a figure
+CHART_FUNCTION_NAMES = ['hist', 'multiboxplot', 'multiviolin_fromxy', 'multiviolin', 'violin_plot', 'multihist',
+                        'multihist_skinnybar', 'bar', 'multibar', 'line_plot', 'multiline', 'cdfs', 'multiscatter',
+                        'hexbin', 'scatterplot', 'qqplot_2samples', 'pie', 'heatmap_direct', 'heatmap', 'surface',
+                        'scatter3d', 'big_hist_line', 'big_hist_multiline', 'big_hist_multihist_proportion']
+
+
+class ChartSpec:
+    """
+    A call to a pyvalise.util.charts function, to be made later
+    """
+    def __init__(self, function_name, args, kwargs):
+        self.function_name = function_name
+        self.args = args
+        self.kwargs = kwargs
+
+    def render(self):
+        """
+        Make the call
+        :return: the matplotlib figure
+        """
+        from pyvalise.util import charts
+        return getattr(charts, self.function_name)(*self.args, **self.kwargs)
+
+
+def make_spec_function(function_name):
+    def spec_function(*args, **kwargs):
+        return ChartSpec(function_name, args, kwargs)
+    spec_function.__name__ = function_name
+    spec_function.__doc__ = 'Deferred pyvalise.util.charts.%s(). Returns a ChartSpec' % function_name
+    return spec_function
+
+
+for chart_function_name in CHART_FUNCTION_NAMES:
+    globals()[chart_function_name] = make_spec_function(chart_function_name)
+
+
+def render_pdf(chart_specs, pdf_file, n_workers=1):
+    """
+    Render chart specs into a multi-page PDF, closing each figure once it's written
+    :param chart_specs:
+    :param pdf_file:
+    :param n_workers: number of processes to draw pages with. See charts.write_pdf_pages()
+    :return:
+    """
+    from pyvalise.util import charts
+    logger.debug("Rendering %d charts" % len(chart_specs))
+    charts.write_pdf_pages([chart_spec.render for chart_spec in chart_specs], pdf_file, n_workers=n_workers)
+
+
+def _render_pdf_in_child(chart_specs, pdf_file, n_workers):
+    render_pdf(chart_specs, pdf_file, n_workers=n_workers)
+    # child processes exit without flushing Python's file buffers
+    if hasattr(pdf_file, 'flush'):
+        pdf_file.flush()
+
+
+class BackgroundRender:
+    """
+    A PDF being rendered in a child process
+    """
+    def __init__(self, chart_specs, pdf_file, n_workers=1):
+        self.pdf_file = pdf_file
+        self.process = multiprocessing.Process(target=_render_pdf_in_child, args=(chart_specs, pdf_file, n_workers))
+        self.process.start()
+
+    def wait(self):
+        """
+        Wait for the rendering to finish. Raises ValueError if it failed
+        :return:
+        """
+        self.process.join()
+        if self.process.exitcode != 0:
+            raise ValueError('Rendering %s failed with exit code %d' % (getattr(self.pdf_file, 'name', self.pdf_file),
+                                                                       self.process.exitcode))
+
+
+def write_pdf(chart_specs, pdf_file, background=False, n_workers=1):
+    """
+    Render chart specs into a multi-page PDF
+    :param chart_specs: ChartSpecs, in page order
+    :param pdf_file:
+    :param background: render in a child process, so the caller can get on with other work
+    :param n_workers: number of processes to draw pages with
+    :return: if background, a BackgroundRender to wait() on before exiting. Otherwise None
+    """
+    if background:
+        return BackgroundRender(list(chart_specs), pdf_file, n_workers=n_workers)
+    render_pdf(list(chart_specs), pdf_file, n_workers=n_workers)
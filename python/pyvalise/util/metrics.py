@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""Stage-level instrumentation for pipelines: wall time, CPU time, peak memory and item counts
+per stage, written out as a machine-readable JSON report."""
+
+import json
+import logging
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+
+def get_peak_rss_mb():
+    """
+    Peak resident set size of this process so far, in MB (Linux reports ru_maxrss in KB)
+    :return:
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def get_cpu_secs():
+    """
+    User + system CPU time of this process and its finished children
+    :return:
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def calc_percentile(sorted_values, percentile):
+    """
+    Nearest-rank percentile of an already-sorted list
+    :param sorted_values:
+    :param percentile: 0-100
+    :return:
+    """
+    if not sorted_values:
+        return None
+    idx = int(round(percentile / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[idx]
+
+
+def summarize_latencies(latencies_secs):
+    """
+    Count, total and percentiles of a list of latencies
+    :param latencies_secs:
+    :return: a dict
+    """
+    sorted_latencies = sorted(latencies_secs)
+    return {'n_calls': len(sorted_latencies),
+            'total_secs': sum(sorted_latencies),
+            'p50_secs': calc_percentile(sorted_latencies, 50),
+            'p90_secs': calc_percentile(sorted_latencies, 90),
+            'p99_secs': calc_percentile(sorted_latencies, 99),
+            'max_secs': sorted_latencies[-1] if sorted_latencies else None}
+
+
+class StageRecord:
+    """
+    Measurements for one pipeline stage
+    """
+    def __init__(self, name):
+        self.name = name
+        self.start_wall = time.time()
+        self.start_cpu = get_cpu_secs()
+        self.start_peak_rss_mb = get_peak_rss_mb()
+        self.wall_secs = None
+        self.cpu_secs = None
+        self.peak_rss_mb = None
+        self.peak_rss_delta_mb = None
+        self.counts = {}
+
+    def count(self, name, value):
+        """
+        Record the number of items of some kind this stage handled
+        :param name:
+        :param value:
+        :return:
+        """
+        self.counts[name] = value
+
+    def finish(self):
+        self.wall_secs = time.time() - self.start_wall
+        self.cpu_secs = get_cpu_secs() - self.start_cpu
+        self.peak_rss_mb = get_peak_rss_mb()
+        self.peak_rss_delta_mb = self.peak_rss_mb - self.start_peak_rss_mb
+
+    def to_dict(self):
+        return {'name': self.name,
+                'wall_secs': self.wall_secs,
+                'cpu_secs': self.cpu_secs,
+                'peak_rss_mb': self.peak_rss_mb,
+                'peak_rss_delta_mb': self.peak_rss_delta_mb,
+                'counts': self.counts}
+
+
+class PipelineMetrics:
+    """
+    Collects a StageRecord per stage, plus any extra sections (e.g., HTTP call stats)
+    """
+    def __init__(self):
+        self.start_wall = time.time()
+        self.stages = []
+        self.current_stage = None
+        self.sections = {}
+
+    def start_stage(self, name):
+        """
+        Start timing a stage. Ends the current stage, if there is one
+        :param name:
+        :return: the new StageRecord
+        """
+        if self.current_stage:
+            self.end_stage()
+        self.current_stage = StageRecord(name)
+        return self.current_stage
+
+    def end_stage(self, **counts):
+        """
+        Finish the current stage, recording any counts given as keyword arguments
+        :return:
+        """
+        for name in counts:
+            self.current_stage.count(name, counts[name])
+        self.current_stage.finish()
+        logger.debug("Stage %s: %.2fs wall, %.2fs CPU, peak RSS %.1f MB (+%.1f)" %
+                     (self.current_stage.name, self.current_stage.wall_secs, self.current_stage.cpu_secs,
+                      self.current_stage.peak_rss_mb, self.current_stage.peak_rss_delta_mb))
+        self.stages.append(self.current_stage)
+        self.current_stage = None
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager version of start_stage() and end_stage()
+        :param name:
+        :return:
+        """
+        record = self.start_stage(name)
+        try:
+            yield record
+        finally:
+            if self.current_stage is record:
+                self.end_stage()
+
+    def add_section(self, name, value):
+        """
+        Add an extra JSON-serializable section to the report
+        :param name:
+        :param value:
+        :return:
+        """
+        self.sections[name] = value
+
+    def to_dict(self):
+        result = {'total_wall_secs': time.time() - self.start_wall,
+                  'peak_rss_mb': get_peak_rss_mb(),
+                  'stages': [stage.to_dict() for stage in self.stages]}
+        result.update(self.sections)
+        return result
+
+    def write_json(self, outfile):
+        json.dump(self.to_dict(), outfile, indent=2, sort_keys=True)
+        outfile.write('\n')
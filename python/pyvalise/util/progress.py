@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""Progress and throughput reporting for long-running line-oriented jobs"""
+
+import logging
+import sys
+import time
+
+__author__ = "Damon May"
+__copyright__ = "Copyright (c) 2015 Damon May"
+__license__ = ""
+__version__ = ""
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPORT_INTERVAL_SECS = 10.0
+
+
+def format_duration(seconds):
+    """
+    Format a number of seconds as h:mm:ss
+    :param seconds:
+    :return:
+    """
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds / 3600, (seconds / 60) % 60, seconds % 60)
+
+
+class ProgressReporter:
+    """
+    Reports lines/s, bytes/s, hit rate and ETA for a job that streams through a file.
+    On a terminal the report is rewritten in place on one line; otherwise it's logged.
+    """
+    def __init__(self, start_bytes=0, start_fraction=0.0, interval_secs=DEFAULT_REPORT_INTERVAL_SECS,
+                 stream=sys.stderr):
+        """
+        :param start_bytes: input position we're starting from, e.g., when resuming
+        :param start_fraction: fraction of the input already done when we started
+        :param interval_secs: minimum time between reports
+        :param stream:
+        """
+        self.start_bytes = start_bytes
+        self.start_fraction = start_fraction
+        self.interval_secs = interval_secs
+        self.stream = stream
+        self.is_tty = hasattr(stream, 'isatty') and stream.isatty()
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+        self.n_reports = 0
+
+    def update(self, n_lines, n_bytes, n_hits, fraction_done=None, force=False):
+        """
+        Report progress, if it's been long enough since the last report
+        :param n_lines: lines processed in this run
+        :param n_bytes: absolute input position, in bytes
+        :param n_hits: lines processed in this run that were hits
+        :param fraction_done: fraction of the whole input done, if known. Enables the ETA
+        :param force: report regardless of the interval
+        :return:
+        """
+        now = time.time()
+        if not force and now - self.last_report_time < self.interval_secs:
+            return
+        self.last_report_time = now
+        self.n_reports += 1
+        elapsed = max(now - self.start_time, 1e-6)
+        bytes_this_run = n_bytes - self.start_bytes
+        bytes_per_sec = bytes_this_run / elapsed
+        message = "%d lines, %.0f lines/s, %.2f MB/s, hit rate %.1f%%" % (
+            n_lines, n_lines / elapsed, bytes_per_sec / 1e6,
+            100.0 * n_hits / n_lines if n_lines else 0.0)
+        if fraction_done is not None:
+            message += ", %.1f%% done" % (100.0 * fraction_done)
+            fraction_per_sec = (fraction_done - self.start_fraction) / elapsed
+            if fraction_per_sec > 0:
+                message += ", ETA %s" % format_duration(max(0.0, 1.0 - fraction_done) / fraction_per_sec)
+        if self.is_tty:
+            self.stream.write("\r" + message + "   ")
+            self.stream.flush()
+        else:
+            logger.info(message)
+
+    def finish(self):
+        """
+        End the progress line, if we've been writing one
+        :return:
+        """
+        if self.is_tty and self.n_reports > 0:
+            self.stream.write("\n")
+            self.stream.flush()